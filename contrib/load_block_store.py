@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Fill a jussi block store (see jussi.cache.backends.block_store) offline
+
+    python contrib/load_block_store.py --path /var/lib/jussi/blocks blocks.jsonl
+
+The input has one block, as returned by `condenser_api.get_block`, per line, and
+only irreversible blocks should be loaded, stored blocks are never replaced
+"""
+import argparse
+import sys
+
+import ujson
+
+from jussi.cache.backends.block_store import BlockStore
+from jussi.cache.codecs import CacheCodecs
+from jussi.urn import URN
+
+
+def block_num(block: dict) -> int:
+    return int(block['block_id'][:8], 16)
+
+
+def block_items(lines):
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        block = ujson.loads(line)
+        num = block_num(block)
+        # cache keys and values as jussi caches responses to these requests
+        yield (URN('appbase', 'condenser_api', 'get_block', [num]).cache_key(),
+               {'id': 1, 'jsonrpc': '2.0', 'result': block})
+        yield (URN('appbase', 'block_api', 'get_block', {'block_num': num}).cache_key(),
+               {'id': 1, 'jsonrpc': '2.0', 'result': {'block': block}})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='load blocks into a jussi block store')
+    parser.add_argument('--path', type=str, required=True,
+                        help='the block store directory, ie, JUSSI_BLOCK_STORE_PATH')
+    parser.add_argument('--cache_codec_no_expire', type=str, default=None,
+                        help='the codec to store blocks with, ie, JUSSI_CACHE_CODEC_NO_EXPIRE')
+    parser.add_argument('blocks', type=argparse.FileType('r'), nargs='?', default=sys.stdin)
+    args = parser.parse_args()
+
+    codecs = CacheCodecs.from_args(no_expire=args.cache_codec_no_expire)
+    block_store = BlockStore(args.path, codecs=codecs)
+    try:
+        stored = block_store.load(block_items(args.blocks))
+    finally:
+        block_store.close()
+    print(f'stored {stored} values in {args.path}')
+
+
+if __name__ == '__main__':
+    main()
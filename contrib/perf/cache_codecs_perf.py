@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# pylint: skip-file
+"""
+benchmark cache value codecs on get_block responses
+
+    python contrib/perf/cache_codecs_perf.py --url https://api.hive.blog --start 50000000 --count 200
+    python contrib/perf/cache_codecs_perf.py --file blocks.json
+
+blocks are fetched from --url, or read from --file (a json list of get_block responses
+as saved by --save), and are otherwise taken from the responses in
+tests/data/jsonrpc/appbase.json
+"""
+import argparse
+import os
+import sys
+import time
+
+import ujson
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from jussi.cache.codecs import CODECS  # noqa: E402
+from jussi.cache.codecs import pack  # noqa: E402
+from jussi.cache.codecs import unpack  # noqa: E402
+
+APPBASE_DATA = os.path.join(os.path.dirname(__file__), '..', '..',
+                            'tests', 'data', 'jsonrpc', 'appbase.json')
+
+
+def fetch_blocks(url, start, count):
+    import requests
+    session = requests.Session()
+    batch = [{'id': i, 'jsonrpc': '2.0', 'method': 'block_api.get_block',
+              'params': {'block_num': start + i}} for i in range(count)]
+    return session.post(url, json=batch).json()
+
+
+def load_responses(path):
+    with open(path) as f:
+        return ujson.load(f)
+
+
+def appbase_responses():
+    return [response for _, response in load_responses(APPBASE_DATA)]
+
+
+def bench(responses, repeat):
+    raw_size = sum(len(ujson.dumps(r, ensure_ascii=False).encode()) for r in responses)
+    print(f'{len(responses)} responses, {raw_size / len(responses):.0f} bytes average\n')
+    print(f'{"codec":<12} {"ratio":>6} {"pack us":>9} {"unpack us":>10}')
+    for name, codec in CODECS.items():
+        packed = [pack(r, codec) for r in responses]
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for r in responses:
+                pack(r, codec)
+        pack_time = (time.perf_counter() - start) / (repeat * len(responses))
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for p in packed:
+                unpack(p)
+        unpack_time = (time.perf_counter() - start) / (repeat * len(responses))
+        ratio = raw_size / sum(len(p) for p in packed)
+        print(f'{name:<12} {ratio:>6.2f} {pack_time * 1e6:>9.1f} {unpack_time * 1e6:>10.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark cache value codecs')
+    parser.add_argument('--url', type=str, default=None)
+    parser.add_argument('--start', type=int, default=50000000)
+    parser.add_argument('--count', type=int, default=100)
+    parser.add_argument('--file', type=str, default=None)
+    parser.add_argument('--save', type=str, default=None)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.url:
+        responses = fetch_blocks(args.url, args.start, args.count)
+    elif args.file:
+        responses = load_responses(args.file)
+    else:
+        responses = appbase_responses()
+    if args.save:
+        with open(args.save, 'w') as f:
+            ujson.dump(responses, f)
+    bench(responses, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+Upstream Load Balancing
+-----------------------
+- Each url prefix in the upstream config may list more than one upstream url
+- Each upstream url may carry an integer weight, the default weight is `1`
+- A `Balancer` picks one `UpstreamEndpoint` from its members for each request
+  using a pluggable selection strategy:
+  - `round_robin`: smooth weighted round robin
+  - `least_outstanding_requests`: fewest in-flight requests per unit of weight
+  - `power_of_two_choices`: best of two weighted random picks, scored by observed latency
+- `UpstreamEndpoint` state (in-flight requests, latency) is shared by every
+  balancer which includes that url
+
+Upstream Health
+---------------
+- An endpoint is ejected after `max_consecutive_errors` failed requests, a failed
+  active health check, or when its latency is an outlier among its peers
+- Ejected endpoints receive no requests for `ejection_time` seconds, doubled for
+  each successive ejection up to `max_ejection_time`
+- An endpoint ejected by a failed health check is reinstated by the next passing one,
+  other ejections aren't ended by health checks
+- Reinstated endpoints ramp back up to their full weight over `slow_start` seconds
+- If every member of a balancer is ejected, all members are used
+"""
+import random
+from collections import deque
+from time import perf_counter
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Tuple
+from typing import Union
+
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+DEFAULT_WEIGHT = 1
+DEFAULT_STRATEGY = 'round_robin'
+
+# weight of the newest sample in the latency moving average
+LATENCY_EWMA_ALPHA = 0.2
+
+# recent latencies kept per endpoint for percentiles, and how often to recompute them
+LATENCY_SAMPLES = 200
+LATENCY_PERCENTILE_INTERVAL = 20
+
+# share of full weight given to an endpoint at the start of slow start
+SLOW_START_MIN_WEIGHT_FACTOR = 0.1
+
+WeightedURL = Tuple[str, int]
+WeightedURLs = Tuple[WeightedURL, ...]
+URLConfigValue = Union[str, list, dict]
+
+
+def normalize_weighted_urls(value: URLConfigValue) -> WeightedURLs:
+    """convert a urls config value to a tuple of (url, weight) pairs
+
+    accepted formats:
+        "wss://a"
+        ["wss://a", "wss://b"]
+        [["wss://a", 2], ["wss://b", 1]]
+        [{"url": "wss://a", "weight": 2}, {"url": "wss://b"}]
+    """
+    if isinstance(value, str):
+        return ((value, DEFAULT_WEIGHT),)
+    if isinstance(value, dict):
+        value = [value]
+    weighted_urls = []
+    for item in value:
+        if isinstance(item, str):
+            url, weight = item, DEFAULT_WEIGHT
+        elif isinstance(item, dict):
+            url, weight = item['url'], item.get('weight', DEFAULT_WEIGHT)
+        else:
+            url, weight = item
+        if not isinstance(weight, int) or weight < 1:
+            raise ValueError(f'invalid weight {weight} for upstream url {url}')
+        weighted_urls.append((url, weight))
+    if not weighted_urls:
+        raise ValueError('empty upstream url list')
+    return tuple(weighted_urls)
+
+
+class HealthPolicy(NamedTuple):
+    max_consecutive_errors: int = 5
+    ejection_time: float = 5.0
+    max_ejection_time: float = 300.0
+    slow_start: float = 30.0
+    latency_outlier_factor: float = 5.0
+    latency_outlier_min: float = 0.25
+
+
+DEFAULT_HEALTH_POLICY = HealthPolicy()
+
+
+# pylint: disable=too-many-instance-attributes
+class UpstreamEndpoint:
+    """tracks the observed state and health of a single upstream url"""
+    __slots__ = ('url',
+                 'policy',
+                 'outstanding',
+                 'latency_ewma',
+                 'latency_samples',
+                 'latency_p95',
+                 'requests',
+                 'errors',
+                 'consecutive_errors',
+                 'ejections',
+                 'ejected_until',
+                 'last_ejection_reason')
+
+    def __init__(self, url: str, policy: HealthPolicy=None) -> None:
+        self.url = url
+        self.policy = policy or DEFAULT_HEALTH_POLICY
+        self.outstanding = 0
+        self.latency_ewma = None
+        self.latency_samples = deque(maxlen=LATENCY_SAMPLES)
+        self.latency_p95 = None
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.ejections = 0
+        self.ejected_until = None
+        self.last_ejection_reason = None
+
+    def on_request_start(self) -> float:
+        self.outstanding += 1
+        self.requests += 1
+        return perf_counter()
+
+    def on_request_end(self, start: float, error: bool=False) -> None:
+        self.outstanding -= 1
+        latency = perf_counter() - start
+        if error:
+            self.errors += 1
+            self.consecutive_errors += 1
+            if self.policy.max_consecutive_errors and \
+                    self.consecutive_errors >= self.policy.max_consecutive_errors:
+                self.eject('consecutive_errors')
+            return
+        self.consecutive_errors = 0
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma += LATENCY_EWMA_ALPHA * (latency - self.latency_ewma)
+        self.latency_samples.append(latency)
+        if self.requests % LATENCY_PERCENTILE_INTERVAL == 0:
+            samples = sorted(self.latency_samples)
+            self.latency_p95 = samples[int(len(samples) * 0.95)]
+
+    def on_request_cancel(self) -> None:
+        """a request abandoned by jussi, eg, the losing request of a hedge"""
+        self.outstanding -= 1
+
+    def is_ejected(self, now: float=None) -> bool:
+        if self.ejected_until is None:
+            return False
+        return (now or perf_counter()) < self.ejected_until
+
+    def eject(self, reason: str) -> None:
+        """stop sending requests to this endpoint, backing off on repeated ejections"""
+        now = perf_counter()
+        if self.is_ejected(now):
+            return
+        if self.ejected_until is not None and \
+                now - self.ejected_until > self.policy.max_ejection_time:
+            # healthy for long enough to forget previous ejections
+            self.ejections = 0
+        self.ejections += 1
+        duration = min(self.policy.ejection_time * 2 ** (self.ejections - 1),
+                       self.policy.max_ejection_time)
+        self.ejected_until = now + duration
+        self.consecutive_errors = 0
+        self.last_ejection_reason = reason
+        logger.warning('ejecting upstream endpoint', url=self.url, reason=reason,
+                       duration=duration, ejections=self.ejections)
+
+    def reinstate(self) -> None:
+        """start slowly sending requests to an ejected endpoint again"""
+        if not self.is_ejected():
+            return
+        self.ejected_until = perf_counter()
+        logger.info('reinstating upstream endpoint', url=self.url)
+
+    def on_health_check(self, healthy: bool) -> None:
+        if not healthy:
+            self.eject('health_check')
+            return
+        # ejections for errors or latency last their full backoff, a probe passing
+        # says little about how the endpoint handles real traffic
+        if self.last_ejection_reason == 'health_check':
+            self.reinstate()
+
+    def weight_factor(self, now: float) -> float:
+        """share of configured weight to use, ramps up after an ejection ends"""
+        if self.ejected_until is None or not self.policy.slow_start:
+            return 1.0
+        elapsed = now - self.ejected_until
+        if elapsed >= self.policy.slow_start:
+            return 1.0
+        return max(SLOW_START_MIN_WEIGHT_FACTOR, elapsed / self.policy.slow_start)
+
+    def to_dict(self) -> dict:
+        return {
+            'url': self.url,
+            'outstanding': self.outstanding,
+            'latency_ewma': self.latency_ewma,
+            'latency_p95': self.latency_p95,
+            'requests': self.requests,
+            'errors': self.errors,
+            'consecutive_errors': self.consecutive_errors,
+            'ejected': self.is_ejected(),
+            'ejections': self.ejections,
+            'last_ejection_reason': self.last_ejection_reason
+        }
+
+    def __repr__(self) -> str:
+        return f'UpstreamEndpoint(url={self.url}, outstanding={self.outstanding})'
+
+
+Members = List[Tuple[UpstreamEndpoint, int]]
+
+# pylint: disable=too-few-public-methods,no-self-use
+
+
+class RoundRobinStrategy:
+    """smooth weighted round robin, as used by nginx"""
+    __slots__ = ('_current_weights',)
+
+    def __init__(self, members: Members) -> None:
+        self._current_weights = [0 for _ in members]
+
+    def select(self, members: Members, candidates: List[int], weights: List[float]) -> int:
+        total = 0
+        best = None
+        for i in candidates:
+            self._current_weights[i] += weights[i]
+            total += weights[i]
+            if best is None or self._current_weights[i] > self._current_weights[best]:
+                best = i
+        self._current_weights[best] -= total
+        return best
+
+
+class LeastOutstandingRequestsStrategy:
+    """fewest in-flight requests relative to weight, ties rotate"""
+    __slots__ = ('_offset',)
+
+    def __init__(self, members: Members) -> None:
+        self._offset = 0
+
+    def select(self, members: Members, candidates: List[int], weights: List[float]) -> int:
+        self._offset = (self._offset + 1) % len(candidates)
+        rotated = candidates[self._offset:] + candidates[:self._offset]
+        return min(rotated,
+                   key=lambda i: (members[i][0].outstanding + 1) / weights[i])
+
+
+class PowerOfTwoChoicesStrategy:
+    """pick two members at random (by weight) and keep the one with the lower
+    latency * (in-flight + 1) score"""
+    __slots__ = ()
+
+    def __init__(self, members: Members) -> None:
+        pass
+
+    @staticmethod
+    def score(endpoint: UpstreamEndpoint, weight: float) -> float:
+        # endpoints without latency samples score 0 so they are tried
+        latency = endpoint.latency_ewma or 0.0
+        return latency * (endpoint.outstanding + 1) / weight
+
+    def select(self, members: Members, candidates: List[int], weights: List[float]) -> int:
+        if len(candidates) == 1:
+            return candidates[0]
+        candidate_weights = [weights[i] for i in candidates]
+        first = random.choices(candidates, weights=candidate_weights)[0]
+        second = first
+        while second == first:
+            second = random.choices(candidates, weights=candidate_weights)[0]
+        if self.score(members[second][0], weights[second]) < \
+                self.score(members[first][0], weights[first]):
+            return second
+        return first
+# pylint: enable=too-few-public-methods,no-self-use
+
+
+STRATEGIES = {
+    'round_robin': RoundRobinStrategy,
+    'least_outstanding_requests': LeastOutstandingRequestsStrategy,
+    'power_of_two_choices': PowerOfTwoChoicesStrategy
+}
+
+
+class Balancer:
+    """selects an upstream endpoint from a weighted group of upstream urls"""
+    __slots__ = ('members', 'strategy_name', '_strategy', '_all')
+
+    def __init__(self,
+                 members: Members,
+                 strategy: str=DEFAULT_STRATEGY) -> None:
+        if strategy not in STRATEGIES:
+            raise ValueError(f'unknown upstream balancer strategy {strategy}')
+        self.members = members
+        self.strategy_name = strategy
+        self._strategy = STRATEGIES[strategy](members)
+        self._all = list(range(len(members)))
+
+    @property
+    def urls(self) -> Tuple[str, ...]:
+        return tuple(endpoint.url for endpoint, _ in self.members)
+
+    @property
+    def endpoints(self) -> List[UpstreamEndpoint]:
+        return [endpoint for endpoint, _ in self.members]
+
+    def select(self, exclude: Iterable[UpstreamEndpoint]=()) -> UpstreamEndpoint:
+        """return a healthy endpoint, preferring endpoints not in `exclude`"""
+        now = perf_counter()
+        candidates = [i for i in self._all if not self.members[i][0].is_ejected(now)]
+        if not candidates:
+            # every endpoint is ejected, so none can be avoided
+            candidates = self._all
+        if exclude:
+            candidates = [i for i in candidates if self.members[i][0] not in exclude] or \
+                candidates
+        if len(candidates) == 1:
+            return self.members[candidates[0]][0]
+        weights = [weight * endpoint.weight_factor(now) for endpoint, weight in self.members]
+        return self.members[self._strategy.select(self.members, candidates, weights)][0]
+
+    def eject_latency_outliers(self) -> None:
+        """eject endpoints much slower than the fastest healthy peer"""
+        now = perf_counter()
+        healthy = [endpoint for endpoint, _ in self.members
+                   if not endpoint.is_ejected(now) and endpoint.latency_ewma is not None]
+        if len(healthy) < 2:
+            return
+        fastest = min(endpoint.latency_ewma for endpoint in healthy)
+        for endpoint in healthy:
+            policy = endpoint.policy
+            if not policy.latency_outlier_factor:
+                continue
+            if endpoint.latency_ewma > policy.latency_outlier_min and \
+                    endpoint.latency_ewma > fastest * policy.latency_outlier_factor:
+                endpoint.eject('latency_outlier')
+                # forget the outlier latency so the endpoint is re-measured when reinstated
+                endpoint.latency_ewma = None
+
+    def __repr__(self) -> str:
+        return f'Balancer(strategy={self.strategy_name}, urls={self.urls})'
+
+
+def build_balancer(weighted_urls: WeightedURLs,
+                   endpoints: Dict[str, UpstreamEndpoint],
+                   strategy: str=DEFAULT_STRATEGY) -> Balancer:
+    """build a Balancer, sharing existing UpstreamEndpoints by url"""
+    members = []
+    for url, weight in weighted_urls:
+        if url not in endpoints:
+            endpoints[url] = UpstreamEndpoint(url)
+        members.append((endpoints[url], weight))
+    return Balancer(members, strategy=strategy)
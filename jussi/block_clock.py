@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Block Clock
+-----------
+- Tracks the head block and last irreversible block (LIB) of the upstream chain
+  by polling `condenser_api.get_dynamic_global_properties` every block interval
+- One worker per host polls, the rest read what it publishes:
+  - the state lives in a small mmap-ed file (by default in /dev/shm), written
+    under a seqlock so readers never see a torn update
+  - the poller is whichever worker holds an exclusive flock on the file, every
+    worker tries to take the lock each interval, so if the poller dies another
+    worker takes over within one interval
+- Every worker calls `on_update` with the new state whenever it changes, which
+  is how the LIB reaches `app.config.last_irreversible_block_num` and the caching
+  code, see jussi.listeners
+- With no path, eg, when /dev/shm can't be opened, the state lives in an
+  anonymous mmap and every worker polls for itself
+- Polls go to an upstream picked by the balancer, so ejected upstreams are
+  skipped and the poll results count towards their health
+"""
+import asyncio
+import fcntl
+import mmap
+import os
+import struct
+from calendar import timegm
+from time import strptime
+from time import time
+from typing import Awaitable
+from typing import Callable
+from typing import NamedTuple
+from typing import Optional
+
+import structlog
+import ujson
+from async_timeout import timeout as async_timeout
+# pylint: disable=no-name-in-module
+from websockets import connect as websockets_connect
+
+from .urn import from_request as urn_from_request
+
+# pylint: enable=no-name-in-module
+
+logger = structlog.get_logger(__name__)
+
+BLOCK_CLOCK_PATH = '/dev/shm/jussi-block-clock'
+BLOCK_INTERVAL = 3.0
+
+# seq, head block num, LIB, head block time, updated at
+STATE = struct.Struct('<IQQdd')
+SEQ = struct.Struct('<I')
+READ_RETRIES = 10
+
+DGP_REQUEST = {
+    'id': 0,
+    'jsonrpc': '2.0',
+    'method': 'condenser_api.get_dynamic_global_properties',
+    'params': []
+}
+DGP_URN = urn_from_request(DGP_REQUEST)
+
+
+class BlockState(NamedTuple):
+    head_block_num: int
+    last_irreversible_block_num: int
+    head_block_time: float
+    updated_at: float
+
+
+EMPTY_STATE = BlockState(0, 0, 0.0, 0.0)
+
+
+def parse_block_time(block_time: str) -> float:
+    return float(timegm(strptime(block_time, '%Y-%m-%dT%H:%M:%S')))
+
+
+def block_state_from_response(response: bytes) -> BlockState:
+    result = ujson.loads(response)['result']
+    return BlockState(head_block_num=int(result['head_block_number']),
+                      last_irreversible_block_num=int(result['last_irreversible_block_num']),
+                      head_block_time=parse_block_time(result['time']),
+                      updated_at=time())
+
+
+class BlockClock:
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, upstreams, session, interval: float=BLOCK_INTERVAL,
+                 timeout: float=None, path: Optional[str]=BLOCK_CLOCK_PATH,
+                 on_update: Callable[[BlockState], Awaitable[None]]=None,
+                 loop=None) -> None:
+        self._upstreams = upstreams
+        self._session = session
+        self.interval = interval
+        self._timeout = timeout or interval
+        self.path = path
+        self._on_update = on_update
+        self._loop = loop or asyncio.get_event_loop()
+        if path is None:
+            # a per-process clock, nothing to share
+            self._fd = None
+            self._mm = mmap.mmap(-1, STATE.size)
+        else:
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(self._fd).st_size < STATE.size:
+                os.ftruncate(self._fd, mmap.PAGESIZE)
+            self._mm = mmap.mmap(self._fd, STATE.size)
+        self.is_leader = False
+        self.state = EMPTY_STATE
+        self.state = self.read()
+        self.polls = 0
+        self.poll_errors = 0
+        self._ws_conn = None
+        self._ws_url = None  # type: Optional[str]
+        self._task = None  # type: Optional[asyncio.Task]
+
+    @property
+    def head_block_num(self) -> int:
+        return self.state.head_block_num
+
+    @property
+    def last_irreversible_block_num(self) -> int:
+        return self.state.last_irreversible_block_num
+
+    def start(self) -> None:
+        self._task = self._loop.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        if self._ws_conn is not None:
+            await self._ws_conn.close()
+            self._ws_conn = None
+        if self.is_leader:
+            if self._fd is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self.is_leader = False
+
+    def close(self) -> None:
+        self._mm.close()
+        if self._fd is not None:
+            os.close(self._fd)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error('block clock error', e=e)
+            await asyncio.sleep(self.interval)
+
+    async def tick(self) -> None:
+        if self.try_lead():
+            await self.poll()
+        state = self.read()
+        if state != self.state:
+            self.state = state
+            if self._on_update is not None:
+                await self._on_update(state)
+
+    def try_lead(self) -> bool:
+        if not self.is_leader:
+            try:
+                if self._fd is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            logger.info('block clock polling upstream', pid=os.getpid())
+            self.is_leader = True
+        return True
+
+    async def poll(self) -> None:
+        self.polls += 1
+        endpoint = self._upstreams.balancer(DGP_URN).select()
+        url = endpoint.url
+        start = endpoint.on_request_start()
+        try:
+            async with async_timeout(self._timeout):
+                if url.startswith('ws'):
+                    response = await self._fetch_ws(url)
+                else:
+                    response = await self._fetch_http(url)
+            state = block_state_from_response(response)
+        except asyncio.CancelledError:
+            endpoint.on_request_cancel()
+            raise
+        except Exception as e:
+            endpoint.on_request_end(start, error=True)
+            self.poll_errors += 1
+            self._drop_ws_conn()
+            logger.info('block clock poll failed', url=url, e=e)
+            return
+        endpoint.on_request_end(start)
+        current = self.read()
+        if state.head_block_num < current.head_block_num or \
+                state.last_irreversible_block_num < current.last_irreversible_block_num:
+            # an upstream behind the one last polled mustn't move the clock back
+            state = current._replace(updated_at=state.updated_at)
+        self.publish(state)
+
+    async def _fetch_http(self, url: str) -> bytes:
+        async with self._session.post(url, data=ujson.dumps(DGP_REQUEST)) as resp:
+            return await resp.read()
+
+    async def _fetch_ws(self, url: str) -> bytes:
+        if self._ws_conn is not None and self._ws_url != url:
+            # the balancer picked another upstream
+            self._drop_ws_conn()
+        if self._ws_conn is None or not self._ws_conn.open:
+            self._ws_conn = await websockets_connect(url, loop=self._loop)
+            self._ws_url = url
+        await self._ws_conn.send(ujson.dumps(DGP_REQUEST))
+        return await self._ws_conn.recv()
+
+    def _drop_ws_conn(self) -> None:
+        if self._ws_conn is not None:
+            self._ws_conn.fail_connection()
+            self._ws_conn = None
+
+    def publish(self, state: BlockState) -> None:
+        """write state to the shared file, only the leader may call this"""
+        seq = SEQ.unpack_from(self._mm, 0)[0]
+        SEQ.pack_into(self._mm, 0, (seq + 1) & 0xFFFFFFFF)
+        STATE.pack_into(self._mm, 0, (seq + 1) & 0xFFFFFFFF, *state)
+        SEQ.pack_into(self._mm, 0, (seq + 2) & 0xFFFFFFFF)
+
+    def read(self) -> BlockState:
+        for _ in range(READ_RETRIES):
+            seq, *state = STATE.unpack_from(self._mm, 0)
+            if not seq & 1 and SEQ.unpack_from(self._mm, 0)[0] == seq:
+                return BlockState(*state)
+        return self.state
+
+    def to_dict(self) -> dict:
+        state = self.state
+        return {
+            'head_block_num': state.head_block_num,
+            'last_irreversible_block_num': state.last_irreversible_block_num,
+            'head_block_time': state.head_block_time,
+            'age': time() - state.updated_at if state.updated_at else None,
+            'is_leader': self.is_leader,
+            'polls': self.polls,
+            'poll_errors': self.poll_errors
+        }
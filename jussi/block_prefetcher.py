@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Sequential Block Prefetching
+----------------------------
+- Indexers walk the chain with `get_block(n)`, `get_block(n+1)`, ..., and without
+  prefetching each call is a cache miss sent upstream one at a time
+- Each client's `get_block` and `get_ops_in_block` calls are tracked per method, once
+  a client has asked for `min_run` consecutive blocks, the next `depth` blocks are
+  fetched upstream in a single jsonrpc batch and cached, so the client's next calls
+  are cache hits
+- The window is refilled once the client has used half of it, so a steady walk
+  sends one upstream batch per `depth / 2` blocks
+- Prefetching is bounded:
+  - a client has at most `client_budget` blocks being prefetched at once, and all
+    clients at most `max_in_flight`
+  - blocks past the head block (see jussi.block_clock) aren't prefetched
+  - prefetch batches queue behind client requests as `bulk` priority (see
+    jussi.fair_queue), and are skipped when the upstream's concurrency limit is
+    reached (see jussi.concurrency_limits)
+- Blocks which are already cached aren't fetched again
+"""
+import asyncio
+from collections import OrderedDict
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+import structlog
+from async_timeout import timeout as async_timeout
+
+from .cache.ttl import TTL
+from .cache.utils import is_negative
+from .cache.utils import jsonrpc_cache_key
+from .request.jsonrpc import from_http_request
+from .typedefs import HTTPRequest
+from .typedefs import SingleJrpcRequest
+from .upstream_batcher import BatchSender
+from .upstream_batcher import http_batch_sender
+from .upstream_batcher import ws_batch_sender
+from .validators import is_get_block_request
+from .validators import is_get_ops_in_block_request
+from .validators import is_valid_get_block_response
+from .validators import is_valid_non_error_single_jsonrpc_response
+
+logger = structlog.get_logger(__name__)
+
+PREFETCH_PRIORITY = 'bulk'
+MAX_CLIENTS = 10000
+
+StreamKey = Tuple[str, str, str, str]
+
+
+def block_num_param(request: SingleJrpcRequest) -> Optional[int]:
+    """the block num of a get_block or get_ops_in_block request, else None"""
+    if not (is_get_block_request(request) or is_get_ops_in_block_request(request)):
+        return None
+    if request.upstream.ttl == TTL.NO_CACHE:
+        return None
+    params = request.urn.params
+    try:
+        if isinstance(params, list):
+            return int(params[0])
+        if isinstance(params, dict):
+            return int(params['block_num'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        pass
+    return None
+
+
+def replace_block_num(params, block_num: int):
+    if isinstance(params, dict):
+        return dict(params, block_num=block_num)
+    return [block_num] + list(params[1:])
+
+
+def with_block_num(request: SingleJrpcRequest, block_num: int) -> dict:
+    """a raw copy of request, as the client sent it, for another block"""
+    raw_request = request.original_request or request.to_dict()
+    raw_request = dict(raw_request)
+    params = raw_request['params']
+    if raw_request['method'] == 'call':
+        api, method, call_params = params[:3]
+        raw_request['params'] = [api, method, replace_block_num(call_params, block_num)]
+    else:
+        raw_request['params'] = replace_block_num(params, block_num)
+    return raw_request
+
+
+def is_prefetchable_response(request: SingleJrpcRequest, response: dict) -> bool:
+    if not is_valid_non_error_single_jsonrpc_response(response) or not response['result']:
+        return False
+    if is_get_block_request(request):
+        return is_valid_get_block_response(request, response)
+    return True
+
+
+class BlockStream:
+    __slots__ = ('last_block_num', 'run', 'prefetched_through', 'in_flight')
+
+    def __init__(self, block_num: int) -> None:
+        self.last_block_num = block_num
+        self.run = 1
+        self.prefetched_through = block_num
+        self.in_flight = 0
+
+
+class BlockPrefetcher:
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+    def __init__(self, depth: int, min_run: int=3, client_budget: int=None,
+                 max_in_flight: int=500, loop=None) -> None:
+        self.depth = depth
+        self.min_run = min_run
+        self.client_budget = client_budget or depth * 2
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._loop = loop or asyncio.get_event_loop()
+        self._streams = OrderedDict()  # type: Dict[StreamKey, BlockStream]
+        self._senders = dict()  # type: Dict[str, BatchSender]
+        self.batches = 0
+        self.prefetched = 0
+        self.already_cached = 0
+        self.skipped = 0
+        self.errors = 0
+
+    def observe(self, http_request: HTTPRequest) -> None:
+        """track the blocks requested by http_request and prefetch ahead of them"""
+        if http_request.is_single_jrpc:
+            requests = (http_request.jsonrpc,)
+        else:
+            requests = http_request.jsonrpc
+        for request in requests:
+            block_num = block_num_param(request)
+            if block_num is not None:
+                self._observe(http_request, request, block_num)
+
+    def _stream(self, key: StreamKey, block_num: int) -> BlockStream:
+        stream = self._streams.get(key)
+        if stream is None:
+            stream = BlockStream(block_num)
+            self._streams[key] = stream
+            if len(self._streams) > MAX_CLIENTS:
+                self._streams.popitem(last=False)
+            return stream
+        self._streams.move_to_end(key)
+        if block_num == stream.last_block_num + 1:
+            stream.run += 1
+        elif block_num != stream.last_block_num:
+            stream.run = 1
+            stream.prefetched_through = block_num
+        stream.last_block_num = block_num
+        return stream
+
+    def _observe(self, http_request: HTTPRequest, request: SingleJrpcRequest,
+                 block_num: int) -> None:
+        urn = request.urn
+        key = (http_request.client_ip, urn.namespace, urn.api, urn.method)
+        stream = self._stream(key, block_num)
+        if stream.run < self.min_run:
+            return
+        # refill once half the prefetched window has been used
+        if stream.prefetched_through - block_num > self.depth // 2:
+            return
+        start = max(block_num, stream.prefetched_through) + 1
+        end = block_num + self.depth
+        block_clock = http_request.app.config.block_clock
+        if block_clock is not None and block_clock.head_block_num:
+            end = min(end, block_clock.head_block_num)
+        count = min(end - start + 1,
+                    self.client_budget - stream.in_flight,
+                    self.max_in_flight - self.in_flight)
+        if count <= 0:
+            self.skipped += 1
+            return
+        end = start + count - 1
+        stream.prefetched_through = end
+        stream.in_flight += count
+        self.in_flight += count
+        self._loop.create_task(self.prefetch(http_request, request, stream, start, end))
+
+    async def prefetch(self, http_request: HTTPRequest, request: SingleJrpcRequest,
+                       stream: BlockStream, start: int, end: int) -> None:
+        count = end - start + 1
+        try:
+            await self._prefetch(http_request, request, start, end)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.errors += 1
+            logger.info('block prefetch failed', start=start, end=end, e=e)
+        finally:
+            stream.in_flight -= count
+            self.in_flight -= count
+
+    async def _prefetch(self, http_request: HTTPRequest, request: SingleJrpcRequest,
+                        start: int, end: int) -> None:
+        config = http_request.app.config
+        cache_group = config.cache_group
+        requests = [from_http_request(http_request, i, with_block_num(request, block_num))
+                    for i, block_num in enumerate(range(start, end + 1))]
+        cached = await cache_group.mget([jsonrpc_cache_key(r) for r in requests])
+        cached = [None if is_negative(value) else value for value in cached]
+        self.already_cached += sum(value is not None for value in cached)
+        requests = [r for r, value in zip(requests, cached) if value is None]
+        if not requests:
+            return
+
+        url = request.upstream.url
+        limiter = None
+        if config.upstream_concurrency_limits is not None:
+            limiter = config.upstream_concurrency_limits[url]
+            if not limiter.try_acquire():
+                self.skipped += 1
+                return
+        queue = None
+        if config.upstream_fair_queues is not None:
+            queue = config.upstream_fair_queues[url]
+            await queue.acquire(PREFETCH_PRIORITY, http_request.client_ip)
+        try:
+            batch = [dict(r.to_upstream_request(as_json=False), id=i)
+                     for i, r in enumerate(requests)]
+            async with async_timeout(request.upstream.timeout):
+                responses = await self._sender(config, url)(batch)
+        finally:
+            if queue is not None:
+                queue.release()
+            if limiter is not None:
+                limiter.on_ignore()
+        self.batches += 1
+
+        responses_by_id = {response.get('id'): response for response in responses
+                           if isinstance(response, dict)}
+        prefetched_requests = []
+        prefetched_responses = []
+        for i, r in enumerate(requests):
+            response = responses_by_id.get(i)
+            if response is not None and is_prefetchable_response(r, response):
+                response['id'] = r.id
+                prefetched_requests.append(r)
+                prefetched_responses.append(response)
+        self.prefetched += len(prefetched_requests)
+        if prefetched_requests:
+            await cache_group.cache_batch_jsonrpc_response(
+                requests=prefetched_requests,
+                responses=prefetched_responses,
+                last_irreversible_block_num=config.last_irreversible_block_num)
+
+    def _sender(self, config, url: str) -> BatchSender:
+        send = self._senders.get(url)
+        if send is None:
+            if url.startswith('ws'):
+                send = ws_batch_sender(config.websocket_pools[url])
+            else:
+                send = http_batch_sender(config.upstream_http_pools.session(url), url)
+            self._senders[url] = send
+        return send
+
+    def to_dict(self) -> dict:
+        return {
+            'depth': self.depth,
+            'clients': len(self._streams),
+            'in_flight': self.in_flight,
+            'batches': self.batches,
+            'prefetched': self.prefetched,
+            'already_cached': self.already_cached,
+            'skipped': self.skipped,
+            'errors': self.errors
+        }
@@ -1,9 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from urllib.parse import urlparse
-from collections import namedtuple
 from typing import Any
-from enum import IntEnum
 
 import structlog
 
@@ -12,29 +10,31 @@ from aredis import StrictRedis
 
 from .cache_group import CacheGroup
 from ..typedefs import WebApp
+from .backends.batcher import BatchedReadCache
+from .backends.block_store import BlockStore
+from .backends.lru import BoundedMemoryCache
 from .backends.redis import Cache
+from .backends.replicas import ReplicaSet
+from .backends.shm import SharedMemoryCache
+from .codecs import CacheCodecs
+from .tiers import CacheGroupItem
+from .tiers import SpeedTier
 
 logger = structlog.get_logger(__name__)
 
 
-class SpeedTier(IntEnum):
-    SLOW = 1
-    FAST = 2
-    FASTEST = 3
-
-
-CacheGroupItem = namedtuple('CacheGroupItem', ('cache', 'read', 'write', 'speed_tier'))
-
-
 # pylint: disable=unused-argument,too-many-branches,too-many-nested-blocks
 def setup_caches(app: WebApp, loop) -> Any:
     logger.info('cache.setup_caches', when='before_server_start')
     args = app.config.args
     caches = []
+    codecs = CacheCodecs.from_args(default=args.cache_codec,
+                                   no_expire=args.cache_codec_no_expire,
+                                   prefixes=args.cache_codec_prefixes)
     if args.redis_url:
         try:
             redis_client = StrictRedis().from_url(args.redis_url)
-            redis_cache = Cache(redis_client)
+            redis_cache = Cache(redis_client, codecs=codecs)
             if redis_cache:
                 caches.append(CacheGroupItem(cache=redis_cache,
                                              read=False,
@@ -43,6 +43,8 @@ def setup_caches(app: WebApp, loop) -> Any:
         except Exception as e:
             logger.error('failed to add redis cache to caches', exception=e)
         if args.redis_read_replica_urls:
+            replica_caches = []
+            replica_names = []
             for url_string in args.redis_read_replica_urls:
                 url = urlparse(url_string)
                 logger.info('Adding redis read replicas',
@@ -50,13 +52,67 @@ def setup_caches(app: WebApp, loop) -> Any:
                             host=url.hostname,
                             port=url.port)
                 redis_client = StrictRedis().from_url(url_string)
-                redis_cache = Cache(redis_client)
+                redis_cache = Cache(redis_client, codecs=codecs)
                 if redis_cache:
-                    caches.append(
-                        CacheGroupItem(cache=redis_cache,
-                                       read=True,
-                                       write=False,
-                                       speed_tier=SpeedTier.SLOW))
+                    replica_caches.append(redis_cache)
+                    replica_names.append(f'{url.hostname}:{url.port}')
+            # several replicas are read as one, each read going to the fastest
+            if len(replica_caches) > 1:
+                replica_caches = [ReplicaSet(replica_caches,
+                                             names=replica_names,
+                                             timeout=args.cache_read_timeout,
+                                             hedge_percentile=args.redis_read_replica_hedge_percentile,
+                                             eject_after=args.redis_read_replica_eject_after,
+                                             eject_seconds=args.redis_read_replica_eject_seconds)]
+            for redis_cache in replica_caches:
+                caches.append(
+                    CacheGroupItem(cache=redis_cache,
+                                   read=True,
+                                   write=False,
+                                   speed_tier=SpeedTier.SLOW))
+
+    if args.cache_read_batch_window > 0:
+        logger.info('batching redis reads',
+                    window=args.cache_read_batch_window,
+                    max_keys=args.cache_read_batch_max_keys)
+        caches = [item._replace(cache=BatchedReadCache(item.cache,
+                                                       window=args.cache_read_batch_window,
+                                                       max_keys=args.cache_read_batch_max_keys,
+                                                       loop=loop))
+                  for item in caches]
+
+    if args.shared_memory_cache_size > 0:
+        try:
+            shared_memory_cache = SharedMemoryCache(args.shared_memory_cache_size,
+                                                    path=args.shared_memory_cache_path,
+                                                    codecs=codecs)
+            caches.append(CacheGroupItem(cache=shared_memory_cache,
+                                         read=True,
+                                         write=True,
+                                         speed_tier=SpeedTier.FASTEST))
+        except Exception as e:
+            logger.error('failed to add shared memory cache to caches', exception=e)
+
+    if args.block_store_path:
+        try:
+            block_store = BlockStore(args.block_store_path, codecs=codecs)
+            caches.append(CacheGroupItem(cache=block_store,
+                                         read=True,
+                                         write=True,
+                                         speed_tier=SpeedTier.FAST))
+        except Exception as e:
+            logger.error('failed to add block store to caches', exception=e)
 
-    configured_cache_group = CacheGroup(caches=caches)
+    memory_cache = BoundedMemoryCache(max_size=args.memory_cache_max_size,
+                                      max_bytes=args.memory_cache_max_bytes,
+                                      policy=args.memory_cache_policy)
+    configured_cache_group = CacheGroup(caches=caches, memory_cache=memory_cache,
+                                        encoded_memory_cache=args.memory_cache_encoded,
+                                        negative_ttl=args.cache_negative_ttl,
+                                        error_ttl=args.cache_error_ttl,
+                                        error_codes=args.cache_error_codes,
+                                        promote_min_hits=args.cache_promote_min_hits,
+                                        promote_ttl=args.cache_promote_ttl,
+                                        write_behind=args.cache_write_behind,
+                                        write_behind_max_pending=args.cache_write_behind_max_pending)
     return configured_cache_group
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Batched Cache Reads
+-------------------
+- Wraps a read cache so that `get`/`mget` calls from concurrent http requests are
+  collected and sent as a single `mget`
+- A batch is sent `window` seconds after its first read, or as soon as it holds
+  `max_keys` keys, whichever comes first
+- Keys read by several requests in the same batch are only read once
+- An error reading a batch is raised to every request in it
+- Writes and everything else go straight to the wrapped cache
+"""
+import asyncio
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import structlog
+
+from .redis import CacheKey
+from .redis import CacheKeys
+from .redis import CacheResult
+from .redis import CacheResults
+
+logger = structlog.get_logger(__name__)
+
+CACHE_READ_BATCH_MAX_KEYS = 500
+
+
+class BatchedReadCache:
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, cache, window: float, max_keys: int=None, loop=None) -> None:
+        self._cache = cache
+        self._window = window
+        self._max_keys = max_keys or CACHE_READ_BATCH_MAX_KEYS
+        self._loop = loop or asyncio.get_event_loop()
+        self._pending = []  # type: List[Tuple[CacheKeys, asyncio.Future]]
+        self._pending_keys = 0
+        self._timer = None  # type: Optional[asyncio.Handle]
+        self.batches = 0
+        self.reads = 0
+        self.keys = 0
+
+    def __getattr__(self, name):
+        return getattr(self._cache, name)
+
+    async def get(self, key: CacheKey) -> CacheResult:
+        results = await self.mget([key])
+        return results[0]
+
+    async def mget(self, keys: CacheKeys) -> CacheResults:
+        if not keys:
+            return []
+        future = self._loop.create_future()
+        self._pending.append((keys, future))
+        self._pending_keys += len(keys)
+        self.reads += 1
+        if self._pending_keys >= self._max_keys:
+            self._flush()
+        elif self._timer is None:
+            self._timer = self._loop.call_later(self._window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch = self._pending
+        self._pending = []
+        self._pending_keys = 0
+        if batch:
+            self._loop.create_task(self._read_batch(batch))
+
+    async def _read_batch(self, batch: List[Tuple[CacheKeys, asyncio.Future]]) -> None:
+        keys = list(dict.fromkeys(key for keys, _ in batch for key in keys))
+        self.batches += 1
+        self.keys += len(keys)
+        try:
+            results = dict(zip(keys, await self._cache.mget(keys)))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for keys, future in batch:
+            if not future.done():
+                future.set_result([results[key] for key in keys])
+
+    def to_dict(self) -> dict:
+        return {
+            'batches': self.batches,
+            'reads': self.reads,
+            'keys': self.keys
+        }
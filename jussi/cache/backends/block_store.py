@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+Block Store
+-----------
+- A cache tier on local disk for irreversible blocks, below the memory and shared
+  memory caches and above redis, so irreversible `get_block`, `get_block_header` and
+  `get_ops_in_block` responses are read without a network round trip and don't fill redis
+- Only values which never expire (see jussi.cache.ttl) for keys of those methods are
+  stored, every other key is a miss without any io
+- Blocks are split into segments of `segment_blocks` blocks. Each segment has one
+  append-only data file, and one index file per key shape (the key with its block
+  number left out, eg, `appbase.condenser_api.get_block.v1=[#]`, or
+  `appbase.condenser_api.get_ops_in_block.v1=#:<digest>` for keys with long params)
+- An index file is a fixed size array of (offset, length, crc32) entries, one per
+  block in the segment, so a lookup is a single read from an mmap-ed index and one
+  from the mmap-ed data file. Index files are sparse, so unused entries take no disk
+- Irreversible blocks never change, so a stored value is never written again, and
+  values are compressed with the cache's codec for values which never expire
+- Files are shared by every jussi worker on a host: appends to a data file are
+  serialized with flock, the index entry is written after the value, and reads check
+  the value's crc32
+- File io, including waiting for the flock, runs on a thread of the store's own, so it
+  doesn't block the event loop. Using a single thread keeps the open segments safe
+  without any more locking
+- `load` stores blocks offline, see contrib/load_block_store.py
+"""
+import asyncio
+import fcntl
+import mmap
+import os
+import re
+import struct
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from hashlib import blake2b
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NoReturn
+from typing import Optional
+from typing import Tuple
+from zlib import crc32
+
+import structlog
+
+from ..codecs import CacheCodecs
+from .redis import CacheKey
+from .redis import CacheKeys
+from .redis import CachePairs
+from .redis import CacheResult
+from .redis import CacheResults
+from .redis import CacheTTLValue
+
+logger = structlog.get_logger(__name__)
+
+BLOCK_STORE_SEGMENT_BLOCKS = 100000
+BLOCK_STORE_MAX_OPEN_SEGMENTS = 64
+
+# offset, length and crc32 of a value in the segment's data file
+INDEX_ENTRY = struct.Struct('<QII')
+
+# cache keys of block methods with the block num as their first param, either in
+# the params or before the digest of long params, see jussi.urn.URN.cache_key
+BLOCK_KEY_PATTERN = re.compile(
+    r'^(?P<prefix>[^=:]+\.(?:get_block|get_block_header|get_ops_in_block)\.v\d+'
+    r'=(?:\[|\{"block_num":)?)(?P<block_num>\d+)(?P<suffix>.*)$')
+
+
+def block_key(key: CacheKey) -> Optional[Tuple[str, int]]:
+    """the shape and block num of a block method's cache key, else None"""
+    match = BLOCK_KEY_PATTERN.match(key)
+    if match is None:
+        return None
+    return f'{match["prefix"]}#{match["suffix"]}', int(match['block_num'])
+
+
+def shape_name(shape: str) -> str:
+    return blake2b(shape.encode(), digest_size=8).hexdigest()
+
+
+class Segment:
+    """the open data file and index files of a segment"""
+    __slots__ = ('path', 'index_size', 'fd', 'mm', 'indexes')
+
+    def __init__(self, path: str, index_size: int, fd: int) -> None:
+        self.path = path
+        self.index_size = index_size
+        self.fd = fd
+        self.mm = None
+        self.indexes = dict()  # type: Dict[str, Tuple[int, mmap.mmap]]
+
+    def index(self, shape: str, create: bool) -> Optional[mmap.mmap]:
+        index = self.indexes.get(shape)
+        if index is not None:
+            return index[1]
+        path = f'{self.path}-{shape_name(shape)}.idx'
+        try:
+            fd = os.open(path, os.O_RDWR | (os.O_CREAT if create else 0), 0o644)
+        except FileNotFoundError:
+            return None
+        if os.fstat(fd).st_size < self.index_size:
+            os.ftruncate(fd, self.index_size)
+        index = mmap.mmap(fd, self.index_size)
+        self.indexes[shape] = (fd, index)
+        return index
+
+    def read(self, offset: int, length: int) -> Optional[bytes]:
+        end = offset + length
+        if self.mm is None or end > len(self.mm):
+            size = os.fstat(self.fd).st_size
+            if end > size:
+                return None
+            if self.mm is not None:
+                self.mm.close()
+            self.mm = mmap.mmap(self.fd, size, prot=mmap.PROT_READ)
+        return self.mm[offset:end]
+
+    def append(self, data: bytes) -> int:
+        """append data to the data file, returning its offset, the caller holds the lock"""
+        offset = os.lseek(self.fd, 0, os.SEEK_END)
+        view = memoryview(data)
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+        return offset
+
+    def close(self) -> None:
+        for fd, index in self.indexes.values():
+            index.close()
+            os.close(fd)
+        self.indexes.clear()
+        if self.mm is not None:
+            self.mm.close()
+        os.close(self.fd)
+
+
+class BlockStore:
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, path: str, segment_blocks: int=BLOCK_STORE_SEGMENT_BLOCKS,
+                 max_open_segments: int=BLOCK_STORE_MAX_OPEN_SEGMENTS,
+                 codecs: CacheCodecs=None) -> None:
+        self.path = path
+        self.segment_blocks = segment_blocks
+        self.max_open_segments = max_open_segments
+        self.codecs = codecs or CacheCodecs()
+        os.makedirs(path, exist_ok=True)
+        self._segments = OrderedDict()  # type: OrderedDict
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix='block-store')
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.corrupt = 0
+
+    def _segment(self, segment_num: int, create: bool) -> Optional[Segment]:
+        segment = self._segments.get(segment_num)
+        if segment is not None:
+            self._segments.move_to_end(segment_num)
+            return segment
+        path = os.path.join(self.path, f'{segment_num:06d}')
+        try:
+            fd = os.open(f'{path}.dat', os.O_RDWR | (os.O_CREAT if create else 0), 0o644)
+        except FileNotFoundError:
+            return None
+        segment = Segment(path, self.segment_blocks * INDEX_ENTRY.size, fd)
+        self._segments[segment_num] = segment
+        if len(self._segments) > self.max_open_segments:
+            _, evicted = self._segments.popitem(last=False)
+            evicted.close()
+        return segment
+
+    def _entry(self, key: CacheKey, create: bool=False):
+        parsed = block_key(key)
+        if parsed is None:
+            return None
+        shape, block_num = parsed
+        segment = self._segment(block_num // self.segment_blocks, create)
+        if segment is None:
+            return None
+        index = segment.index(shape, create)
+        if index is None:
+            return None
+        return segment, index, (block_num % self.segment_blocks) * INDEX_ENTRY.size
+
+    def _stored(self, key: CacheKey) -> bool:
+        entry = self._entry(key)
+        if entry is None:
+            return False
+        _, index, entry_offset = entry
+        return INDEX_ENTRY.unpack_from(index, entry_offset)[1] > 0
+
+    def gets(self, key: CacheKey) -> CacheResult:
+        entry = self._entry(key)
+        if entry is None:
+            if block_key(key) is not None:
+                self.misses += 1
+            return None
+        segment, index, entry_offset = entry
+        offset, length, checksum = INDEX_ENTRY.unpack_from(index, entry_offset)
+        data = segment.read(offset, length) if length else None
+        if data is None:
+            self.misses += 1
+            return None
+        if crc32(data) != checksum:
+            self.corrupt += 1
+            logger.warning('corrupt block store value', key=key, path=segment.path)
+            return None
+        self.hits += 1
+        return self.codecs.unpack(data)
+
+    def sets(self, key: CacheKey, value, expire_time: CacheTTLValue=None) -> None:
+        # only irreversible values, which never expire, are stored
+        if expire_time is not None:
+            return
+        entry = self._entry(key, create=True)
+        if entry is None:
+            return
+        segment, index, entry_offset = entry
+        if INDEX_ENTRY.unpack_from(index, entry_offset)[1]:
+            return
+        data = self.codecs.pack(value, key=key, expire_time=expire_time)
+        fcntl.flock(segment.fd, fcntl.LOCK_EX)
+        try:
+            # another worker may have stored it
+            if INDEX_ENTRY.unpack_from(index, entry_offset)[1]:
+                return
+            offset = segment.append(data)
+            INDEX_ENTRY.pack_into(index, entry_offset, offset, len(data), crc32(data))
+        finally:
+            fcntl.flock(segment.fd, fcntl.LOCK_UN)
+        self.stored += 1
+
+    def load(self, items: Iterable[Tuple[CacheKey, Any]]) -> int:
+        """store (key, value) pairs of irreversible blocks, returning how many were new"""
+        stored = self.stored
+        for key, value in items:
+            self.sets(key, value, expire_time=None)
+        return self.stored - stored
+
+    def mgets(self, keys: CacheKeys) -> CacheResults:
+        return [self.gets(key) for key in keys]
+
+    def set_manys(self, data: CachePairs, expire_time: CacheTTLValue=None) -> None:
+        for key, value in data.items():
+            self.sets(key, value, expire_time=expire_time)
+
+    def _ttls(self, keys: CacheKeys) -> List[Optional[float]]:
+        return [None if self._stored(key) else 0.0 for key in keys]
+
+    def _clear(self) -> None:
+        self._close_segments()
+        for name in os.listdir(self.path):
+            if name.endswith('.dat') or name.endswith('.idx'):
+                os.remove(os.path.join(self.path, name))
+
+    def _run(self, func, *args, **kwargs) -> asyncio.Future:
+        return asyncio.get_event_loop().run_in_executor(self._executor,
+                                                        partial(func, *args, **kwargs))
+
+    async def get(self, key: CacheKey) -> CacheResult:
+        if block_key(key) is None:
+            return None
+        return await self._run(self.gets, key)
+
+    async def mget(self, keys: CacheKeys) -> CacheResults:
+        if not any(block_key(key) for key in keys):
+            return [None] * len(keys)
+        return await self._run(self.mgets, keys)
+
+    async def ttls(self, keys: CacheKeys) -> List[Optional[float]]:
+        """stored values never expire, None for those, 0 for keys which aren't stored"""
+        return await self._run(self._ttls, keys)
+
+    async def set(self, key: CacheKey, value, expire_time: CacheTTLValue=None) -> NoReturn:
+        if expire_time is None and block_key(key) is not None:
+            await self._run(self.sets, key, value, expire_time=expire_time)
+
+    async def set_many(self, data: CachePairs, expire_time: CacheTTLValue=None) -> NoReturn:
+        if expire_time is None and any(block_key(key) for key in data):
+            await self._run(self.set_manys, data, expire_time=expire_time)
+
+    async def clear(self) -> NoReturn:
+        await self._run(self._clear)
+
+    def _close_segments(self) -> None:
+        while self._segments:
+            _, segment = self._segments.popitem()
+            segment.close()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        self._close_segments()
+
+    def to_dict(self) -> dict:
+        return {
+            'path': self.path,
+            'segment_blocks': self.segment_blocks,
+            'open_segments': len(self._segments),
+            'hits': self.hits,
+            'misses': self.misses,
+            'stored': self.stored,
+            'corrupt': self.corrupt
+        }
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded Memory Cache
+--------------------
+- A drop-in replacement for `SimplerMaxTTLMemoryCache` where get, set and eviction
+  are O(1) (expiry is O(log n)) instead of scanning every item on each set
+- Items expire after their ttl, capped at `max_ttl`. Expiry times are kept in a heap,
+  expired items are removed lazily on read and from the head of the heap on write
+- The cache is bounded by item count (`max_size`) and by the estimated size of its
+  values (`max_bytes`, 0 disables), evicting by policy:
+  - `lru`: least recently used
+  - `lfu`: least frequently used, ties broken by least recently used
+- hits, misses, evictions and expirations are counted for monitoring
+"""
+import heapq
+from collections import OrderedDict
+from collections import defaultdict
+from time import perf_counter
+from typing import Dict
+from typing import NoReturn
+
+import structlog
+import ujson
+
+from .max_ttl import CacheKey
+from .max_ttl import CacheKeys
+from .max_ttl import CachePairs
+from .max_ttl import CacheResult
+from .max_ttl import CacheResults
+from .max_ttl import CacheTTLValue
+from .max_ttl import CacheValue
+from .max_ttl import MEMORY_CACHE_MAX_TTL
+
+logger = structlog.get_logger(__name__)
+
+MEMORY_CACHE_MAX_SIZE = 20000
+MEMORY_CACHE_MAX_BYTES = 128 * 1024 * 1024
+MEMORY_CACHE_POLICY = 'lru'
+MEMORY_CACHE_POLICIES = ('lru', 'lfu')
+
+# rough per-item overhead of keys, entries and bookkeeping
+ITEM_OVERHEAD_BYTES = 200
+
+
+def estimate_size(value: CacheValue) -> int:
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, (dict, list)):
+        return len(ujson.dumps(value, ensure_ascii=False))
+    return 8
+
+
+class _Entry:
+    __slots__ = ('value', 'expires', 'size', 'hits')
+
+    def __init__(self, value: CacheValue, expires: float, size: int) -> None:
+        self.value = value
+        self.expires = expires
+        self.size = size
+        self.hits = 1
+
+
+class BoundedMemoryCache:
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, max_ttl: int=None, max_size: int=None, max_bytes: int=None,
+                 policy: str=None) -> None:
+        self._max_ttl = max_ttl or MEMORY_CACHE_MAX_TTL
+        self._max_size = max_size or MEMORY_CACHE_MAX_SIZE
+        self._max_bytes = MEMORY_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self._policy = policy or MEMORY_CACHE_POLICY
+        if self._policy not in MEMORY_CACHE_POLICIES:
+            raise ValueError(f'unknown memory cache policy: {self._policy}')
+        self._lfu = self._policy == 'lfu'
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._init_storage()
+
+    def _init_storage(self) -> None:
+        # recency order, least recently used first
+        self._cache = OrderedDict()  # type: OrderedDict
+        # lfu: hit count -> keys with that count in recency order
+        self._frequencies = defaultdict(OrderedDict)  # type: Dict[int, OrderedDict]
+        self._min_hits = 1
+        self._expiry_heap = []
+        self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def __contains__(self, key: CacheKey) -> bool:
+        return self._live_entry(key) is not None
+
+    @property
+    def bytes(self) -> int:
+        return self._bytes
+
+    def _live_entry(self, key: CacheKey):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= perf_counter():
+            self._remove(key)
+            self.expirations += 1
+            return None
+        return entry
+
+    def gets(self, key: CacheKey) -> CacheResult:
+        entry = self._live_entry(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touch(key, entry)
+        return entry.value
+
+    async def get(self, key: CacheKey) -> CacheResult:
+        return self.gets(key)
+
+    def mgets(self, keys: CacheKeys) -> CacheResults:
+        return [self.gets(k) for k in keys]
+
+    async def mget(self, keys: CacheKeys) -> CacheResults:
+        return [self.gets(k) for k in keys]
+
+    def sets(self, key: CacheKey, value: CacheValue, expire_time: CacheTTLValue) -> NoReturn:
+        if expire_time is None or expire_time > self._max_ttl:
+            expire_time = self._max_ttl
+        if key in self._cache:
+            self._remove(key)
+        if expire_time <= 0:
+            return
+        size = ITEM_OVERHEAD_BYTES
+        if self._max_bytes:
+            size += estimate_size(value)
+            if size > self._max_bytes:
+                return
+        # evict before inserting, or lfu would evict the new key with its single hit
+        self.prune(room=1, room_bytes=size)
+        expires = perf_counter() + expire_time
+        entry = _Entry(value, expires, size)
+        self._cache[key] = entry
+        self._bytes += size
+        if self._lfu:
+            self._frequencies[1][key] = None
+            self._min_hits = 1
+        heapq.heappush(self._expiry_heap, (expires, key))
+
+    async def set(self, key: CacheKey, value: CacheValue, expire_time: CacheTTLValue) -> NoReturn:
+        return self.sets(key, value, expire_time)
+
+    def set_manys(self, data: CachePairs, expire_time: CacheTTLValue) -> NoReturn:
+        for k, v in data.items():
+            self.sets(k, v, expire_time)
+
+    async def set_many(self, data: CachePairs, expire_time: CacheTTLValue) -> NoReturn:
+        return self.set_manys(data, expire_time)
+
+    def deletes(self, key: CacheKey) -> NoReturn:
+        if key in self._cache:
+            self._remove(key)
+
+    async def delete(self, key: CacheKey) -> NoReturn:
+        return self.deletes(key)
+
+    def prune(self, room: int=0, room_bytes: int=0) -> NoReturn:
+        """remove expired items from the head of the expiry heap, then evict until
+        within bounds with room for `room` more items of `room_bytes`"""
+        now = perf_counter()
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            expires, key = heapq.heappop(heap)
+            entry = self._cache.get(key)
+            # heap items for overwritten or deleted keys are stale
+            if entry is not None and entry.expires == expires:
+                self._remove(key)
+                self.expirations += 1
+        while self._cache and (len(self._cache) + room > self._max_size or
+                               (self._max_bytes and
+                                self._bytes + room_bytes > self._max_bytes)):
+            self._remove(self._victim())
+            self.evictions += 1
+        # stale heap items build up when long lived keys are overwritten
+        if len(heap) > 2 * len(self._cache) + 1024:
+            self._expiry_heap = [(entry.expires, key) for key, entry in self._cache.items()]
+            heapq.heapify(self._expiry_heap)
+
+    def clears(self) -> NoReturn:
+        self._init_storage()
+
+    async def clear(self) -> NoReturn:
+        return self.clears()
+
+    def _touch(self, key: CacheKey, entry: _Entry) -> None:
+        self._cache.move_to_end(key)
+        if self._lfu:
+            bucket = self._frequencies[entry.hits]
+            del bucket[key]
+            if not bucket:
+                del self._frequencies[entry.hits]
+                if self._min_hits == entry.hits:
+                    self._min_hits += 1
+            entry.hits += 1
+            self._frequencies[entry.hits][key] = None
+
+    def _victim(self) -> CacheKey:
+        if not self._lfu:
+            return next(iter(self._cache))
+        if self._min_hits not in self._frequencies:
+            self._min_hits = min(self._frequencies)
+        return next(iter(self._frequencies[self._min_hits]))
+
+    def _remove(self, key: CacheKey) -> None:
+        entry = self._cache.pop(key)
+        self._bytes -= entry.size
+        if self._lfu:
+            bucket = self._frequencies[entry.hits]
+            del bucket[key]
+            if not bucket:
+                del self._frequencies[entry.hits]
+
+    def to_dict(self) -> dict:
+        return {
+            'policy': self._policy,
+            'keys': len(self._cache),
+            'bytes': self._bytes,
+            'max_size': self._max_size,
+            'max_bytes': self._max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
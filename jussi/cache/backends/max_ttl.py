@@ -56,6 +56,15 @@ class SimplerMaxTTLMemoryCache:
     async def mget(self, keys: CacheKeys) -> CacheResults:
         return [self.gets(k) for k in keys]
 
+    def ttl(self, key: CacheKey) -> Optional[float]:
+        """seconds key has left, None if it isn't cached"""
+        if self.gets(key) is None:
+            return None
+        return self._cache[key][0] - perf_counter()
+
+    async def ttls(self, keys: CacheKeys) -> List[float]:
+        return [self.ttl(k) or 0.0 for k in keys]
+
     def sets(self, key: CacheKey, value: CacheValue, expire_time: CacheTTLValue) -> NoReturn:
         if expire_time is None or expire_time > self._max_ttl:
             expire_time = self._max_ttl
@@ -1,6 +1,4 @@
 # -*- coding: utf-8 -*-
-from zlib import compress
-from zlib import decompress
 from typing import Dict
 from typing import List
 from typing import NoReturn
@@ -8,9 +6,7 @@ from typing import Optional
 from typing import Tuple
 from typing import TypeVar
 
-
-from ujson import dumps
-from ujson import loads
+from ..codecs import CacheCodecs
 
 CacheTTLValue = TypeVar('CacheTTL', int, float, type(None))
 CacheKey = str
@@ -26,19 +22,17 @@ CacheResults = List[CacheResult]
 class Cache:
     """cache provides basic function"""
 
-    def __init__(self, client):
+    def __init__(self, client, codecs: CacheCodecs=None):
         self.client = client
+        self.codecs = codecs or CacheCodecs()
 
-    # pylint: disable=no-self-use
-    def _pack(self, value) -> bytes:
-        return compress(dumps(value, ensure_ascii=False).encode('utf8'))
+    def _pack(self, value, key: CacheKey=None, expire_time: CacheTTLValue=None) -> bytes:
+        return self.codecs.pack(value, key=key, expire_time=expire_time)
 
     def _unpack(self, value: bytes) -> CacheResult:
         if not value:
             return None
-        return loads(decompress(value))
-
-    # pylint: enable=no-self-use
+        return self.codecs.unpack(value)
 
     async def get(self, key: CacheKey) -> CacheResult:
         res = await self.client.get(key)
@@ -47,19 +41,30 @@ class Cache:
         return None
 
     async def set(self, key: str, value, expire_time: CacheTTLValue=None) -> NoReturn:
-        value = self._pack(value)
+        value = self._pack(value, key=key, expire_time=expire_time)
         await self.client.set(key, value, ex=expire_time)
 
     async def set_many(self, data: CachePairs, expire_time: CacheTTLValue=None) -> NoReturn:
         async with await self.client.pipeline() as pipeline:
             for key, value in data.items():
-                value = self._pack(value)
+                value = self._pack(value, key=key, expire_time=expire_time)
                 await pipeline.set(key, value, expire_time)
             return await pipeline.execute()
 
     async def mget(self, keys: CacheKeys) -> CacheResults:
         return [self._unpack(r) for r in await self.client.mget(keys)]
 
+    async def ttls(self, keys: CacheKeys) -> List[Optional[float]]:
+        """seconds each key has left, None if it never expires, 0 if it's gone"""
+        if not keys:
+            return []
+        # one round trip for all the keys
+        async with await self.client.pipeline() as pipeline:
+            for key in keys:
+                await pipeline.pttl(key)
+            pttls = await pipeline.execute()
+        return [None if pttl == -1 else max(pttl, 0) / 1000 for pttl in pttls]
+
     async def clear(self):
         return await self.client.clear()
 
@@ -94,8 +99,12 @@ class MockClient:
     async def mget(self, keys) -> CacheResults:
         return self.cache.mgets(keys)
 
+    async def pttl(self, key) -> int:
+        ttl = self.cache.ttl(key)
+        return -2 if ttl is None else int(ttl * 1000)
+
     async def pipeline(self):
-        return self
+        return MockPipeline(self)
 
     async def clear(self):
         self.cache.clears()
@@ -108,3 +117,29 @@ class MockClient:
 
     async def __aexit__(self, exc_type, exc, tb):
         pass
+
+
+class MockPipeline:
+    """queues the replies of a MockClient's commands, like a redis pipeline"""
+
+    def __init__(self, client):
+        self.client = client
+        self.replies = []
+
+    def __getattr__(self, name):
+        command = getattr(self.client, name)
+
+        async def queue(*args, **kwargs):
+            self.replies.append(await command(*args, **kwargs))
+            return self
+        return queue
+
+    async def execute(self):
+        replies, self.replies = self.replies, []
+        return replies
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Redis Read Replicas
+-------------------
+- Wraps the caches of several redis read replicas, so each read goes to one
+  replica, the one with the lowest EWMA of its read latency, instead of trying
+  the replicas one after another
+- Every `PROBE_INTERVAL`th read goes to the replica read least recently, so the
+  latency of replicas which aren't picked stays current
+- Hedged reads: when a read takes longer than the `hedge_percentile` of the
+  replica's recent read latencies, the same read is sent to the next best
+  replica, and the first answer with a hit wins
+- A read which takes longer than `timeout`, ie, `cache_read_timeout`, is a miss.
+  A replica is ejected for `eject_seconds` after `eject_after` reads in a row
+  time out or fail, and is read again with a fresh EWMA afterwards. If every
+  replica is ejected, the one ejected first is read
+- Anything else, eg, the connection pool for `/monitor`, is the first replica's
+"""
+import asyncio
+from collections import deque
+from time import monotonic
+from time import perf_counter
+from typing import Any
+from typing import List
+from typing import Optional
+
+import structlog
+
+from .redis import CacheKey
+from .redis import CacheKeys
+from .redis import CacheResult
+from .redis import CacheResults
+
+logger = structlog.get_logger(__name__)
+
+EWMA_ALPHA = 0.2
+LATENCY_WINDOW = 100
+# fewer latencies than this and reads aren't hedged
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 0.001
+PROBE_INTERVAL = 100
+
+
+class Replica:
+    __slots__ = ('cache', 'name', 'ewma', 'latencies', 'last_read', 'failures',
+                 'ejected_until', 'reads', 'timeouts', 'errors', 'ejections')
+
+    def __init__(self, cache, name: str) -> None:
+        self.cache = cache
+        self.name = name
+        self.ewma = None  # type: Optional[float]
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.last_read = 0.0
+        # reads in a row which timed out or failed
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.reads = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.ejections = 0
+
+    def observe(self, seconds: float) -> None:
+        if self.ewma is None:
+            self.ewma = seconds
+        else:
+            self.ewma = EWMA_ALPHA * seconds + (1 - EWMA_ALPHA) * self.ewma
+        self.latencies.append(seconds)
+        self.failures = 0
+
+    def hedge_delay(self, percentile: float) -> Optional[float]:
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        return max(HEDGE_MIN_DELAY, latencies[index])
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'ewma_ms': round(self.ewma * 1000, 3) if self.ewma is not None else None,
+            'reads': self.reads,
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+            'ejections': self.ejections,
+            'ejected': self.ejected_until > monotonic()
+        }
+
+
+class ReplicaSet:
+    # pylint: disable=too-many-arguments
+    def __init__(self, caches: List[Any], names: List[str]=None, timeout: float=1.0,
+                 hedge_percentile: float=95.0, eject_after: int=5,
+                 eject_seconds: float=10.0) -> None:
+        names = names or [str(i) for i in range(len(caches))]
+        self.replicas = [Replica(cache, name) for cache, name in zip(caches, names)]
+        self.timeout = timeout
+        # 0 disables hedged reads
+        self.hedge_percentile = hedge_percentile
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.reads = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def __getattr__(self, name):
+        return getattr(self.replicas[0].cache, name)
+
+    def ranked(self) -> List[Replica]:
+        """available replicas, best first"""
+        self.reads += 1
+        now = monotonic()
+        available = []
+        for replica in self.replicas:
+            if replica.ejected_until:
+                if now < replica.ejected_until:
+                    continue
+                logger.info('reinstating redis read replica', replica=replica.name)
+                replica.ejected_until = 0.0
+                replica.failures = 0
+                replica.ewma = None
+            available.append(replica)
+        if not available:
+            return [min(self.replicas, key=lambda r: r.ejected_until)]
+        if self.reads % PROBE_INTERVAL == 0:
+            return sorted(available, key=lambda r: r.last_read)
+        # unmeasured replicas are read first, to measure them
+        return sorted(available, key=lambda r: r.ewma or 0.0)
+
+    def _failed(self, replica: Replica) -> None:
+        replica.failures += 1
+        if replica.failures >= self.eject_after and not replica.ejected_until:
+            replica.ejected_until = monotonic() + self.eject_seconds
+            replica.ejections += 1
+            logger.warning('ejecting redis read replica', replica=replica.name,
+                           failures=replica.failures, seconds=self.eject_seconds)
+
+    async def _read(self, replica: Replica, method: str, arg, miss):
+        replica.reads += 1
+        replica.last_read = monotonic()
+        start = perf_counter()
+        try:
+            result = await asyncio.wait_for(getattr(replica.cache, method)(arg),
+                                            timeout=self.timeout)
+        except asyncio.TimeoutError:
+            replica.timeouts += 1
+            self._failed(replica)
+            logger.debug('redis read replica timeout', replica=replica.name)
+            return miss
+        except asyncio.CancelledError:
+            # eg, the request's cache read timeout
+            if perf_counter() - start >= self.timeout:
+                replica.timeouts += 1
+                self._failed(replica)
+            raise
+        except Exception:
+            replica.errors += 1
+            self._failed(replica)
+            raise
+        replica.observe(perf_counter() - start)
+        return result
+
+    async def _hedged_read(self, method: str, arg, miss):
+        ranked = self.ranked()
+        primary = ranked[0]
+        delay = None
+        if self.hedge_percentile and len(ranked) > 1:
+            delay = primary.hedge_delay(self.hedge_percentile)
+        if delay is None:
+            return await self._read(primary, method, arg, miss)
+
+        first = asyncio.ensure_future(self._read(primary, method, arg, miss))
+        try:
+            done, _ = await asyncio.wait([first], timeout=delay)
+        except asyncio.CancelledError:
+            first.cancel()
+            raise
+        if done:
+            return first.result()
+        self.hedges += 1
+        second = asyncio.ensure_future(self._read(ranked[1], method, arg, miss))
+        pending = {first, second}
+        answered = False
+        result = miss
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is not None:
+                        error = future.exception()
+                        continue
+                    answered = True
+                    result = future.result()
+                    if result != miss:
+                        if future is second:
+                            self.hedge_wins += 1
+                        return result
+        finally:
+            for future in pending:
+                future.cancel()
+        if not answered:
+            raise error
+        return result
+
+    async def get(self, key: CacheKey) -> CacheResult:
+        return await self._hedged_read('get', key, None)
+
+    async def mget(self, keys: CacheKeys) -> CacheResults:
+        if not keys:
+            return []
+        return await self._hedged_read('mget', keys, [None] * len(keys))
+
+    async def close(self) -> None:
+        for replica in self.replicas:
+            result = replica.cache.close()
+            if asyncio.iscoroutine(result):
+                await result
+
+    def to_dict(self) -> dict:
+        return {
+            'reads': self.reads,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'replicas': [replica.to_dict() for replica in self.replicas]
+        }
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Shared Memory Cache
+-------------------
+- A cache tier shared by every jussi worker on a host, above redis, so a hot value
+  read from redis or upstream is stored once per host instead of once per worker
+- Values are stored in an mmap-ed file (by default in /dev/shm), as a hash table of
+  fixed size slots in a few size classes (slabs), a value goes in the smallest
+  class it fits in, and values too big for the largest class aren't stored
+- Each key maps to one slot per size class, a new value overwrites whatever was in
+  its slot, so there is no eviction bookkeeping and the table never fills up
+- Keys are stored as 16 byte blake2b digests
+- Reads take no locks: each slot has a sequence number which writers make odd while
+  writing and even again when done (a seqlock), and a read that overlaps a write is
+  retried. Writers exclude each other with striped fcntl byte range locks
+- Expiry times are wall clock times, so they mean the same thing in every worker
+- The first worker to open the file initializes it, under flock, writing its header
+  last. A file with a valid header is never truncated or reinitialized, as other
+  workers may have it mapped: if its layout differs (eg, after a config change), the
+  file's layout is used until the file is removed, eg, by a reboot
+"""
+import fcntl
+import mmap
+import os
+import struct
+from hashlib import blake2b
+from time import time
+from typing import List
+from typing import NamedTuple
+from typing import NoReturn
+from typing import Optional
+from typing import Tuple
+
+import structlog
+
+from ..codecs import CacheCodecs
+from .redis import CacheKey
+from .redis import CacheKeys
+from .redis import CachePairs
+from .redis import CacheResult
+from .redis import CacheResults
+from .redis import CacheTTLValue
+
+logger = structlog.get_logger(__name__)
+
+SHARED_MEMORY_CACHE_PATH = '/dev/shm/jussi-cache'
+SHARED_MEMORY_CACHE_SLOT_SIZES = (1024, 4096, 16384, 65536)
+SHARED_MEMORY_CACHE_LOCK_STRIPES = 64
+
+MAGIC = b'JUSSISHM'
+VERSION = 1
+# magic, version, file size, number of size classes
+HEADER = struct.Struct('<8sIQI')
+HEADER_SIZE = 4096
+# seq, key digest, expiry time (0 never expires), value length
+SLOT_HEADER = struct.Struct('<I16sdI')
+SEQ = struct.Struct('<I')
+EMPTY_DIGEST = bytes(16)
+READ_RETRIES = 3
+
+
+class SlotClass(NamedTuple):
+    slot_size: int
+    slots: int
+    offset: int
+
+
+def key_digest(key: CacheKey) -> Tuple[bytes, int]:
+    digest = blake2b(key.encode(), digest_size=16).digest()
+    return digest, int.from_bytes(digest[:8], 'little')
+
+
+def layout(size: int, slot_sizes: Tuple[int, ...]) -> List[SlotClass]:
+    """split size bytes evenly between the slot size classes"""
+    share = (size - HEADER_SIZE) // len(slot_sizes)
+    classes = []
+    offset = HEADER_SIZE
+    for slot_size in sorted(slot_sizes):
+        slots = share // slot_size
+        if slots < 1:
+            raise ValueError(f'shared memory cache size {size} is too small '
+                             f'for slots of {slot_size} bytes')
+        classes.append(SlotClass(slot_size, slots, offset))
+        offset += slots * slot_size
+    return classes
+
+
+class SharedMemoryCache:
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, size: int, path: str=SHARED_MEMORY_CACHE_PATH,
+                 slot_sizes: Tuple[int, ...]=SHARED_MEMORY_CACHE_SLOT_SIZES,
+                 lock_stripes: int=SHARED_MEMORY_CACHE_LOCK_STRIPES,
+                 codecs: CacheCodecs=None) -> None:
+        self.path = path
+        self.size = size
+        self.codecs = codecs or CacheCodecs()
+        self._classes = layout(size, slot_sizes)
+        self._lock_stripes = lock_stripes
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._init_file()
+        self._mm = mmap.mmap(self._fd, self.size)
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.too_large = 0
+
+    def _header(self) -> bytes:
+        return HEADER.pack(MAGIC, VERSION, self.size, len(self._classes)) + \
+            b''.join(struct.pack('<Q', c.slot_size) for c in self._classes)
+
+    def _file_layout(self) -> Optional[Tuple[int, Tuple[int, ...]]]:
+        """the size and slot sizes in the file's header, None if it has no valid header"""
+        data = os.pread(self._fd, HEADER_SIZE, 0)
+        if len(data) < HEADER.size:
+            return None
+        magic, version, size, count = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION or size != os.fstat(self._fd).st_size or \
+                not 0 < count <= (len(data) - HEADER.size) // 8:
+            return None
+        slot_sizes = struct.unpack_from(f'<{count}Q', data, HEADER.size)
+        try:
+            layout(size, slot_sizes)
+        except ValueError:
+            return None
+        return size, slot_sizes
+
+    def _init_file(self) -> None:
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            file_layout = self._file_layout()
+            if file_layout is None:
+                logger.info('creating shared memory cache', path=self.path, size=self.size)
+                if os.fstat(self._fd).st_size:
+                    # not a cache, or one of another version
+                    os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, self.size)
+                # the header goes last, so a file with a valid header is initialized
+                os.pwrite(self._fd, self._header(), 0)
+                return
+            size, slot_sizes = file_layout
+            if size != self.size or slot_sizes != tuple(c.slot_size for c in self._classes):
+                # other workers have it mapped, so it's used as it is
+                logger.warning('using the layout of the existing shared memory cache',
+                               path=self.path, size=size, slot_sizes=slot_sizes)
+                self.size = size
+                self._classes = layout(size, slot_sizes)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _slot(self, slot_class: SlotClass, key_hash: int) -> int:
+        return slot_class.offset + (key_hash % slot_class.slots) * slot_class.slot_size
+
+    def _lock(self, offset: int, operation: int) -> None:
+        # byte range locks past the end of the file, one per stripe
+        stripe = (offset // 64) % self._lock_stripes
+        fcntl.lockf(self._fd, operation, 1, self.size + stripe)
+
+    def _read(self, digest: bytes, key_hash: int) -> Optional[bytes]:
+        mm = self._mm
+        now = time()
+        for slot_class in self._classes:
+            offset = self._slot(slot_class, key_hash)
+            for _ in range(READ_RETRIES):
+                seq, slot_digest, expires, length = SLOT_HEADER.unpack_from(mm, offset)
+                if seq & 1:
+                    # being written
+                    continue
+                if slot_digest != digest or (expires and expires < now):
+                    break
+                start = offset + SLOT_HEADER.size
+                value = mm[start:start + length]
+                if SEQ.unpack_from(mm, offset)[0] == seq:
+                    return value
+        return None
+
+    def _expires(self, digest: bytes, key_hash: int) -> Optional[float]:
+        """the expiry time of a key's value, 0 if it never expires, None if it's not stored"""
+        now = time()
+        for slot_class in self._classes:
+            seq, slot_digest, expires, _ = SLOT_HEADER.unpack_from(
+                self._mm, self._slot(slot_class, key_hash))
+            if not seq & 1 and slot_digest == digest and not (expires and expires < now):
+                return expires
+        return None
+
+    def _write_slot(self, offset: int, digest: bytes, expires: float, value: bytes) -> None:
+        mm = self._mm
+        self._lock(offset, fcntl.LOCK_EX)
+        try:
+            seq = SEQ.unpack_from(mm, offset)[0]
+            SEQ.pack_into(mm, offset, (seq + 1) & 0xFFFFFFFF)
+            start = offset + SLOT_HEADER.size
+            mm[start:start + len(value)] = value
+            SLOT_HEADER.pack_into(mm, offset, (seq + 1) & 0xFFFFFFFF, digest, expires,
+                                  len(value))
+            SEQ.pack_into(mm, offset, (seq + 2) & 0xFFFFFFFF)
+        finally:
+            self._lock(offset, fcntl.LOCK_UN)
+
+    def _write(self, key: CacheKey, value: bytes, expires: float) -> None:
+        digest, key_hash = key_digest(key)
+        stored = False
+        for slot_class in self._classes:
+            offset = self._slot(slot_class, key_hash)
+            if not stored and len(value) + SLOT_HEADER.size <= slot_class.slot_size:
+                self._write_slot(offset, digest, expires, value)
+                stored = True
+            elif SLOT_HEADER.unpack_from(self._mm, offset)[1] == digest:
+                # drop a stale value for this key from another size class
+                self._write_slot(offset, EMPTY_DIGEST, 0.0, b'')
+        if stored:
+            self.stored += 1
+        else:
+            self.too_large += 1
+
+    def gets(self, key: CacheKey) -> CacheResult:
+        value = self._read(*key_digest(key))
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.codecs.unpack(value)
+
+    def sets(self, key: CacheKey, value, expire_time: CacheTTLValue=None) -> None:
+        if expire_time is None:
+            expires = 0.0
+        elif expire_time > 0:
+            expires = time() + expire_time
+        else:
+            return
+        self._write(key, self.codecs.pack(value, key=key, expire_time=expire_time), expires)
+
+    async def get(self, key: CacheKey) -> CacheResult:
+        return self.gets(key)
+
+    async def mget(self, keys: CacheKeys) -> CacheResults:
+        return [self.gets(key) for key in keys]
+
+    async def ttls(self, keys: CacheKeys) -> List[Optional[float]]:
+        """seconds each key has left, None if it never expires, 0 if it's gone"""
+        now = time()
+        ttls = []
+        for key in keys:
+            expires = self._expires(*key_digest(key))
+            if expires is None:
+                ttls.append(0.0)
+            else:
+                ttls.append(max(expires - now, 0.0) if expires else None)
+        return ttls
+
+    async def set(self, key: CacheKey, value, expire_time: CacheTTLValue=None) -> NoReturn:
+        self.sets(key, value, expire_time=expire_time)
+
+    async def set_many(self, data: CachePairs, expire_time: CacheTTLValue=None) -> NoReturn:
+        for key, value in data.items():
+            self.sets(key, value, expire_time=expire_time)
+
+    async def clear(self) -> NoReturn:
+        for slot_class in self._classes:
+            for i in range(slot_class.slots):
+                offset = slot_class.offset + i * slot_class.slot_size
+                if SLOT_HEADER.unpack_from(self._mm, offset)[1] != EMPTY_DIGEST:
+                    self._write_slot(offset, EMPTY_DIGEST, 0.0, b'')
+
+    def close(self) -> None:
+        self._mm.close()
+        os.close(self._fd)
+
+    def to_dict(self) -> dict:
+        return {
+            'path': self.path,
+            'size': self.size,
+            'slots': {c.slot_size: c.slots for c in self._classes},
+            'hits': self.hits,
+            'misses': self.misses,
+            'stored': self.stored,
+            'too_large': self.too_large
+        }
@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 import asyncio
 from operator import itemgetter
+from time import perf_counter
+from time import time
 from typing import Any
+from typing import Awaitable
+from typing import Callable
 from typing import Dict
+from typing import Iterable
 from typing import List
 from typing import NoReturn
 from typing import Optional
@@ -11,6 +16,7 @@ from typing import TypeVar
 
 import cytoolz
 import structlog
+import ujson
 
 from jussi.errors import JussiInteralError
 from jussi.validators import is_get_block_request
@@ -24,12 +30,26 @@ from ..typedefs import SingleJrpcRequest
 from ..typedefs import SingleJrpcResponse
 from ..validators import is_valid_non_error_jussi_response
 from ..validators import is_valid_non_error_single_jsonrpc_response
-from .backends.max_ttl import SimplerMaxTTLMemoryCache
+from .backends.block_store import BlockStore
+from .backends.lru import BoundedMemoryCache
+from .tiers import Admission
+from .tiers import SpeedTier
+from .tiers import TierStats
+from .tiers import WriteBehind
 from .ttl import TTL
+from .utils import FRESH_UNTIL
+from .utils import NEGATIVE
+from .utils import NegativeResponse
+from .utils import StaleResponse
+from .utils import encode_cached_result
 from .utils import irreversible_ttl
+from .utils import is_negative
 from .utils import jsonrpc_cache_key
 from .utils import merge_cached_response
 from .utils import merge_cached_responses
+from .utils import merge_encoded_cached_response
+from .utils import merge_negative_cached_response
+from .utils import stale_age
 
 logger = structlog.getLogger(__name__)
 
@@ -52,20 +72,37 @@ class UncacheableResponse(JussiInteralError):
     message = 'Uncacheable response'
 
 
-SLOW_TIER = 1
-FAST_TIER = 2
-
-
 class CacheGroup:
     # pylint: disable=unused-argument, too-many-arguments, no-else-return
-    def __init__(self, caches: List[Any]) -> None:
+    def __init__(self, caches: List[Any], memory_cache: Any=None,
+                 encoded_memory_cache: bool=False, negative_ttl: float=0,
+                 error_ttl: float=0, error_codes: Iterable[int]=(),
+                 promote_min_hits: int=0, promote_ttl: float=1.0,
+                 write_behind: bool=False, write_behind_max_pending: int=1000) -> None:
         self._cache_group_items = caches
-        self._memory_cache = SimplerMaxTTLMemoryCache()
+        self._memory_cache = memory_cache if memory_cache is not None else BoundedMemoryCache()
+        # store serialized jsonrpc results in the memory cache, so that memory cache
+        # hits are returned as bytes without re-serializing the result
+        self._encoded_memory_cache = encoded_memory_cache
         self._read_cache_items = []
         self._read_caches = []
         self._write_cache_items = []
         self._write_caches = []
         self._all_caches = [cache_item.cache for cache_item in self._cache_group_items]
+        # keys of stale responses being refreshed
+        self._revalidating = set()
+        # seconds null results and errors with error_codes are cached, 0 disables
+        self._negative_ttl = negative_ttl
+        self._error_ttl = error_ttl
+        self._error_codes = frozenset(error_codes)
+        # values read from a tier are copied into faster tiers once admitted,
+        # 0 disables promotion
+        self._admission = Admission(promote_min_hits) if promote_min_hits > 0 else None
+        self._promote_ttl = promote_ttl
+        # promotions run in the background, so reads never wait for them
+        self._promotions = WriteBehind(write_behind_max_pending) if self._admission else None
+        # writes to SLOW tiers aren't awaited when write_behind is set
+        self._write_behind = WriteBehind(write_behind_max_pending) if write_behind else None
 
         self._read_cache_items = list(
             sorted(
@@ -85,22 +122,41 @@ class CacheGroup:
                 reverse=True))
         self._write_caches = [item.cache for item in self._write_cache_items]
 
-        if self._read_caches == [] and len(self._write_caches) > 0:
-            logger.info('setting single write cache as read/write')
-            self._read_caches = self._write_caches
+        # a write cache is also read from unless there's a read cache of its speed
+        # tier, eg, the redis master when there are no read replicas
+        read_tiers = {item.speed_tier for item in self._read_cache_items}
+        read_write_items = [item for item in self._write_cache_items
+                            if item.speed_tier not in read_tiers]
+        if read_write_items:
+            logger.info('setting write caches as read/write', items=read_write_items)
+            self._read_cache_items = list(sorted(self._read_cache_items + read_write_items,
+                                                 key=lambda i: i.speed_tier,
+                                                 reverse=True))
+            self._read_caches = [item.cache for item in self._read_cache_items]
+        self._read_stats = [TierStats(item) for item in self._read_cache_items]
+
+        self._write_through_caches = [item.cache for item in self._write_cache_items
+                                      if not write_behind or item.speed_tier > SpeedTier.SLOW]
+        self._write_behind_caches = [item.cache for item in self._write_cache_items
+                                     if write_behind and item.speed_tier <= SpeedTier.SLOW]
 
         logger.info('CacheGroup configured',
                     items=self._cache_group_items,
                     read_items=self._read_cache_items,
                     write_items=self._write_cache_items,
                     read_caches=self._read_caches,
-                    write_caches=self._write_caches)
+                    write_caches=self._write_caches,
+                    write_behind_caches=self._write_behind_caches)
 
     async def get(self, key: CacheKey) -> CacheResult:
         # no memory cache read here for optimization, it has already happened
-        for cache in self._read_caches:
+        for i, cache in enumerate(self._read_caches):
+            start = perf_counter()
             result = await cache.get(key)
-            if result is not None:
+            hit = result is not None
+            self._read_stats[i].observe(hit, not hit, perf_counter() - start)
+            if hit:
+                self.promote(i, {key: result})
                 return result
 
     async def mget(self, keys: CacheKeys) -> CacheResults:
@@ -115,32 +171,83 @@ class CacheGroup:
             return results
 
         # read from one cache at a time
-        for cache in self._read_caches:
+        for i, cache in enumerate(self._read_caches):
             missing = [
                 key for key, response in zip(
                     keys, results) if not response]
+            start = perf_counter()
             cache_results = await cache.mget(missing)
+            hits = {key: result for key, result in zip(missing, cache_results)
+                    if result is not None}
+            self._read_stats[i].observe(len(hits), len(missing) - len(hits),
+                                        perf_counter() - start)
+            if hits:
+                self.promote(i, hits)
             cache_iter = iter(cache_results)
             results = [existing or next(cache_iter) for existing in results]
             if all(results):
                 return results
         return results
 
-    async def set(self, key: CacheKey, value: CacheValue, expire_time: CacheTTL) -> NoReturn:
+    def promote(self, tier_index: int, hits: CachePairs) -> None:
+        """copy values read from a tier into the faster write tiers and memory cache,
+        as they are, for at most promote_ttl seconds and no longer than they have left"""
+        if self._admission is None or not hasattr(self._read_caches[tier_index], 'ttls'):
+            return
+        admitted = {key: value for key, value in hits.items()
+                    if self._admission.admit(key)}
+        if admitted:
+            self._promotions.submit(self._promote(tier_index, admitted))
+
+    async def _promote(self, tier_index: int, admitted: CachePairs) -> None:
+        cache = self._read_caches[tier_index]
+        speed_tier = self._read_cache_items[tier_index].speed_tier
+        # the block store only takes values which never expire, from the upstream
+        faster_caches = [item.cache for item in self._write_cache_items
+                         if item.speed_tier > speed_tier and not isinstance(item.cache, BlockStore)]
+        keys = list(admitted)
+        ttls = await cache.ttls(keys)
+        futures = []
+        for key, remaining in zip(keys, ttls):
+            expire_time = self._promote_ttl if remaining is None else \
+                min(self._promote_ttl, remaining)
+            if expire_time <= 0:
+                continue
+            self._read_stats[tier_index].promotions += 1
+            # promoted values stay parsed, with any stale marker, and are validated
+            # against their request when read
+            self._memory_cache.sets(key, admitted[key], expire_time=expire_time)
+            futures.extend(faster_cache.set(key, admitted[key], expire_time=expire_time)
+                           for faster_cache in faster_caches)
+        if futures:
+            await asyncio.gather(*futures)
+
+    async def set(self, key: CacheKey, value: CacheValue, expire_time: CacheTTL,
+                  memory_value: CacheValue=None) -> NoReturn:
         if isinstance(expire_time, TTL):
             expire_time = expire_time.value
-        self._memory_cache.sets(key, value, expire_time=expire_time)
+        if memory_value is None:
+            memory_value = value
+        self._memory_cache.sets(key, memory_value, expire_time=expire_time)
+        for cache in self._write_behind_caches:
+            self._write_behind.submit(cache.set(key, value, expire_time=expire_time))
         await asyncio.gather(*[cache.set(key, value, expire_time=expire_time) for cache
-                               in self._write_caches], return_exceptions=False)
+                               in self._write_through_caches], return_exceptions=False)
 
-    async def set_many(self, data: CachePairs, expire_time: CacheTTL) -> NoReturn:
+    async def set_many(self, data: CachePairs, expire_time: CacheTTL,
+                       memory_data: CachePairs=None) -> NoReturn:
         # pylint: disable=no-member
         # set memory cache
         if isinstance(expire_time, TTL):
             expire_time = expire_time.value
-        self._memory_cache.set_manys(data, expire_time)
-
-        futures = [cache.set_many(data, expire_time=expire_time) for cache in self._write_caches]
+        if memory_data is None:
+            memory_data = data
+        self._memory_cache.set_manys(memory_data, expire_time)
+
+        for cache in self._write_behind_caches:
+            self._write_behind.submit(cache.set_many(data, expire_time=expire_time))
+        futures = [cache.set_many(data, expire_time=expire_time)
+                   for cache in self._write_through_caches]
         if futures:
             await asyncio.gather(*futures, return_exceptions=False)
 
@@ -149,8 +256,21 @@ class CacheGroup:
         await asyncio.gather(*[cache.clear() for cache in self._write_caches])
 
     async def close(self) -> NoReturn:
+        if self._write_behind is not None:
+            await self._write_behind.flush()
+        if self._promotions is not None:
+            await self._promotions.flush()
         for cache in self._all_caches:
-            cache.close()
+            result = cache.close()
+            if asyncio.iscoroutine(result):
+                await result
+
+    def tier_stats(self) -> dict:
+        return {
+            'read_tiers': [stats.to_dict() for stats in self._read_stats],
+            'write_behind': self._write_behind.to_dict() if self._write_behind else None,
+            'promotions': self._promotions.to_dict() if self._promotions else None
+        }
 
     # jsonrpc related methods
     #
@@ -163,14 +283,19 @@ class CacheGroup:
 
         # try sync memory cache get first
         cached_response = self._memory_cache.gets(key)
-        if cached_response is not None:
-            return merge_cached_response(request, cached_response)
-
-        # try async redis cache get
-        cached_response = await self.get(key)
-        if cached_response is not None:
-            return merge_cached_response(request, cached_response)
-        return None
+        if isinstance(cached_response, bytes):
+            return merge_encoded_cached_response(request, cached_response)
+        if cached_response is None:
+            # try async redis cache get
+            cached_response = await self.get(key)
+        if cached_response is None:
+            return None
+        if is_negative(cached_response):
+            return NegativeResponse(merge_negative_cached_response(request, cached_response))
+        age = stale_age(cached_response)
+        if age is not None:
+            return StaleResponse(merge_cached_response(request, cached_response), age)
+        return merge_cached_response(request, cached_response)
 
     async def get_batch_jsonrpc_responses(self,
                                           requests: BatchJrpcRequest) -> \
@@ -178,8 +303,29 @@ class CacheGroup:
         keys = [jsonrpc_cache_key(request) for request in requests]
         # try async mget which include sync memory-cache mget
         cached_responses = await self.mget(keys)
+        # stale and negative responses are only served to single requests
+        cached_responses = [None if is_negative(r) or stale_age(r) is not None else r
+                            for r in cached_responses]
+        if any(isinstance(r, bytes) for r in cached_responses):
+            return self.merge_encoded_batch_responses(requests, cached_responses)
         return merge_cached_responses(requests, cached_responses)
 
+    @staticmethod
+    def merge_encoded_batch_responses(requests: BatchJrpcRequest,
+                                      cached_responses: List[Any]) -> Optional[bytes]:
+        """assemble a complete batch response from encoded and parsed cached results,
+        or None if any response is missing or invalid"""
+        parts = []
+        for request, cached_response in zip(requests, cached_responses):
+            if isinstance(cached_response, bytes):
+                parts.append(merge_encoded_cached_response(request, cached_response))
+                continue
+            response = merge_cached_response(request, cached_response)
+            if not is_valid_non_error_jussi_response(request, response):
+                return None
+            parts.append(ujson.dumps(response, ensure_ascii=False).encode())
+        return b''.join((b'[', b','.join(parts), b']'))
+
     async def cache_single_jsonrpc_response(self,
                                             request: SingleJrpcRequest = None,
                                             response: SingleJrpcResponse = None,
@@ -188,6 +334,10 @@ class CacheGroup:
                                             ) -> None:
         key = jsonrpc_cache_key(request)
         ttl = ttl or request.upstream.ttl
+        negative_ttl = self.negative_ttl(request, response, ttl)
+        if negative_ttl:
+            self.cache_negative_response(key, response, negative_ttl)
+            return
         if ttl == TTL.EXPIRE_IF_REVERSIBLE:
             last_irreversible_block_num = last_irreversible_block_num or \
                 self._memory_cache.gets('last_irreversible_block_num') or \
@@ -199,7 +349,55 @@ class CacheGroup:
         elif ttl == TTL.NO_CACHE:
             return
         value = self.prepare_response_for_cache(request, response)
-        await self.set(key, value, expire_time=ttl)
+        expire_time = ttl.value if isinstance(ttl, TTL) else ttl
+        stale_time = max(request.upstream.stale_ttl, request.upstream.stale_if_error)
+        if stale_time and expire_time and expire_time > 0:
+            # keep the response past its ttl, marked with when it went stale
+            value = dict(value, **{FRESH_UNTIL: time() + expire_time})
+            await self.set(key, value, expire_time=expire_time + stale_time,
+                           memory_value=value)
+            return
+        await self.set(key, value, expire_time=ttl,
+                       memory_value=self.memory_cache_value(value, request))
+
+    async def revalidate(self, key: CacheKey, refresh: Callable[[], Awaitable]) -> None:
+        """refresh a stale response, unless it's already being refreshed"""
+        if key in self._revalidating:
+            return
+        self._revalidating.add(key)
+        try:
+            await refresh()
+        finally:
+            self._revalidating.discard(key)
+
+    def negative_ttl(self, request: SingleJrpcRequest, response: SingleJrpcResponse,
+                     ttl: CacheTTL) -> float:
+        """seconds a null result or deterministic error may be cached, 0 if it may not"""
+        if ttl == TTL.NO_CACHE or not isinstance(response, dict):
+            return 0
+        error = response.get('error')
+        if isinstance(error, dict):
+            return self._error_ttl if error.get('code') in self._error_codes else 0
+        if 'result' not in response:
+            return 0
+        # other null results are cached with their method's ttl
+        if ttl != TTL.EXPIRE_IF_REVERSIBLE and not is_get_block_request(request):
+            return 0
+        result = response['result']
+        # appbase returns an empty object for blocks which don't exist yet
+        if result is None or result == {}:
+            return self._negative_ttl
+        return 0
+
+    def cache_negative_response(self, key: CacheKey, response: SingleJrpcResponse,
+                                expire_time: float) -> None:
+        # only the memory cache takes sub-second ttls, and a negative response is
+        # cheap to ask the upstream for again
+        if 'error' in response:
+            value = {NEGATIVE: True, 'error': response['error']}
+        else:
+            value = {NEGATIVE: True, 'result': response['result']}
+        self._memory_cache.sets(key, value, expire_time=expire_time)
 
     async def cache_batch_jsonrpc_response(self,
                                            requests: BatchJrpcRequest = None,
@@ -222,19 +420,40 @@ class CacheGroup:
                 if ttl == TTL.EXPIRE_IF_REVERSIBLE:
                     ttl = irreversible_ttl(responses[i], last_irreversible_block_num)
                 new_ttls.append(ttl)
-            triplets = filter(lambda p: p[0] != TTL.NO_CACHE, zip(ttls, requests, responses))
+            triplets = filter(lambda p: p[0] != TTL.NO_CACHE, zip(new_ttls, requests, responses))
 
         futures = []
         # pylint: disable=no-member
         for ttl, grouped_triplets in cytoolz.groupby(itemgetter(0), triplets).items():
             if isinstance(ttl, TTL):
                 ttl = ttl.value
-            pairs = {jsonrpc_cache_key(req): resp for ttl, req, resp in grouped_triplets}
-            self._memory_cache.set_manys(pairs, expire_time=ttl)
-            futures.append(self.set_many(pairs, expire_time=ttl))
+            pairs = dict()
+            memory_pairs = dict()
+            for _, req, resp in grouped_triplets:
+                try:
+                    value = self.prepare_response_for_cache(req, resp)
+                except UncacheableResponse as e:
+                    logger.info('not caching batch response', reason=e)
+                    continue
+                key = jsonrpc_cache_key(req)
+                pairs[key] = value
+                memory_pairs[key] = self.memory_cache_value(value, req)
+            if not pairs:
+                continue
+            futures.append(self.set_many(pairs, expire_time=ttl, memory_data=memory_pairs))
         if futures:
             await asyncio.gather(*futures, return_exceptions=True)
 
+    def memory_cache_value(self, response: SingleJrpcResponse,
+                           request: SingleJrpcRequest) -> Any:
+        # encoded results are served without validation, so only results which are
+        # valid for their request are encoded, anything else stays parsed so it is
+        # still validated when read
+        if self._encoded_memory_cache and \
+                is_valid_non_error_jussi_response(request, response):
+            return encode_cached_result(response)
+        return response
+
     # pylint: disable=no-self-use
     def prepare_response_for_cache(self,
                                    request: SingleJrpcRequest,
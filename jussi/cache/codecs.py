@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Cache Value Codecs
+------------------
+- Values stored in redis are serialized with ujson and then compressed by a codec
+- Every packed value starts with a one byte header naming its codec, so values written
+  with different codecs can be read side by side while a change of codec rolls out
+- Values written before codecs existed are header-less zlib, which always starts with
+  0x78, and are still read. The `zlib_legacy` codec writes them, and is the default,
+  so older instances can still read the cache during a rolling deploy
+- Switching to another codec is a second deploy: first every instance is upgraded to
+  a version which reads all codecs, then `--cache_codec` is changed
+- Available codecs:
+  - `none`: no compression
+  - `zlib`: zlib level 1
+  - `zlib_legacy`: header-less zlib at the default level
+  - `lz4`: lz4 block compression, if the `lz4` package is installed
+  - `zstd`: zstd level 3, if the `zstandard` package is installed
+- `CacheCodecs` chooses a codec for each value by the longest matching key prefix,
+  then by ttl class (values which don't expire vs values which do), then the default
+"""
+import zlib
+from typing import Callable
+from typing import Dict
+from typing import NamedTuple
+from typing import Optional
+
+import pygtrie
+import structlog
+from ujson import dumps
+from ujson import loads
+
+logger = structlog.get_logger(__name__)
+
+LEGACY_ZLIB_HEADER = 0x78
+
+
+class Codec(NamedTuple):
+    name: str
+    header: bytes
+    compress: Callable[[bytes], bytes]
+    decompress: Callable[[bytes], bytes]
+
+
+def _identity(data: bytes) -> bytes:
+    return data
+
+
+CODECS = {
+    'none': Codec('none', b'\x00', _identity, bytes),
+    'zlib': Codec('zlib', b'\x01', lambda data: zlib.compress(data, 1), zlib.decompress),
+    'zlib_legacy': Codec('zlib_legacy', b'', zlib.compress, zlib.decompress)
+}  # type: Dict[str, Codec]
+
+try:
+    import lz4.block
+    CODECS['lz4'] = Codec('lz4', b'\x02', lz4.block.compress, lz4.block.decompress)
+except ImportError:
+    pass
+
+try:
+    import zstandard
+    _zstd_compressor = zstandard.ZstdCompressor(level=3)
+    _zstd_decompressor = zstandard.ZstdDecompressor()
+    CODECS['zstd'] = Codec('zstd', b'\x03',
+                           _zstd_compressor.compress, _zstd_decompressor.decompress)
+except ImportError:
+    pass
+
+CODECS_BY_HEADER = {codec.header[0]: codec for codec in CODECS.values() if codec.header}
+
+# older jussi versions only read header-less zlib, so the codecs with a header are
+# opt-in, once every instance reading the cache can read them
+DEFAULT_CODEC = 'zlib_legacy'
+
+
+def get_codec(name: str) -> Codec:
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f'unknown or unavailable cache codec: {name}, '
+                         f'available codecs: {sorted(CODECS.keys())}')
+
+
+def pack(value, codec: Codec) -> bytes:
+    return codec.header + codec.compress(dumps(value, ensure_ascii=False).encode('utf8'))
+
+
+def unpack(data: bytes):
+    header = data[0]
+    if header == LEGACY_ZLIB_HEADER:
+        return loads(zlib.decompress(data))
+    codec = CODECS_BY_HEADER[header]
+    return loads(codec.decompress(memoryview(data)[1:]))
+
+
+class CacheCodecs:
+    """chooses the codec to pack each cache value with"""
+
+    def __init__(self, default: str=None, no_expire: str=None,
+                 prefixes: Dict[str, str]=None) -> None:
+        self.default = get_codec(default or DEFAULT_CODEC)
+        self.no_expire = get_codec(no_expire) if no_expire else self.default
+        self.prefixes = pygtrie.StringTrie(separator='.')
+        for prefix, name in (prefixes or dict()).items():
+            self.prefixes[prefix] = get_codec(name)
+
+    @classmethod
+    def from_args(cls, default: str=None, no_expire: str=None,
+                  prefixes: Optional[list]=None) -> 'CacheCodecs':
+        """build from `prefix=codec` strings"""
+        prefix_codecs = dict()
+        for item in prefixes or []:
+            prefix, _, name = item.rpartition('=')
+            prefix_codecs[prefix] = name
+        return cls(default=default, no_expire=no_expire, prefixes=prefix_codecs)
+
+    def codec_for(self, key: str=None, expire_time: int=None) -> Codec:
+        if key is not None and self.prefixes:
+            _, codec = self.prefixes.longest_prefix(key)
+            if codec is not None:
+                return codec
+        if not expire_time:
+            return self.no_expire
+        return self.default
+
+    def pack(self, value, key: str=None, expire_time: int=None) -> bytes:
+        return pack(value, self.codec_for(key, expire_time))
+
+    # pylint: disable=no-self-use
+    def unpack(self, data: bytes):
+        return unpack(data)
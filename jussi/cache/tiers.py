@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Cache Tiers
+-----------
+- The caches of a CacheGroup are ordered by SpeedTier, fastest first, and read in
+  that order, with the in-process memory cache above them all
+- Promotion: a value read from one tier is copied into the faster write tiers and
+  the memory cache, once its key has been read from a slower tier `min_hits` times
+  (see Admission), so one-off reads don't evict hot keys from the smaller tiers
+- Promoted values are copied as they were read, so stale markers are kept, and
+  cached for `promote_ttl` seconds, or for what they had left in their tier if
+  that's less (see the `ttls` method of each cache). Tiers without `ttls` aren't
+  promoted from, and the block store is never promoted into, as it only takes
+  irreversible blocks from the upstream
+- Promotions run in the background (see WriteBehind), so a read never waits for the
+  remaining ttls to be read or for the faster tiers to be written
+- Write-behind: writes to SLOW tiers, eg, redis, are sent in the background instead
+  of being awaited by the request, at most `max_pending` at once. Writes past that
+  are dropped and counted, a dropped write is only a future cache miss
+- TierStats counts hits, misses, promotions and read latency of each read cache
+"""
+import asyncio
+from collections import namedtuple
+from enum import IntEnum
+from typing import Awaitable
+from typing import Set
+
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+
+class SpeedTier(IntEnum):
+    SLOW = 1
+    FAST = 2
+    FASTEST = 3
+
+
+CacheGroupItem = namedtuple('CacheGroupItem', ('cache', 'read', 'write', 'speed_tier'))
+
+
+class TierStats:
+    __slots__ = ('name', 'speed_tier', 'hits', 'misses', 'promotions', 'seconds')
+
+    def __init__(self, item: CacheGroupItem) -> None:
+        self.name = item.cache.__class__.__name__
+        self.speed_tier = SpeedTier(item.speed_tier)
+        self.hits = 0
+        self.misses = 0
+        self.promotions = 0
+        self.seconds = 0.0
+
+    def observe(self, hits: int, misses: int, seconds: float) -> None:
+        self.hits += hits
+        self.misses += misses
+        self.seconds += seconds
+
+    def to_dict(self) -> dict:
+        reads = self.hits + self.misses
+        return {
+            'cache': self.name,
+            'speed_tier': self.speed_tier.name,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / reads, 4) if reads else None,
+            'promotions': self.promotions,
+            'seconds': round(self.seconds, 6)
+        }
+
+
+class Admission:
+    """counts reads of keys from slower tiers, admitting a key into the faster
+    tiers on its `min_hits`th read. Counts are kept for at most `max_keys` keys, and
+    all reset when that's reached, so keys which aren't read again are forgotten"""
+    __slots__ = ('min_hits', 'max_keys', '_counts')
+
+    def __init__(self, min_hits: int, max_keys: int=100000) -> None:
+        self.min_hits = min_hits
+        self.max_keys = max_keys
+        self._counts = dict()
+
+    def admit(self, key: str) -> bool:
+        if self.min_hits <= 1:
+            return True
+        count = self._counts.get(key, 0) + 1
+        if count >= self.min_hits:
+            self._counts.pop(key, None)
+            return True
+        if len(self._counts) >= self.max_keys:
+            self._counts.clear()
+        self._counts[key] = count
+        return False
+
+
+class WriteBehind:
+    __slots__ = ('max_pending', '_pending', 'written', 'dropped', 'errors')
+
+    def __init__(self, max_pending: int=1000) -> None:
+        self.max_pending = max_pending
+        self._pending = set()  # type: Set[asyncio.Future]
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def submit(self, write: Awaitable) -> None:
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            write.close()
+            return
+        future = asyncio.ensure_future(write)
+        self._pending.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future: asyncio.Future) -> None:
+        self._pending.discard(future)
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if exc is not None:
+            self.errors += 1
+            logger.error('write-behind cache write failed', exception=exc)
+            return
+        self.written += 1
+
+    async def flush(self) -> None:
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    def to_dict(self) -> dict:
+        return {
+            'pending': len(self._pending),
+            'max_pending': self.max_pending,
+            'written': self.written,
+            'dropped': self.dropped,
+            'errors': self.errors
+        }
@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
-import functools
+from time import time
+from typing import NamedTuple
 from typing import Optional
 
 import cytoolz
 import structlog
+import ujson
 
+from ..empty import _empty
 from ..typedefs import BatchJrpcRequest
 from ..typedefs import CachedBatchResponse
 from ..typedefs import CachedSingleResponse
@@ -14,10 +17,29 @@ from .ttl import TTL
 
 logger = structlog.get_logger(__name__)
 
+# cached responses which may be served stale carry the wall clock time they're
+# fresh until, and are kept in the cache past it
+FRESH_UNTIL = 'fresh_until'
+
+
+class StaleResponse(NamedTuple):
+    """a cached response past its ttl, and how many seconds past"""
+    response: SingleJrpcResponse
+    age: float
+
+
+# null results and deterministic errors are briefly cached with a marker, so they're
+# never mistaken for cached results
+NEGATIVE = 'negative'
+
+
+class NegativeResponse(NamedTuple):
+    """a cached null result or jsonrpc error"""
+    response: SingleJrpcResponse
+
 
-@functools.lru_cache(8192)
 def jsonrpc_cache_key(single_jsonrpc_request: SingleJrpcRequest) -> str:
-    return str(single_jsonrpc_request.urn)
+    return single_jsonrpc_request.urn.cache_key()
 
 
 def irreversible_ttl(jsonrpc_response: dict=None,
@@ -85,7 +107,42 @@ def merge_cached_response(request: SingleJrpcRequest,
     return {'id': request.id, 'jsonrpc': '2.0', 'result': cached_response['result']}
 
 
+def stale_age(cached_response: CachedSingleResponse) -> Optional[float]:
+    """seconds since cached_response's ttl passed, None if it's still fresh"""
+    if not isinstance(cached_response, dict):
+        return None
+    fresh_until = cached_response.get(FRESH_UNTIL)
+    if fresh_until is None:
+        return None
+    age = time() - fresh_until
+    return age if age >= 0 else None
+
+
+def is_negative(cached_response: CachedSingleResponse) -> bool:
+    return isinstance(cached_response, dict) and cached_response.get(NEGATIVE) is True
+
+
+def merge_negative_cached_response(request: SingleJrpcRequest,
+                                   cached_response: CachedSingleResponse) -> SingleJrpcResponse:
+    if 'error' in cached_response:
+        return {'id': request.id, 'jsonrpc': '2.0', 'error': cached_response['error']}
+    return {'id': request.id, 'jsonrpc': '2.0', 'result': cached_response['result']}
+
+
 def merge_cached_responses(request: BatchJrpcRequest,
                            cached_responses: CachedBatchResponse) -> CachedBatchResponse:
     return [merge_cached_response(req, resp) for req, resp in zip(
         request, cached_responses)]
+
+
+def encode_cached_result(response: SingleJrpcResponse) -> bytes:
+    """serialize a response's result once, to be spliced into responses on cache hits"""
+    return ujson.dumps(response['result'], ensure_ascii=False).encode()
+
+
+def merge_encoded_cached_response(request: SingleJrpcRequest,
+                                  encoded_result: bytes) -> bytes:
+    if request.id is _empty:
+        return b''.join((b'{"jsonrpc":"2.0","result":', encoded_result, b'}'))
+    return b''.join((b'{"id":', ujson.dumps(request.id, ensure_ascii=False).encode(),
+                     b',"jsonrpc":"2.0","result":', encoded_result, b'}'))
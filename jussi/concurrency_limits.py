@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive Upstream Concurrency Limits
+------------------------------------
+- Each upstream has a limit on its concurrent requests, requests over the limit are
+  rejected at once with an overload error instead of queueing until they time out
+- The limit is adjusted by AIMD (additive increase, multiplicative decrease):
+  - a response within `latency_tolerance` times the minimum round trip time of its
+    method raises the limit by about one per round trip's worth of responses
+  - a slower response, an error or a timeout multiplies the limit by `backoff`,
+    at most once per minimum round trip time
+- Round trip times are measured for each fetch from an upstream endpoint, ie, without
+  time spent in the fair queue or on retries, and compared to the baseline of their
+  own method, so a mix of fast and slow methods doesn't look like an overload
+- Each baseline is re-measured every `RTT_WINDOW` responses, so it follows the
+  upstream when it gets permanently slower or faster. Baselines are kept for at most
+  `MAX_BASELINES` methods, and all reset when that's reached
+- Requests cancelled for other reasons (eg, a hedge losing the race) don't change the limit
+"""
+from time import perf_counter
+from typing import Dict
+from typing import Optional
+
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+RTT_WINDOW = 250
+MAX_BASELINES = 1000
+
+
+class RTTBaseline:
+    __slots__ = ('min_rtt', '_window_min_rtt', '_samples')
+
+    def __init__(self) -> None:
+        self.min_rtt = None  # type: Optional[float]
+        self._window_min_rtt = None  # type: Optional[float]
+        self._samples = 0
+
+    def sample(self, rtt: float) -> float:
+        """record rtt, returning the minimum round trip time"""
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        if self._window_min_rtt is None or rtt < self._window_min_rtt:
+            self._window_min_rtt = rtt
+        self._samples += 1
+        if self._samples >= RTT_WINDOW:
+            self.min_rtt = self._window_min_rtt
+            self._window_min_rtt = None
+            self._samples = 0
+        return self.min_rtt
+
+
+class AdaptiveConcurrencyLimiter:
+    __slots__ = ('limit',
+                 'min_limit',
+                 'max_limit',
+                 'backoff',
+                 'latency_tolerance',
+                 'in_flight',
+                 'rejected',
+                 'baselines',
+                 '_last_decrease')
+
+    def __init__(self, limit: int=100, min_limit: int=10, max_limit: int=1000,
+                 backoff: float=0.9, latency_tolerance: float=2.0) -> None:
+        self.limit = float(limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.rejected = 0
+        self.baselines = dict()  # type: Dict[str, RTTBaseline]
+        self._last_decrease = 0.0
+
+    @property
+    def min_rtt(self) -> Optional[float]:
+        min_rtts = [b.min_rtt for b in self.baselines.values() if b.min_rtt is not None]
+        return min(min_rtts) if min_rtts else None
+
+    def try_acquire(self) -> bool:
+        if self.in_flight >= int(self.limit):
+            self.rejected += 1
+            return False
+        self.in_flight += 1
+        return True
+
+    def observe(self, rtt: float, method: str='') -> None:
+        """a response of method from an upstream endpoint, rtt seconds after it was sent"""
+        baseline = self.baselines.get(method)
+        if baseline is None:
+            if len(self.baselines) >= MAX_BASELINES:
+                self.baselines.clear()
+            baseline = self.baselines[method] = RTTBaseline()
+        min_rtt = baseline.sample(rtt)
+        if rtt > min_rtt * self.latency_tolerance:
+            self._decrease(min_rtt)
+        elif self.in_flight >= self.limit / 2:
+            # only grow a limit which is being used
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_success(self) -> None:
+        # the limit was adjusted by the observed round trip times
+        self.in_flight -= 1
+
+    def on_drop(self) -> None:
+        self.in_flight -= 1
+        self._decrease(self.min_rtt)
+
+    def on_ignore(self) -> None:
+        self.in_flight -= 1
+
+    def _decrease(self, min_rtt: Optional[float]) -> None:
+        now = perf_counter()
+        if now - self._last_decrease < (min_rtt or 0):
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+
+    def to_dict(self) -> dict:
+        return {
+            'limit': int(self.limit),
+            'in_flight': self.in_flight,
+            'rejected': self.rejected,
+            'min_rtts': {method: baseline.min_rtt
+                         for method, baseline in self.baselines.items()}
+        }
+
+
+class UpstreamConcurrencyLimits:
+    """an AdaptiveConcurrencyLimiter per upstream url, created on first use"""
+
+    def __init__(self, **limiter_kwargs) -> None:
+        self._limiter_kwargs = limiter_kwargs
+        self._limiters = dict()  # type: Dict[str, AdaptiveConcurrencyLimiter]
+
+    def __getitem__(self, url: str) -> AdaptiveConcurrencyLimiter:
+        limiter = self._limiters.get(url)
+        if limiter is None:
+            limiter = AdaptiveConcurrencyLimiter(**self._limiter_kwargs)
+            self._limiters[url] = limiter
+        return limiter
+
+    def to_dict(self) -> dict:
+        return {url: limiter.to_dict() for url, limiter in self._limiters.items()}
@@ -338,3 +338,14 @@ class JussiLimitsError(JsonRpcError):
 class JussiCustomJsonOpLengthError(JsonRpcError):
     code = 1800
     message = 'Custom JSON operation size limit of {size_limit} exceeded'
+
+
+class UpstreamOverloadedError(JsonRpcError):
+    code = 1900
+    message = 'Upstream {url} is overloaded, retry after {retry_after} seconds'
+
+    def to_sanic_response(self) -> HTTPResponse:
+        sanic_response = super().to_sanic_response()
+        sanic_response.status = 503
+        sanic_response.headers['Retry-After'] = str(self.kwargs.get('retry_after', 1))
+        return sanic_response
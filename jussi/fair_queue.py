@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Weighted Fair Queuing
+---------------------
+- Each upstream url admits at most `concurrency` requests at once, the rest wait
+- Waiting requests are served in weighted fair order (start-time fair queuing):
+  - a flow is a priority class and client ip pair, so within a class each client
+    gets an equal share, and one client's burst can't starve the others
+  - each flow's share is its class weight, eg, a `critical` flow's requests are
+    served 16 times as often as a `bulk` flow's
+- A request's priority class comes from the `priorities` of its upstream config,
+  see jussi.upstream
+- An idle upstream url doesn't queue, requests are only reordered under contention
+"""
+import asyncio
+import heapq
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+PRIORITY_WEIGHTS = {
+    'critical': 16,
+    'high': 8,
+    'normal': 4,
+    'low': 2,
+    'bulk': 1
+}
+DEFAULT_PRIORITY = 'normal'
+
+# forget the finish times of idle flows when there are more than this many
+MAX_FLOWS = 10000
+
+Flow = Tuple[str, str]
+
+
+class WeightedFairQueue:
+    __slots__ = ('concurrency',
+                 'in_flight',
+                 'queued',
+                 '_virtual_time',
+                 '_finish_times',
+                 '_waiting',
+                 '_seq',
+                 '_loop')
+
+    def __init__(self, concurrency: int, loop=None) -> None:
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self.queued = 0
+        self._virtual_time = 0.0
+        self._finish_times = dict()  # type: Dict[Flow, float]
+        # (finish tag, arrival order, start tag, waiter)
+        self._waiting = []  # type: List[Tuple[float, int, float, asyncio.Future]]
+        self._seq = 0
+        self._loop = loop or asyncio.get_event_loop()
+
+    def __len__(self) -> int:
+        return len(self._waiting)
+
+    async def acquire(self, priority: str, client: str) -> None:
+        if self.in_flight < self.concurrency and not self._waiting:
+            self.in_flight += 1
+            return
+        flow = (priority, client)
+        weight = PRIORITY_WEIGHTS.get(priority, PRIORITY_WEIGHTS[DEFAULT_PRIORITY])
+        start = max(self._virtual_time, self._finish_times.get(flow, 0.0))
+        finish = start + 1 / weight
+        self._finish_times[flow] = finish
+        waiter = self._loop.create_future()
+        self._seq += 1
+        heapq.heappush(self._waiting, (finish, self._seq, start, waiter))
+        self.queued += 1
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # the waiter may have been admitted just as it was cancelled
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        while self._waiting and self.in_flight < self.concurrency:
+            _, _, start, waiter = heapq.heappop(self._waiting)
+            if waiter.done():
+                continue
+            self._virtual_time = start
+            self.in_flight += 1
+            waiter.set_result(None)
+        if len(self._finish_times) > MAX_FLOWS:
+            self._forget_idle_flows()
+
+    def _forget_idle_flows(self) -> None:
+        # a flow whose finish time has passed starts at the virtual time anyway
+        self._finish_times = {flow: finish for flow, finish in self._finish_times.items()
+                              if finish > self._virtual_time}
+
+    def to_dict(self) -> dict:
+        return {
+            'concurrency': self.concurrency,
+            'in_flight': self.in_flight,
+            'waiting': len(self._waiting),
+            'queued': self.queued
+        }
+
+
+class UpstreamFairQueues:
+    """a WeightedFairQueue per upstream url, created on first use"""
+
+    def __init__(self, concurrency: int, loop=None) -> None:
+        self._concurrency = concurrency
+        self._loop = loop
+        self._queues = dict()  # type: Dict[str, WeightedFairQueue]
+
+    def __getitem__(self, url: str) -> WeightedFairQueue:
+        queue = self._queues.get(url)
+        if queue is None:
+            queue = WeightedFairQueue(self._concurrency, loop=self._loop)
+            self._queues[url] = queue
+        return queue
+
+    def to_dict(self) -> dict:
+        return {url: queue.to_dict() for url, queue in self._queues.items()}
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Fan-out Caching
+---------------
+- Methods which take a list of items, eg, `condenser_api.get_accounts`, are cached
+  per item when they have a `fan_outs` upstream config key (see jussi.upstream)
+- Each item is cached as the response to a request for just that item, so requests
+  for overlapping lists of items, and requests for one item, share cached items
+- A request for several items reads its cached items with one `mget`, sends only the
+  missing items upstream in one request, splits that result into per item results
+  to cache them, and reassembles its result in the order of its items
+- Results are matched to items by position, or, with a `key`, by the field of each
+  result entry holding its item, for methods which leave out unknown items, eg,
+  `get_accounts` returns no entry for an unknown account
+- Requests with fewer than two items, or repeated items, are cached as usual
+"""
+from typing import Any
+from typing import List
+from typing import Optional
+
+import ujson
+
+from .cache.ttl import TTL
+from .cache.utils import FRESH_UNTIL
+from .cache.utils import stale_age
+from .empty import _empty
+from .typedefs import SingleJrpcRequest
+from .typedefs import SingleJrpcResponse
+from .upstream import FanOut
+from .validators import is_valid_non_error_single_jsonrpc_response
+
+Items = List[Any]
+
+
+def fan_out_items(request: SingleJrpcRequest) -> Optional[Items]:
+    """the items of a request which is cached per item, else None"""
+    fan_out = request.upstream.fan_out
+    if fan_out is None or request.upstream.ttl == TTL.NO_CACHE:
+        return None
+    try:
+        items = request.urn.params[fan_out.param]
+    except (IndexError, KeyError, TypeError):
+        return None
+    if not isinstance(items, list) or len(items) < 2:
+        return None
+    if not all(isinstance(item, (str, int)) for item in items):
+        return None
+    if len(set(items)) != len(items):
+        return None
+    return items
+
+
+def replace_items(params, fan_out: FanOut, items: Items):
+    if isinstance(params, dict):
+        return dict(params, **{fan_out.param: items})
+    params = list(params)
+    params[fan_out.param] = items
+    return params
+
+
+def with_items(request: SingleJrpcRequest, items: Items) -> dict:
+    """a raw copy of request, as the client sent it, for other items"""
+    fan_out = request.upstream.fan_out
+    raw_request = dict(request.original_request or request.to_dict())
+    params = raw_request['params']
+    if raw_request['method'] == 'call':
+        api, method, call_params = params[:3]
+        raw_request['params'] = [api, method, replace_items(call_params, fan_out, items)]
+    else:
+        raw_request['params'] = replace_items(params, fan_out, items)
+    return raw_request
+
+
+def result_list(fan_out: FanOut, result: Any) -> Optional[list]:
+    if fan_out.result is not None:
+        if not isinstance(result, dict):
+            return None
+        result = result.get(fan_out.result)
+    return result if isinstance(result, list) else None
+
+
+def with_result_list(fan_out: FanOut, result: Any, entries: list) -> Any:
+    if fan_out.result is not None:
+        return dict(result, **{fan_out.result: entries})
+    return entries
+
+
+def split_result(fan_out: FanOut, items: Items, result: Any) -> Optional[List[Any]]:
+    """the result of a request for each of items, None if result doesn't match items"""
+    entries = result_list(fan_out, result)
+    if entries is None:
+        return None
+    if fan_out.key is None:
+        if len(entries) != len(items):
+            return None
+        return [with_result_list(fan_out, result, [entry]) for entry in entries]
+    entries_by_item = dict()
+    for entry in entries:
+        if not isinstance(entry, dict) or entry.get(fan_out.key) not in items:
+            return None
+        entries_by_item[entry[fan_out.key]] = entry
+    if len(entries_by_item) != len(entries):
+        return None
+    return [with_result_list(fan_out, result,
+                             [entries_by_item[item]] if item in entries_by_item else [])
+            for item in items]
+
+
+def join_results(fan_out: FanOut, results: List[Any]) -> Any:
+    """reassemble a result from the results for each item"""
+    entries = []
+    for result in results:
+        entries.extend(result_list(fan_out, result))
+    return with_result_list(fan_out, results[0], entries)
+
+
+def cached_result(fan_out: FanOut, cached_value: Any) -> Optional[Any]:
+    """the result of an item's cached response, None if it's missing, stale or negative"""
+    if isinstance(cached_value, bytes):
+        result = ujson.loads(cached_value)
+    else:
+        if stale_age(cached_value) is not None:
+            return None
+        if isinstance(cached_value, dict) and FRESH_UNTIL in cached_value:
+            # cached with a stale marker, for methods with stale ttls
+            cached_value = {k: v for k, v in cached_value.items() if k != FRESH_UNTIL}
+        if not is_valid_non_error_single_jsonrpc_response(cached_value):
+            return None
+        result = cached_value['result']
+    if result_list(fan_out, result) is None:
+        return None
+    return result
+
+
+def response_with_result(request: SingleJrpcRequest, result: Any) -> SingleJrpcResponse:
+    if request.id is _empty:
+        return {'jsonrpc': '2.0', 'result': result}
+    return {'id': request.id, 'jsonrpc': '2.0', 'result': result}
@@ -2,24 +2,47 @@
 import asyncio
 import concurrent.futures
 import datetime
+from functools import partial
 from time import perf_counter as perf
+from typing import Container
 from typing import Coroutine
+from typing import List
 
 import cytoolz
 import structlog
 
 from async_timeout import timeout
 from sanic import response
-from ujson import loads
 from websockets.exceptions import ConnectionClosed
 
+from .balancer import UpstreamEndpoint
+from .cache.backends.batcher import BatchedReadCache
+from .cache.backends.block_store import BlockStore
+from .cache.backends.replicas import ReplicaSet
+from .cache.backends.shm import SharedMemoryCache
+from .cache.utils import jsonrpc_cache_key
+from .empty import _empty
 from .errors import InvalidUpstreamURL
 from .errors import RequestTimeoutError
+from .errors import UpstreamOverloadedError
 from .errors import UpstreamResponseError
+from .fan_out import cached_result
+from .fan_out import fan_out_items
+from .fan_out import join_results
+from .fan_out import response_with_result
+from .fan_out import split_result
+from .fan_out import with_items
+from .raw_response import RawJsonRpcResponse
+from .raw_response import encode_batch_response
+from .raw_response import encode_response
+from .raw_response import parsed_response
+from .request.jsonrpc import from_http_request
 from .typedefs import HTTPRequest
 from .typedefs import HTTPResponse
 from .typedefs import SingleJrpcRequest
 from .typedefs import SingleJrpcResponse
+from .validators import is_idempotent_request
+from .ws.mux import MultiplexedPool
 
 logger = structlog.get_logger(__name__)
 
@@ -29,19 +52,48 @@ logger = structlog.get_logger(__name__)
 async def handle_jsonrpc(http_request: HTTPRequest) -> HTTPResponse:
     # retreive parsed jsonrpc_requests after request middleware processing
     http_request.timings.append((perf(), 'handle_jsonrpc.enter'))
+    if http_request.stale_response is not None:
+        return await dispatch_single_or_stale(http_request)
     # make upstream requests
     async with timeout(http_request.request_timeout):
         if http_request.is_single_jrpc:
 
-            jsonrpc_response = await dispatch_single(http_request,
-                                                     http_request.jsonrpc)
+            jsonrpc_response = await dispatch(http_request, http_request.jsonrpc)
+            body = encode_response(jsonrpc_response)
         else:
 
-            futures = [dispatch_single(http_request, request)
+            futures = [dispatch(http_request, request)
                        for request in http_request.jsonrpc]
             jsonrpc_response = await asyncio.gather(*futures)
+            body = encode_batch_response(jsonrpc_response)
+        # keep the responses for caching, so the body needn't be parsed again
+        http_request.upstream_responses = jsonrpc_response
         http_request.timings.append((perf(), 'handle_jsonrpc.exit'))
-        return response.json(jsonrpc_response)
+        return response.raw(body, content_type='application/json')
+
+
+async def dispatch_single_or_stale(http_request: HTTPRequest) -> HTTPResponse:
+    """dispatch, but answer with the request's stale cached response if the
+    upstream fails, times out or returns an error"""
+    jrpc_request = http_request.jsonrpc
+    try:
+        async with timeout(http_request.request_timeout):
+            jsonrpc_response = await dispatch_single(http_request, jrpc_request)
+        if 'error' not in parsed_response(jsonrpc_response):
+            http_request.upstream_responses = jsonrpc_response
+            http_request.timings.append((perf(), 'handle_jsonrpc.exit'))
+            return response.raw(encode_response(jsonrpc_response),
+                                content_type='application/json')
+        logger.info('upstream error, serving stale response',
+                    request_id=http_request.jussi_request_id)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.info('upstream failed, serving stale response', e=e,
+                    request_id=http_request.jussi_request_id)
+    http_request.timings.append((perf(), 'handle_jsonrpc.exit'))
+    return response.json(http_request.stale_response,
+                         headers={'x-jussi-cache-hit': jsonrpc_cache_key(jrpc_request)})
 
 
 async def healthcheck(http_request: HTTPRequest) -> HTTPResponse:
@@ -64,17 +116,29 @@ async def monitor(http_request: HTTPRequest) -> HTTPResponse:
     try:
         cache_group = app.config.cache_group
         cache_data.append({
-            'cache.memory_cache': {
-                'keys': len(cache_group._memory_cache._keys)
-            }
+            'cache.memory_cache': cache_group._memory_cache.to_dict()
         })
+        cache_data.append({'cache.tiers': cache_group.tier_stats()})
         for i, cache in enumerate(cache_group._read_caches):
+            if isinstance(cache, SharedMemoryCache):
+                cache_data.append({'shared_memory_cache': cache.to_dict()})
+                continue
+            if isinstance(cache, BlockStore):
+                cache_data.append({'block_store': cache.to_dict()})
+                continue
             data = {
                 'read_cache.pool.available': len(cache.client.connection_pool._available_connections),
                 'read_cache.pool.in_use': len(cache.client.connection_pool._in_use_connections)
             }
+            if isinstance(cache, BatchedReadCache):
+                data['read_cache.batches'] = cache.to_dict()
+            replicas = cache._cache if isinstance(cache, BatchedReadCache) else cache
+            if isinstance(replicas, ReplicaSet):
+                data['read_cache.replicas'] = replicas.to_dict()
             cache_data.append(data)
         for i, cache in enumerate(cache_group._write_caches):
+            if isinstance(cache, (SharedMemoryCache, BlockStore)):
+                continue
             data = {
                 'write_cache.pool.available': len(cache.client.connection_pool._available_connections),
                 'write_cache.pool.in_use': len(cache.client.connection_pool._in_use_connections)
@@ -103,16 +167,65 @@ async def monitor(http_request: HTTPRequest) -> HTTPResponse:
     pools = http_request.app.config.websocket_pools
     try:
         for url, pool in pools.items():
-            data = {
-                'url': url,
-                'queue': pool._queue.qsize,
-                'in_use': len([ch._in_use for ch in pool._holders if ch._in_use is not None]),
-                'ws_read_q_sizes': [ch._con.messages.qsize() for ch in pool._holders if ch._con]
-            }
-            ws_pools.append(data)
+            ws_pools.append(pool.to_dict())
     except Exception as e:
         logger.error('error adding cache info', e=e)
 
+    upstream_endpoints = []
+    try:
+        upstream_endpoints = [endpoint.to_dict() for endpoint in
+                              app.config.upstreams.endpoints.values()]
+    except Exception as e:
+        logger.error('error adding upstream endpoint info', e=e)
+
+    http_pools = dict()
+    try:
+        http_pools = app.config.upstream_http_pools.to_dict()
+    except Exception as e:
+        logger.error('error adding upstream http pool info', e=e)
+
+    fair_queues = dict()
+    try:
+        if app.config.upstream_fair_queues is not None:
+            fair_queues = app.config.upstream_fair_queues.to_dict()
+    except Exception as e:
+        logger.error('error adding upstream fair queue info', e=e)
+
+    concurrency_limits = dict()
+    try:
+        if app.config.upstream_concurrency_limits is not None:
+            concurrency_limits = app.config.upstream_concurrency_limits.to_dict()
+    except Exception as e:
+        logger.error('error adding upstream concurrency limit info', e=e)
+
+    single_flight = dict()
+    try:
+        if app.config.single_flight is not None:
+            single_flight = app.config.single_flight.to_dict()
+    except Exception as e:
+        logger.error('error adding single flight info', e=e)
+
+    block_clock = dict()
+    try:
+        if app.config.block_clock is not None:
+            block_clock = app.config.block_clock.to_dict()
+    except Exception as e:
+        logger.error('error adding block clock info', e=e)
+
+    block_prefetcher = dict()
+    try:
+        if app.config.block_prefetcher is not None:
+            block_prefetcher = app.config.block_prefetcher.to_dict()
+    except Exception as e:
+        logger.error('error adding block prefetcher info', e=e)
+
+    upstream_batchers = []
+    try:
+        upstream_batchers = [batcher.to_dict() for batcher in
+                             app.config.upstream_batchers.values()]
+    except Exception as e:
+        logger.error('error adding upstream batcher info', e=e)
+
     async_data = dict()
     try:
         tasks = asyncio.tasks.Task.all_tasks()
@@ -132,8 +245,15 @@ async def monitor(http_request: HTTPRequest) -> HTTPResponse:
         'asyncio': async_data,
         'cache': cache_data,
         'server': server_data,
-        'ws_pools': ws_pools
-
+        'ws_pools': ws_pools,
+        'http_pools': http_pools,
+        'upstream_concurrency_limits': concurrency_limits,
+        'upstream_fair_queues': fair_queues,
+        'upstream_endpoints': upstream_endpoints,
+        'single_flight': single_flight,
+        'upstream_batchers': upstream_batchers,
+        'block_clock': block_clock,
+        'block_prefetcher': block_prefetcher
     }
     return response.json(data)
 # pylint: enable=protected-access, too-many-locals, no-member, unused-variable
@@ -142,10 +262,21 @@ async def monitor(http_request: HTTPRequest) -> HTTPResponse:
 
 
 async def fetch_ws(http_request: HTTPRequest,
-                   jrpc_request: SingleJrpcRequest) -> SingleJrpcResponse:
+                   jrpc_request: SingleJrpcRequest,
+                   url: str=None) -> SingleJrpcResponse:
     jrpc_request.timings.append((perf(), 'fetch_ws.enter'))
     pools = http_request.app.config.websocket_pools
-    pool = pools[jrpc_request.upstream.url]
+    pool = pools[url or jrpc_request.upstream.url]
+    if isinstance(pool, MultiplexedPool):
+        upstream_response_json = await pool.request(
+            jrpc_request.to_upstream_request(as_json=False),
+            timeout=jrpc_request.upstream.timeout)
+        jrpc_request.timings.append((perf(), 'fetch_ws.response'))
+        upstream_response = RawJsonRpcResponse.from_upstream(upstream_response_json,
+                                                             jrpc_request.id)
+        jrpc_request.timings.append((perf(), 'fetch_ws.exit'))
+        return upstream_response
+
     upstream_request = jrpc_request.to_upstream_request()
     try:
         conn = await pool.acquire()
@@ -154,14 +285,14 @@ async def fetch_ws(http_request: HTTPRequest,
         jrpc_request.timings.append((perf(), 'fetch_ws.send'))
         upstream_response_json = await conn.recv()
         jrpc_request.timings.append((perf(), 'fetch_ws.response'))
-        upstream_response = loads(upstream_response_json)
+        upstream_response = RawJsonRpcResponse.from_upstream(upstream_response_json,
+                                                             jrpc_request.id)
         await pool.release(conn)
-        assert int(upstream_response.get('id')) == jrpc_request.upstream_id
-        upstream_response['id'] = jrpc_request.id
+        assert int(upstream_response.upstream_id) == jrpc_request.upstream_id
         jrpc_request.timings.append((perf(), 'fetch_ws.exit'))
         return upstream_response
 
-    except Exception as e:
+    except BaseException as e:
         try:
             conn.terminate()
         except NameError:
@@ -174,29 +305,247 @@ async def fetch_ws(http_request: HTTPRequest,
 
 
 async def fetch_http(http_request: HTTPRequest,
-                     jrpc_request: SingleJrpcRequest) -> SingleJrpcResponse:
+                     jrpc_request: SingleJrpcRequest,
+                     url: str=None) -> SingleJrpcResponse:
     jrpc_request.timings.append((perf(), 'fetch_http.enter'))
-    session = http_request.app.config.aiohttp['session']
+    url = url or jrpc_request.upstream.url
+    session = http_request.app.config.upstream_http_pools.session(url)
     upstream_request = jrpc_request.to_upstream_request(as_json=False)
 
-    async with session.post(jrpc_request.upstream.url,
+    async with session.post(url,
                             json=upstream_request,
                             headers=jrpc_request.upstream_headers) as resp:
         jrpc_request.timings.append((perf(), 'fetch_http.response'))
-        upstream_response = await resp.json(encoding='utf-8', content_type=None)
-    upstream_response['id'] = jrpc_request.id
+        upstream_response_json = await resp.read()
+    upstream_response = RawJsonRpcResponse.from_upstream(upstream_response_json,
+                                                         jrpc_request.id)
     jrpc_request.timings.append((perf(), 'fetch_http.exit'))
     return upstream_response
 # pylint: enable=no-value-for-parameter
 
 
+async def fetch_batched(http_request: HTTPRequest,
+                        jrpc_request: SingleJrpcRequest,
+                        url: str=None) -> SingleJrpcResponse:
+    jrpc_request.timings.append((perf(), 'fetch_batched.enter'))
+    batcher = http_request.app.config.upstream_batchers[url or jrpc_request.upstream.url]
+    upstream_response = await batcher.fetch(jrpc_request)
+    jrpc_request.timings.append((perf(), 'fetch_batched.exit'))
+    return upstream_response
+
+
+async def fetch_endpoint(http_request: HTTPRequest,
+                         jrpc_request: SingleJrpcRequest,
+                         endpoint: UpstreamEndpoint,
+                         abandoned: Container[UpstreamEndpoint]=()) -> SingleJrpcResponse:
+    """fetch from a balanced upstream endpoint, recording its in-flight requests and latency"""
+    fair_queues = http_request.app.config.upstream_fair_queues
+    if fair_queues is None:
+        return await fetch_endpoint_now(http_request, jrpc_request, endpoint, abandoned)
+    queue = fair_queues[endpoint.url]
+    await queue.acquire(jrpc_request.upstream.priority, http_request.client_ip)
+    jrpc_request.timings.append((perf(), 'fetch_endpoint.dequeued'))
+    try:
+        return await fetch_endpoint_now(http_request, jrpc_request, endpoint, abandoned)
+    finally:
+        queue.release()
+
+
+async def fetch_endpoint_now(http_request: HTTPRequest,
+                             jrpc_request: SingleJrpcRequest,
+                             endpoint: UpstreamEndpoint,
+                             abandoned: Container[UpstreamEndpoint]=()) -> SingleJrpcResponse:
+    batchers = http_request.app.config.upstream_batchers
+    if batchers and endpoint.url in batchers and is_idempotent_request(jrpc_request):
+        fetch = fetch_batched
+    elif endpoint.url.startswith('ws'):
+        fetch = fetch_ws
+    else:
+        fetch = fetch_http
+    start = endpoint.on_request_start()
+    try:
+        upstream_response = await fetch(http_request, jrpc_request, url=endpoint.url)
+    except asyncio.CancelledError:
+        # a hedged request which lost the race says nothing about the endpoint's health
+        if endpoint in abandoned:
+            endpoint.on_request_cancel()
+        else:
+            endpoint.on_request_end(start, error=True)
+        raise
+    except BaseException:
+        endpoint.on_request_end(start, error=True)
+        raise
+    endpoint.on_request_end(start)
+    limits = http_request.app.config.upstream_concurrency_limits
+    if limits is not None:
+        urn = jrpc_request.urn
+        method = '.'.join(str(p) for p in (urn.api, urn.method) if p is not _empty)
+        limits[jrpc_request.upstream.url].observe(perf() - start, method)
+    return upstream_response
+
+
+async def fetch_hedged(http_request: HTTPRequest,
+                       jrpc_request: SingleJrpcRequest,
+                       endpoint: UpstreamEndpoint,
+                       tried: List[UpstreamEndpoint]) -> SingleJrpcResponse:
+    """fetch from endpoint, and if it hasn't responded by the hedge delay, also from
+    another endpoint, returning the first successful response"""
+    upstream = jrpc_request.upstream
+    abandoned = set()
+    primary = asyncio.ensure_future(
+        fetch_endpoint(http_request, jrpc_request, endpoint, abandoned))
+    delay = max(upstream.hedge_after_ms / 1000, endpoint.latency_p95 or 0)
+    try:
+        done, _ = await asyncio.wait([primary], timeout=delay)
+    except asyncio.CancelledError:
+        primary.cancel()
+        raise
+    if done:
+        return primary.result()
+
+    hedge_endpoint = upstream.balancer.select(exclude=tried)
+    if hedge_endpoint in tried:
+        return await primary
+    tried.append(hedge_endpoint)
+    jrpc_request.timings.append((perf(), 'fetch_hedged.hedge'))
+    logger.debug('hedging upstream request', url=endpoint.url,
+                 hedge_url=hedge_endpoint.url, delay=delay)
+    hedge = asyncio.ensure_future(
+        fetch_endpoint(http_request, jrpc_request, hedge_endpoint, abandoned))
+    fetches = {primary: endpoint, hedge: hedge_endpoint}
+    pending = set(fetches)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for fetch in done:
+                if fetch.exception() is None:
+                    return fetch.result()
+        # both failed, surface the primary's error
+        return primary.result()
+    finally:
+        for fetch, fetch_from in fetches.items():
+            if not fetch.done():
+                abandoned.add(fetch_from)
+                fetch.cancel()
+
+
+async def fetch_with_retries(http_request: HTTPRequest,
+                             jrpc_request: SingleJrpcRequest) -> SingleJrpcResponse:
+    """fetch from the upstream's balancer, retrying failed idempotent requests
+    on another endpoint and hedging slow ones"""
+    upstream = jrpc_request.upstream
+    if is_idempotent_request(jrpc_request):
+        retries = upstream.retries
+        hedge = upstream.hedge_after_ms > 0 and len(upstream.balancer.members) > 1
+    else:
+        retries = 0
+        hedge = False
+    tried = []
+    attempt = 0
+    while True:
+        endpoint = upstream.balancer.select(exclude=tried)
+        tried.append(endpoint)
+        try:
+            if hedge:
+                return await fetch_hedged(http_request, jrpc_request, endpoint, tried)
+            return await fetch_endpoint(http_request, jrpc_request, endpoint)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if attempt >= retries:
+                raise e
+            attempt += 1
+            jrpc_request.timings.append((perf(), 'fetch_with_retries.retry'))
+            logger.info('retrying upstream request', url=endpoint.url,
+                        attempt=attempt, e=e)
+
+
+async def fetch_with_limit(http_request: HTTPRequest,
+                           jrpc_request: SingleJrpcRequest) -> SingleJrpcResponse:
+    """fetch unless the upstream is at its adaptive concurrency limit, in which case
+    the request is rejected at once instead of queueing. The limit is adjusted by the
+    round trip times of the endpoint fetches, see fetch_endpoint_now"""
+    url = jrpc_request.upstream.url
+    limiter = http_request.app.config.upstream_concurrency_limits[url]
+    if not limiter.try_acquire():
+        raise UpstreamOverloadedError(http_request=http_request,
+                                      jrpc_request=jrpc_request,
+                                      url=url,
+                                      retry_after=http_request.app.config.args.upstream_overload_retry_after)
+    try:
+        upstream_response = await fetch_with_retries(http_request, jrpc_request)
+    except asyncio.CancelledError:
+        # eg, the client went away, which says nothing about the upstream
+        limiter.on_ignore()
+        raise
+    except BaseException:
+        # errors and timeouts are both signs of an overloaded upstream
+        limiter.on_drop()
+        raise
+    limiter.on_success()
+    return upstream_response
+
+
+def dispatch(http_request: HTTPRequest, jrpc_request: SingleJrpcRequest) -> Coroutine:
+    if fan_out_items(jrpc_request) is not None:
+        return dispatch_fan_out(http_request, jrpc_request)
+    return dispatch_single(http_request, jrpc_request)
+
+
+async def dispatch_fan_out(http_request: HTTPRequest,
+                           jrpc_request: SingleJrpcRequest) -> SingleJrpcResponse:
+    """answer a request for several items from the items' cached responses, sending
+    only the missing items upstream, see jussi.fan_out"""
+    fan_out = jrpc_request.upstream.fan_out
+    items = fan_out_items(jrpc_request)
+    config = http_request.app.config
+    cache_group = config.cache_group
+    item_requests = [from_http_request(http_request, jrpc_request.batch_index,
+                                       with_items(jrpc_request, [item]))
+                     for item in items]
+    cached = await cache_group.mget([jsonrpc_cache_key(r) for r in item_requests])
+    results = [cached_result(fan_out, value) for value in cached]
+    missing = [i for i, result in enumerate(results) if result is None]
+    jrpc_request.timings.append((perf(), 'dispatch_fan_out.cached'))
+    if missing:
+        missing_items = [items[i] for i in missing]
+        if len(missing) == 1:
+            upstream_request = item_requests[missing[0]]
+        else:
+            upstream_request = from_http_request(http_request, jrpc_request.batch_index,
+                                                 with_items(jrpc_request, missing_items))
+        upstream_response = await dispatch_single(http_request, upstream_request)
+        parsed = parsed_response(upstream_response)
+        if 'result' not in parsed:
+            return upstream_response
+        missing_results = split_result(fan_out, missing_items, parsed['result'])
+        if missing_results is None:
+            logger.info('unable to split fan out result', urn=str(upstream_request.urn),
+                        request_id=http_request.jussi_request_id)
+            return await dispatch_single(http_request, jrpc_request)
+        for i, result in zip(missing, missing_results):
+            results[i] = result
+        asyncio.ensure_future(cache_group.cache_batch_jsonrpc_response(
+            requests=[item_requests[i] for i in missing],
+            responses=[response_with_result(item_requests[i], results[i]) for i in missing],
+            last_irreversible_block_num=config.last_irreversible_block_num))
+    return response_with_result(jrpc_request, join_results(fan_out, results))
+
+
 def dispatch_single(http_request: HTTPRequest,
                     jrpc_request) -> Coroutine:
     # pylint: disable=unexpected-keyword-arg
-    if jrpc_request.upstream.url.startswith('ws'):
-        response = fetch_ws(http_request, jrpc_request)
-    elif jrpc_request.upstream.url.startswith('http'):
-        response = fetch_http(http_request, jrpc_request)
+    url = jrpc_request.upstream.url
+    if not url.startswith('ws') and not url.startswith('http'):
+        raise InvalidUpstreamURL(url=url, reason='scheme')
+    if http_request.app.config.upstream_concurrency_limits is None:
+        fetch = fetch_with_retries
     else:
-        raise InvalidUpstreamURL(url=jrpc_request.upstream.url, reason='scheme')
-    return response
+        fetch = fetch_with_limit
+    single_flight = http_request.app.config.single_flight
+    if single_flight is None:
+        return fetch(http_request, jrpc_request)
+    return single_flight.fetch(jrpc_request,
+                               partial(fetch, http_request, jrpc_request),
+                               request_timeout=http_request.request_timeout)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Upstream HTTP Connection Pools
+------------------------------
+- Each http upstream url gets its own aiohttp connector and session, so a slow
+  upstream can only use up its own connections. Urls which aren't in the upstream
+  config get theirs when they're first used
+- Each connector opens at most `limit` connections, keeps idle connections open for
+  `keepalive_timeout` seconds and caches dns lookups for `ttl_dns_cache` seconds
+- At startup, `min_connections` connections to each url are opened by sending that
+  many concurrent health check requests
+- The time requests wait for a free connection, and the connections in use, are
+  tracked per url
+"""
+import asyncio
+from typing import Dict
+from typing import Iterable
+from urllib.parse import urljoin
+
+import aiohttp
+import structlog
+
+from .upstream_health import health_check_request
+
+logger = structlog.get_logger(__name__)
+
+
+class ConnectionPoolStats:
+    __slots__ = ('queued', 'queued_time', 'max_queued_time', 'created', 'reused')
+
+    def __init__(self) -> None:
+        self.queued = 0
+        self.queued_time = 0.0
+        self.max_queued_time = 0.0
+        self.created = 0
+        self.reused = 0
+
+    def trace_config(self, loop) -> aiohttp.TraceConfig:
+        # pylint: disable=unused-argument
+        async def on_queued_start(session, ctx, params):
+            ctx.queued_at = loop.time()
+
+        async def on_queued_end(session, ctx, params):
+            wait = loop.time() - ctx.queued_at
+            self.queued += 1
+            self.queued_time += wait
+            self.max_queued_time = max(self.max_queued_time, wait)
+
+        async def on_create_end(session, ctx, params):
+            self.created += 1
+
+        async def on_reuse(session, ctx, params):
+            self.reused += 1
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_queued_start.append(on_queued_start)
+        trace_config.on_connection_queued_end.append(on_queued_end)
+        trace_config.on_connection_create_end.append(on_create_end)
+        trace_config.on_connection_reuseconn.append(on_reuse)
+        return trace_config
+
+    def to_dict(self) -> dict:
+        return {
+            'queued': self.queued,
+            'queued_time_avg': self.queued_time / self.queued if self.queued else 0.0,
+            'queued_time_max': self.max_queued_time,
+            'created': self.created,
+            'reused': self.reused
+        }
+
+
+class UpstreamHTTPPools:
+    """one aiohttp session, with its own connection pool, per upstream url"""
+
+    def __init__(self, urls: Iterable[str], limit: int=100,
+                 keepalive_timeout: float=15.0, ttl_dns_cache: int=10,
+                 loop=None, **session_kwargs) -> None:
+        self._loop = loop or asyncio.get_event_loop()
+        self._limit = limit
+        self._keepalive_timeout = keepalive_timeout
+        self._ttl_dns_cache = ttl_dns_cache
+        self._session_kwargs = session_kwargs
+        self._sessions = dict()  # type: Dict[str, aiohttp.ClientSession]
+        self._stats = dict()  # type: Dict[str, ConnectionPoolStats]
+        self._prewarm_task = None  # type: asyncio.Task
+        for url in urls:
+            if not url.startswith('ws'):
+                self._add(url)
+
+    def _add(self, url: str) -> aiohttp.ClientSession:
+        stats = ConnectionPoolStats()
+        connector = aiohttp.TCPConnector(limit=self._limit,
+                                         keepalive_timeout=self._keepalive_timeout,
+                                         ttl_dns_cache=self._ttl_dns_cache,
+                                         loop=self._loop)
+        session = aiohttp.ClientSession(connector=connector,
+                                        trace_configs=[stats.trace_config(self._loop)],
+                                        loop=self._loop,
+                                        **self._session_kwargs)
+        self._sessions[url] = session
+        self._stats[url] = stats
+        return session
+
+    def __contains__(self, url: str) -> bool:
+        return url in self._sessions
+
+    def session(self, url: str) -> aiohttp.ClientSession:
+        """the url's session, created on first use for urls which aren't in the upstream
+        config, eg, JUSSI_ACCOUNT_TRANSFER_STEEMD_URL"""
+        session = self._sessions.get(url)
+        if session is None:
+            logger.info('creating upstream connection pool', url=url)
+            session = self._add(url)
+        return session
+
+    def start_prewarm(self, upstreams, min_connections: int) -> None:
+        if min_connections > 0 and self._sessions:
+            self._prewarm_task = self._loop.create_task(
+                self.prewarm(upstreams, min_connections))
+
+    async def prewarm(self, upstreams, min_connections: int) -> None:
+        """open min_connections connections to each url"""
+        await asyncio.gather(*[self._prewarm_url(url, upstreams.health_check(url),
+                                                 min_connections)
+                               for url in self._sessions])
+
+    async def _prewarm_url(self, url: str, health_check: dict, min_connections: int) -> None:
+        session = self._sessions[url]
+
+        async def warm():
+            if 'path' in health_check:
+                async with session.get(urljoin(url, health_check['path'])) as resp:
+                    await resp.read()
+            else:
+                async with session.post(url, data=health_check_request(health_check)) as resp:
+                    await resp.read()
+        results = await asyncio.gather(*[warm() for _ in range(min_connections)],
+                                       return_exceptions=True)
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors:
+            logger.info('error prewarming upstream connections', url=url, e=errors[0])
+        logger.debug('prewarmed upstream connections', url=url,
+                     connections=min_connections - len(errors))
+
+    async def close(self) -> None:
+        if self._prewarm_task is not None:
+            self._prewarm_task.cancel()
+        for session in self._sessions.values():
+            await session.close()
+
+    def to_dict(self) -> dict:
+        # pylint: disable=protected-access
+        data = dict()
+        for url, session in self._sessions.items():
+            connector = session.connector
+            data[url] = {
+                'limit': connector.limit,
+                'in_use': len(connector._acquired),
+                'idle': sum(len(conns) for conns in connector._conns.values()),
+                **self._stats[url].to_dict()
+            }
+        return data
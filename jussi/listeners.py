@@ -9,11 +9,23 @@ import aiohttp
 import async_timeout
 import ujson
 
+from jussi.ws.mux import MultiplexedPool
 from jussi.ws.pool import Pool
 
+from .balancer import HealthPolicy
+from .block_clock import BlockClock
+from .block_prefetcher import BlockPrefetcher
 from .cache import setup_caches
+from .concurrency_limits import UpstreamConcurrencyLimits
+from .fair_queue import UpstreamFairQueues
+from .http_pools import UpstreamHTTPPools
+from .single_flight import SingleFlight
 from .typedefs import WebApp
 from .upstream import _Upstreams
+from .upstream_batcher import UpstreamBatcher
+from .upstream_batcher import http_batch_sender
+from .upstream_batcher import ws_batch_sender
+from .upstream_health import UpstreamHealthChecker
 
 
 def setup_listeners(app: WebApp) -> WebApp:
@@ -59,6 +71,22 @@ def setup_listeners(app: WebApp) -> WebApp:
             headers={'Content-Type': 'application/json'}))
         app.config.aiohttp = aio
 
+    @app.listener('before_server_start')
+    def setup_upstream_http_pools(app: WebApp, loop) -> None:
+        logger = app.config.logger
+        logger.info('setup_upstream_http_pools', when='before_server_start')
+        args = app.config.args
+        pools = UpstreamHTTPPools(app.config.upstreams.urls,
+                                  limit=args.upstream_http_limit,
+                                  keepalive_timeout=args.upstream_http_keepalive_timeout,
+                                  ttl_dns_cache=args.upstream_http_dns_cache_ttl,
+                                  loop=loop,
+                                  skip_auto_headers=['User-Agent'],
+                                  json_serialize=partial(ujson.dumps, ensure_ascii=False),
+                                  headers={'Content-Type': 'application/json'})
+        pools.start_prewarm(app.config.upstreams, args.upstream_http_min_connections)
+        app.config.upstream_http_pools = pools
+
     @app.listener('before_server_start')
     async def setup_websocket_connection_pools(app: WebApp, loop) -> None:
         logger = app.config.logger
@@ -75,7 +103,19 @@ def setup_listeners(app: WebApp) -> WebApp:
         )
         for url in upstream_urls:
             print("********url=",url)
-            if url.startswith('ws'):
+            if url.startswith('ws') and args.websocket_multiplex:
+                logger.info('creating multiplexed websocket pool',
+                            pool_size=args.websocket_pool_maxsize,
+                            url=url,
+                            **ws_connect_kwargs)
+                pools[url] = MultiplexedPool(
+                    args.websocket_pool_maxsize,  # connections in pool
+                    loop,  # event_loop
+                    url,  # connection url
+                    # all kwargs are passed to websocket connection
+                    **ws_connect_kwargs
+                )
+            elif url.startswith('ws'):
                 logger.info('creating websocket pool',
                             pool_min_size=args.websocket_pool_minsize,
                             pool_maxsize=args.websocket_pool_maxsize,
@@ -89,13 +129,59 @@ def setup_listeners(app: WebApp) -> WebApp:
                     0,  # max queries per conn (0 means unlimited)
                     loop,  # event_loop
                     url,  # connection url
-                    # all kwargs are passed to websocket connection
+                    pool_acquire_timeout=args.websocket_pool_acquire_timeout,
+                    pool_scale_up_wait=args.websocket_pool_scale_up_wait,
+                    pool_idle_timeout=args.websocket_pool_idle_timeout,
+                    pool_ping_interval=args.websocket_pool_ping_interval,
+                    # all other kwargs are passed to websocket connection
                     **ws_connect_kwargs
                 )
 
         # pylint: disable=protected-access
         app.config.websocket_pools = pools
 
+    @app.listener('before_server_start')
+    def setup_upstream_batchers(app: WebApp, loop) -> None:
+        logger = app.config.logger
+        logger.info('setup_upstream_batchers', when='before_server_start')
+        args = app.config.args
+        batchers = dict()
+        if args.upstream_batch_max_size > 1:
+            for url in app.config.upstreams.urls:
+                if url.startswith('ws'):
+                    send = ws_batch_sender(app.config.websocket_pools[url])
+                else:
+                    send = http_batch_sender(app.config.upstream_http_pools.session(url), url)
+                batchers[url] = UpstreamBatcher(url, send,
+                                                max_size=args.upstream_batch_max_size,
+                                                linger=args.upstream_batch_linger,
+                                                loop=loop)
+        app.config.upstream_batchers = batchers
+
+    @app.listener('before_server_start')
+    def setup_upstream_health_checks(app: WebApp, loop) -> None:
+        logger = app.config.logger
+        logger.info('setup_upstream_health_checks', when='before_server_start')
+        args = app.config.args
+        upstreams = app.config.upstreams
+        policy = HealthPolicy(max_consecutive_errors=args.upstream_max_consecutive_errors,
+                              ejection_time=args.upstream_ejection_time,
+                              max_ejection_time=args.upstream_max_ejection_time,
+                              slow_start=args.upstream_slow_start,
+                              latency_outlier_factor=args.upstream_latency_outlier_factor)
+        for endpoint in upstreams.endpoints.values():
+            endpoint.policy = policy
+
+        app.config.upstream_health_checker = None
+        if args.upstream_health_check_interval:
+            checker = UpstreamHealthChecker(upstreams,
+                                            app.config.aiohttp['session'],
+                                            interval=args.upstream_health_check_interval,
+                                            timeout=args.upstream_health_check_timeout,
+                                            loop=loop)
+            checker.start()
+            app.config.upstream_health_checker = checker
+
     @app.listener('before_server_start')
     async def setup_caching(app: WebApp, loop) -> None:
         logger = app.config.logger
@@ -146,6 +232,95 @@ def setup_listeners(app: WebApp) -> WebApp:
                         prefix='jussi',
                         client=app.config.statsd_client)
 
+    @app.listener('before_server_start')
+    def setup_block_clock(app: WebApp, loop) -> None:
+        logger = app.config.logger
+        logger.info('setup_block_clock', when='before_server_start')
+        args = app.config.args
+        app.config.block_clock = None
+        if not args.block_clock_interval:
+            return
+
+        async def on_block(state) -> None:
+            app.config.last_irreversible_block_num = state.last_irreversible_block_num
+            statsd_client = app.config.statsd_client
+            if block_clock.is_leader:
+                if statsd_client:
+                    statsd_client.gauge('block_clock.head_block_num', state.head_block_num)
+                    statsd_client.gauge('block_clock.last_irreversible_block_num',
+                                        state.last_irreversible_block_num)
+                await app.config.cache_group.set('last_irreversible_block_num',
+                                                 state.last_irreversible_block_num,
+                                                 expire_time=180)
+
+        clock_kwargs = dict(interval=args.block_clock_interval,
+                            on_update=on_block,
+                            loop=loop)
+        try:
+            block_clock = BlockClock(app.config.upstreams,
+                                     app.config.aiohttp['session'],
+                                     path=args.block_clock_path,
+                                     **clock_kwargs)
+        except Exception as e:
+            logger.error('failed to open shared block clock, using a per-process clock',
+                         path=args.block_clock_path, exception=e)
+            block_clock = BlockClock(app.config.upstreams,
+                                     app.config.aiohttp['session'],
+                                     path=None,
+                                     **clock_kwargs)
+        if block_clock.last_irreversible_block_num:
+            # published by another worker on this host
+            app.config.last_irreversible_block_num = block_clock.last_irreversible_block_num
+        block_clock.start()
+        app.config.block_clock = block_clock
+
+    @app.listener('before_server_start')
+    def setup_block_prefetcher(app: WebApp, loop) -> None:
+        logger = app.config.logger
+        logger.info('setup_block_prefetcher', when='before_server_start')
+        args = app.config.args
+        app.config.block_prefetcher = None
+        if args.block_prefetch_depth:
+            app.config.block_prefetcher = BlockPrefetcher(
+                args.block_prefetch_depth,
+                min_run=args.block_prefetch_min_run,
+                client_budget=args.block_prefetch_client_budget,
+                max_in_flight=args.block_prefetch_max_in_flight,
+                loop=loop)
+
+    @app.listener('before_server_start')
+    async def setup_single_flight(app: WebApp, loop) -> None:
+        logger = app.config.logger
+        logger.info('setup_single_flight', when='before_server_start')
+        app.config.single_flight = None
+        if app.config.args.upstream_single_flight:
+            app.config.single_flight = SingleFlight(statsd_client=app.config.statsd_client)
+
+    @app.listener('before_server_start')
+    def setup_upstream_concurrency_limits(app: WebApp, loop) -> None:
+        logger = app.config.logger
+        logger.info('setup_upstream_concurrency_limits', when='before_server_start')
+        args = app.config.args
+        app.config.upstream_concurrency_limits = None
+        if args.upstream_concurrency_limit:
+            app.config.upstream_concurrency_limits = UpstreamConcurrencyLimits(
+                limit=args.upstream_concurrency_limit,
+                min_limit=min(args.upstream_concurrency_min_limit,
+                              args.upstream_concurrency_limit),
+                max_limit=max(args.upstream_concurrency_max_limit,
+                              args.upstream_concurrency_limit),
+                latency_tolerance=args.upstream_concurrency_latency_tolerance)
+
+    @app.listener('before_server_start')
+    def setup_upstream_fair_queues(app: WebApp, loop) -> None:
+        logger = app.config.logger
+        logger.info('setup_upstream_fair_queues', when='before_server_start')
+        args = app.config.args
+        app.config.upstream_fair_queues = None
+        if args.upstream_fair_queue_concurrency:
+            app.config.upstream_fair_queues = UpstreamFairQueues(
+                args.upstream_fair_queue_concurrency, loop=loop)
+
     @app.listener('after_server_stop')
     async def close_websocket_connection_pools(app: WebApp, loop) -> None:
         logger = app.config.logger
@@ -155,12 +330,30 @@ def setup_listeners(app: WebApp) -> WebApp:
             logger.info('closing websocket pool for %s', url)
             pool.terminate()
 
+    @app.listener('after_server_stop')
+    async def stop_upstream_health_checks(app: WebApp, loop) -> None:
+        logger = app.config.logger
+        logger.info('stop_upstream_health_checks', when='after_server_stop')
+        checker = app.config.upstream_health_checker
+        if checker is not None:
+            await checker.stop()
+
+    @app.listener('after_server_stop')
+    async def stop_block_clock(app: WebApp, loop) -> None:
+        logger = app.config.logger
+        logger.info('stop_block_clock', when='after_server_stop')
+        block_clock = app.config.block_clock
+        if block_clock is not None:
+            await block_clock.stop()
+            block_clock.close()
+
     @app.listener('after_server_stop')
     async def close_aiohttp_session(app: WebApp, loop) -> None:
         logger = app.config.logger
         logger.info('close_aiohttp_session', when='after_server_stop')
         session = app.config.aiohttp['session']
         await session.close()
+        await app.config.upstream_http_pools.close()
 
     @app.listener('after_server_stop')
     async def shutdown_caching(app: WebApp, loop) -> None:
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import asyncio
+from functools import partial
 from time import perf_counter as perf
+from typing import Optional
 
 
 import structlog
@@ -10,6 +12,12 @@ from sanic import response
 from ujson import loads
 
 from ..cache.cache_group import UncacheableResponse
+from ..cache.utils import NegativeResponse
+from ..cache.utils import StaleResponse
+from ..cache.utils import jsonrpc_cache_key
+from ..fan_out import fan_out_items
+from ..handlers import dispatch_single
+from ..raw_response import parsed_response
 from ..typedefs import HTTPRequest
 from ..typedefs import HTTPResponse
 from ..utils import async_nowait_middleware
@@ -22,6 +30,10 @@ async def get_response(request: HTTPRequest) -> None:
     if not request.jsonrpc:
         return
 
+    # requests cached per item are read by the handler, see jussi.fan_out
+    if request.is_single_jrpc and fan_out_items(request.jsonrpc) is not None:
+        return
+
     request.timings.append((perf(), 'get_cached_response.enter'))
     cache_group = request.app.config.cache_group
     cache_read_timeout = request.app.config.cache_read_timeout
@@ -42,6 +54,24 @@ async def get_response(request: HTTPRequest) -> None:
             cached_response = await cached_response_future
         request.timings.append((perf(), 'get_cached_response.response'))
 
+        if isinstance(cached_response, StaleResponse):
+            cached_response = stale_or_none(request, cached_response)
+
+        # null results and errors are returned as they were, without validation
+        if isinstance(cached_response, NegativeResponse):
+            jussi_cache_key = cache_group.x_jussi_cache_key(request.jsonrpc)
+            request.timings.append((perf(), 'get_cached_response.exit'))
+            return response.json(cached_response.response,
+                                 headers={'x-jussi-cache-hit': jussi_cache_key})
+
+        # encoded memory cache hits are already serialized and validated
+        if isinstance(cached_response, bytes):
+            jussi_cache_key = cache_group.x_jussi_cache_key(request.jsonrpc)
+            request.timings.append((perf(), 'get_cached_response.exit'))
+            return response.raw(cached_response,
+                                content_type='application/json',
+                                headers={'x-jussi-cache-hit': jussi_cache_key})
+
         if cached_response and \
                 cache_group.is_complete_response(request.jsonrpc, cached_response):
             jussi_cache_key = cache_group.x_jussi_cache_key(request.jsonrpc)
@@ -60,6 +90,34 @@ async def get_response(request: HTTPRequest) -> None:
     request.timings.append((perf(), 'get_cached_response.exit'))
 
 
+def stale_or_none(request: HTTPRequest, stale: StaleResponse) -> Optional[dict]:
+    """the stale response if it may be served now while it's refreshed, else keep
+    it to serve if the upstream fails"""
+    upstream = request.jsonrpc.upstream
+    if stale.age <= upstream.stale_ttl:
+        cache_group = request.app.config.cache_group
+        asyncio.ensure_future(cache_group.revalidate(jsonrpc_cache_key(request.jsonrpc),
+                                                     partial(revalidate, request)))
+        return stale.response
+    if stale.age <= upstream.stale_if_error:
+        request.stale_response = stale.response
+    return None
+
+
+async def revalidate(request: HTTPRequest) -> None:
+    try:
+        upstream_response = await dispatch_single(request, request.jsonrpc)
+        await request.app.config.cache_group.cache_single_jsonrpc_response(
+            request=request.jsonrpc,
+            response=parsed_response(upstream_response),
+            last_irreversible_block_num=request.app.config.last_irreversible_block_num)
+    except UncacheableResponse:
+        pass
+    except Exception as e:
+        logger.info('error refreshing stale response', e=e,
+                    request_id=request.jussi_request_id)
+
+
 @async_nowait_middleware
 async def cache_response(request: HTTPRequest, response: HTTPResponse) -> None:
     try:
@@ -69,7 +127,16 @@ async def cache_response(request: HTTPRequest, response: HTTPResponse) -> None:
             return
         if request.jsonrpc.upstream.ttl == -1: #don't waste time parsing response if not cacheable
             return
-        jsonrpc_response = loads(response.body)
+        if request.is_single_jrpc and fan_out_items(request.jsonrpc) is not None:
+            return
+        if request.upstream_responses is not None:
+            # parse the raw upstream responses only now that they are to be cached
+            if request.is_single_jrpc:
+                jsonrpc_response = parsed_response(request.upstream_responses)
+            else:
+                jsonrpc_response = [parsed_response(r) for r in request.upstream_responses]
+        else:
+            jsonrpc_response = loads(response.body)
         if not jsonrpc_response:
             return
         cache_group = request.app.config.cache_group
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+import structlog
+
+from ..typedefs import HTTPRequest
+from ..typedefs import HTTPResponse
+from ..utils import async_nowait_middleware
+
+logger = structlog.get_logger(__name__)
+
+
+@async_nowait_middleware
+async def prefetch_blocks(request: HTTPRequest, response: HTTPResponse) -> None:
+    if not request.jsonrpc or 'x-jussi-error-id' in response.headers:
+        return
+    block_prefetcher = request.app.config.block_prefetcher
+    if block_prefetcher is None:
+        return
+    try:
+        block_prefetcher.observe(request)
+    except Exception as e:
+        logger.error('error prefetching blocks', e=e,
+                     request=request.jussi_request_id)
@@ -22,6 +22,9 @@ async def update_last_irreversible_block_num(request: HTTPRequest, response: HTT
         if is_get_dynamic_global_properties_request(request.jsonrpc):
             jsonrpc_response = ujson.loads(response.body)
             last_irreversible_block_num = jsonrpc_response['result']['last_irreversible_block_num']
+            if last_irreversible_block_num <= request.app.config.last_irreversible_block_num:
+                # already known, eg, from the block clock
+                return
             cache_group = request.app.config.cache_group
             request.app.config.last_irreversible_block_num = last_irreversible_block_num
             await asyncio.shield(cache_group.set('last_irreversible_block_num',
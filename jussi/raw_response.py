@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Raw Upstream Responses
+----------------------
+- Upstream response bodies are kept as bytes instead of being parsed, having their
+  `id` replaced and being serialized again
+- The upstream `id` (the request's `upstream_id`) is found with an anchored match at
+  the start (`{"id":123,...`) or the end (`...,"id":123}`) of the body, the only places
+  a top level member can be found without parsing, and replaced by slicing
+- Bodies with the `id` anywhere else are parsed and serialized, the slow path
+- Batch responses are assembled by joining the raw bodies
+- The parsed response is built lazily, only when caching or validation needs it
+"""
+import re
+from typing import Any
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+import ujson
+
+from .empty import _empty
+from .typedefs import SingleJrpcResponse
+
+ID_AT_START = re.compile(rb'\A\s*\{\s*"id"\s*:\s*(-?\d+)\s*,')
+ID_AT_END = re.compile(rb',\s*"id"\s*:\s*(-?\d+)\s*\}\s*\Z')
+# ID_AT_END is only searched for in the tail of the body
+ID_AT_END_MAX_LENGTH = 64
+
+
+def encode_id(_id: Any) -> bytes:
+    return ujson.dumps(_id, ensure_ascii=False).encode()
+
+
+def find_upstream_id(body: bytes) -> Optional[Tuple[int, int, int]]:
+    """returns the upstream id in body and the span of its value, or None"""
+    match = ID_AT_START.match(body)
+    if match and body.rstrip().endswith(b'}'):
+        return int(match.group(1)), match.start(1), match.end(1)
+    tail_offset = max(len(body) - ID_AT_END_MAX_LENGTH, 0)
+    match = ID_AT_END.search(body, tail_offset)
+    if match:
+        return int(match.group(1)), match.start(1), match.end(1)
+    return None
+
+
+class RawJsonRpcResponse:
+    """a single jsonrpc response kept as the bytes received from upstream"""
+    __slots__ = ('body', 'upstream_id', '_id_span', '_parsed')
+
+    def __init__(self, body: bytes, upstream_id: Any=None,
+                 id_span: Tuple[int, int]=None,
+                 parsed: SingleJrpcResponse=None) -> None:
+        self.body = body
+        self.upstream_id = upstream_id
+        self._id_span = id_span
+        self._parsed = parsed
+
+    @classmethod
+    def from_upstream(cls, body: Union[bytes, str], _id: Any) -> 'RawJsonRpcResponse':
+        """replace the upstream id in body with the client's request id"""
+        if isinstance(body, str):
+            body = body.encode()
+        found = find_upstream_id(body)
+        if found is None:
+            # slow path
+            parsed = ujson.loads(body)
+            return cls(body, upstream_id=parsed.get('id'), parsed=parsed).with_id(_id)
+        upstream_id, start, end = found
+        return cls(body, upstream_id=upstream_id, id_span=(start, end)).with_id(_id)
+
+    def with_id(self, _id: Any) -> 'RawJsonRpcResponse':
+        if _id is _empty:
+            parsed = dict(self.parsed)
+            parsed.pop('id', None)
+            return self._reencoded(parsed)
+        if self._id_span is None:
+            return self._reencoded(dict(self.parsed, id=_id))
+        start, end = self._id_span
+        encoded_id = encode_id(_id)
+        body = b''.join((self.body[:start], encoded_id, self.body[end:]))
+        return RawJsonRpcResponse(body, upstream_id=self.upstream_id,
+                                  id_span=(start, start + len(encoded_id)))
+
+    def _reencoded(self, parsed: SingleJrpcResponse) -> 'RawJsonRpcResponse':
+        return RawJsonRpcResponse(ujson.dumps(parsed, ensure_ascii=False).encode(),
+                                  upstream_id=self.upstream_id, parsed=parsed)
+
+    @property
+    def parsed(self) -> SingleJrpcResponse:
+        if self._parsed is None:
+            self._parsed = ujson.loads(self.body)
+        return self._parsed
+
+    # dict-like read access to the parsed response
+    def __getitem__(self, key: str) -> Any:
+        return self.parsed[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.parsed
+
+    def get(self, key: str, default: Any=None) -> Any:
+        return self.parsed.get(key, default)
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, RawJsonRpcResponse):
+            other = other.parsed
+        return self.parsed == other
+
+    def __repr__(self) -> str:
+        return f'RawJsonRpcResponse({self.body[:100]!r})'
+
+
+Response = Union[RawJsonRpcResponse, SingleJrpcResponse]
+
+
+def with_id(response: Response, _id: Any) -> Response:
+    if isinstance(response, RawJsonRpcResponse):
+        return response.with_id(_id)
+    return {**response, 'id': _id}
+
+
+def parsed_response(response: Response) -> SingleJrpcResponse:
+    if isinstance(response, RawJsonRpcResponse):
+        return response.parsed
+    return response
+
+
+def encode_response(response: Response) -> bytes:
+    if isinstance(response, RawJsonRpcResponse):
+        return response.body
+    return ujson.dumps(response, ensure_ascii=False).encode()
+
+
+def encode_batch_response(responses: List[Response]) -> bytes:
+    return b''.join((b'[', b','.join(encode_response(r) for r in responses), b']'))
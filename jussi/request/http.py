@@ -45,7 +45,7 @@ class HTTPRequest:
         'body', '_parsed_json', '_parsed_jsonrpc',
         '_ip', '_parsed_url', 'uri_template', 'stream',
         '_socket', '_port', 'timings', '_log', 'is_batch_jrpc',
-        'is_single_jrpc'
+        'is_single_jrpc', 'upstream_responses', 'stale_response'
     )
 
     def __init__(self, url_bytes: bytes, headers: dict,
@@ -66,6 +66,9 @@ class HTTPRequest:
         self.stream = None
         self.is_batch_jrpc = False
         self.is_single_jrpc = False
+        self.upstream_responses = None
+        # a cached response past its ttl, served if the upstream fails
+        self.stale_response = None
 
         self.timings = [(perf_counter(), 'http_create')]
         self._log = _empty
@@ -117,6 +120,15 @@ class HTTPRequest:
             self._get_address()
         return self._ip
 
+    @property
+    def client_ip(self) -> str:
+        """the ip our load balancer saw, the last x-forwarded-for entry, as the
+        earlier entries are set by the client"""
+        forwarded_for = self.headers.get('x-forwarded-for')
+        if forwarded_for:
+            return forwarded_for.rsplit(',', 1)[-1].strip()
+        return self.ip
+
     @property
     def port(self):
         if not hasattr(self, '_socket'):
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Single-flight Upstream Requests
+-------------------------------
+- Concurrent identical cacheable requests (same `jsonrpc_cache_key`) share one
+  upstream request instead of each going upstream, eg, hundreds of clients asking
+  for the same `get_block` just after it was produced
+- The first request (the leader) starts a shared task, requests arriving while it
+  is in flight wait on it and receive a copy of its response with their own `id`
+- The shared task is shielded from the cancellation of any one waiter, and is
+  bounded by the leader's request timeout
+- Uncacheable and non-idempotent requests are never coalesced
+"""
+import asyncio
+from typing import Callable
+from typing import Coroutine
+from typing import Dict
+
+import structlog
+from async_timeout import timeout
+
+from .cache.ttl import TTL
+from .cache.utils import jsonrpc_cache_key
+from .raw_response import with_id
+from .typedefs import SingleJrpcRequest
+from .typedefs import SingleJrpcResponse
+from .validators import is_idempotent_request
+
+logger = structlog.get_logger(__name__)
+
+
+def is_coalescable_request(request: SingleJrpcRequest) -> bool:
+    return request.upstream.ttl != TTL.NO_CACHE and is_idempotent_request(request)
+
+
+class SingleFlight:
+    """in-flight table of upstream requests keyed by jsonrpc cache key"""
+    __slots__ = ('_in_flight', '_statsd_client', 'leaders', 'coalesced')
+
+    def __init__(self, statsd_client=None) -> None:
+        self._in_flight = dict()  # type: Dict[str, asyncio.Future]
+        self._statsd_client = statsd_client
+        self.leaders = 0
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+    async def fetch(self,
+                    request: SingleJrpcRequest,
+                    fetch: Callable[[], Coroutine],
+                    request_timeout: float=None) -> SingleJrpcResponse:
+        if not is_coalescable_request(request):
+            return await fetch()
+        key = jsonrpc_cache_key(request)
+        shared = self._in_flight.get(key)
+        if shared is not None:
+            self.coalesced += 1
+            if self._statsd_client:
+                self._statsd_client.incr('jrpc.coalesced')
+            response = await asyncio.shield(shared)
+            return with_id(response, request.id)
+
+        self.leaders += 1
+        shared = asyncio.ensure_future(self._fetch_shared(fetch, request_timeout))
+        self._in_flight[key] = shared
+        shared.add_done_callback(lambda f: self._forget(key, f))
+        return await asyncio.shield(shared)
+
+    @staticmethod
+    async def _fetch_shared(fetch: Callable[[], Coroutine],
+                            request_timeout: float=None) -> SingleJrpcResponse:
+        async with timeout(request_timeout):
+            return await fetch()
+
+    def _forget(self, key: str, shared: asyncio.Future) -> None:
+        if self._in_flight.get(key) is shared:
+            del self._in_flight[key]
+        # retrieve the exception so it is not logged as never retrieved when
+        # every waiter was cancelled
+        if not shared.cancelled():
+            shared.exception()
+
+    def to_dict(self) -> dict:
+        return {
+            'in_flight': len(self._in_flight),
+            'leaders': self.leaders,
+            'coalesced': self.coalesced
+        }
@@ -6,6 +6,8 @@ import os
 import re
 import socket
 from typing import NamedTuple
+from typing import Optional
+from typing import Union
 from urllib.parse import urlparse
 
 import jsonschema
@@ -13,8 +15,13 @@ import pygtrie
 import structlog
 import ujson
 
+from .balancer import DEFAULT_STRATEGY
+from .balancer import Balancer
+from .balancer import build_balancer
+from .balancer import normalize_weighted_urls
 from .errors import InvalidUpstreamHost
 from .errors import InvalidUpstreamURL
+from .fair_queue import DEFAULT_PRIORITY
 
 logger = structlog.get_logger(__name__)
 
@@ -32,6 +39,39 @@ ACCOUNT_TRANSFER_PATTERN = re.compile(r'^\/?(@([^\/\s]+)/transfers|~?witnesses|p
 # -------------------
 #  RETRIES
 #  NO RETRIES: 0
+#  broadcast methods are never retried
+# -------------------
+#  HEDGE_AFTER_MS
+#  NO HEDGING: 0
+#  minimum delay before a duplicate request is sent to another upstream url,
+#  the delay follows the upstream url's observed p95 latency above it
+# -------------------
+#  STALE_TTLS
+#  NO STALE RESPONSES: 0
+#  seconds past its ttl a cached response is still served, while one request
+#  refreshes it in the background
+# -------------------
+#  STALE_IF_ERROR_TTLS
+#  NO STALE RESPONSES: 0
+#  seconds past its ttl a cached response is served if the upstream fails
+# -------------------
+#  PRIORITIES
+#  critical | high | normal | low | bulk, the default is normal
+#  when an upstream url is busy, waiting requests are served in weighted fair order,
+#  see jussi.fair_queue
+# -------------------
+#  FAN_OUTS
+#  {"param": <index or name of the list of items in the params>,
+#   "key": <optional, the field of each result entry holding its item>,
+#   "result": <optional, the name of the list of results in the result>}
+#  requests for several items are cached per item, see jussi.fan_out
+# -------------------
+#  URLS
+#  a single url, a list of urls or a list of [url, weight] pairs
+#  BALANCER: round_robin | least_outstanding_requests | power_of_two_choices
+# -------------------
+#  HEALTH_CHECK
+#  {"method": <jsonrpc method>, "params": <params>} or {"path": <http GET path>}
 # -------------------
 
 
@@ -46,8 +86,16 @@ class _Upstreams(object):
     """Maps and converts incoming requests to calls to upstream servers based on name(spaces) in jusii config file"""
     __NAMESPACES = None
     __URLS = None
+    __BALANCERS = None
+    __ENDPOINTS = None
+    __HEALTH_CHECKS = None
     __TTLS = None
     __TIMEOUTS = None
+    __RETRIES = None
+    __HEDGE_AFTER_MS = None
+    __STALE_TTLS = None
+    __STALE_IF_ERROR_TTLS = None
+    __PRIORITIES = None
     __TRANSLATE_TO_APPBASE = None
 
     def __init__(self, config, validate=True):
@@ -64,9 +112,17 @@ class _Upstreams(object):
             assert not namespace == 'jsonrpc',\
                 f'Invalid namespace {namespace} : Namespace "jsonrpc" is not allowed'
 
-        self.__URLS = self.__build_trie('urls')
+        self.__ENDPOINTS = dict()
+        self.__HEALTH_CHECKS = dict()
+        self.__URLS, self.__BALANCERS = self.__build_url_tries()
         self.__TTLS = self.__build_trie('ttls')
         self.__TIMEOUTS = self.__build_trie('timeouts')
+        self.__RETRIES = self.__build_trie('retries')
+        self.__HEDGE_AFTER_MS = self.__build_trie('hedge_after_ms')
+        self.__STALE_TTLS = self.__build_trie('stale_ttls')
+        self.__STALE_IF_ERROR_TTLS = self.__build_trie('stale_if_error_ttls')
+        self.__PRIORITIES = self.__build_trie('priorities')
+        self.__FAN_OUTS = self.__build_trie('fan_outs')
 
         self.__TRANSLATE_TO_APPBASE = frozenset(
             c['name'] for c in self.config if c.get('translate_to_appbase', False) is True)
@@ -77,7 +133,7 @@ class _Upstreams(object):
     def __build_trie(self, key):
         """builds a searchable trie by parsing a subset of config file specified by key"""
         trie = pygtrie.StringTrie(separator='.')
-        for item in it.chain.from_iterable(c[key] for c in self.config):
+        for item in it.chain.from_iterable(c.get(key, []) for c in self.config):
             if isinstance(item, list):
                 prefix, value = item
             else:
@@ -89,6 +145,30 @@ class _Upstreams(object):
             trie[prefix] = value
         return trie
 
+    def __build_url_tries(self):
+        """builds url and balancer tries, one balancer per configured group of urls"""
+        url_trie = pygtrie.StringTrie(separator='.')
+        balancer_trie = pygtrie.StringTrie(separator='.')
+        balancers = dict()
+        for upstream in self.config:
+            strategy = upstream.get('balancer', DEFAULT_STRATEGY)
+            health_check = upstream.get('health_check', dict())
+            for item in upstream['urls']:
+                if isinstance(item, list):
+                    prefix, value = item
+                else:
+                    prefix = item['prefix']
+                    value = item['upstream_url']
+                weighted_urls = normalize_weighted_urls(value)
+                for url, _ in weighted_urls:
+                    self.__HEALTH_CHECKS.setdefault(url, health_check)
+                if (strategy, weighted_urls) not in balancers:
+                    balancers[(strategy, weighted_urls)] = build_balancer(
+                        weighted_urls, self.__ENDPOINTS, strategy=strategy)
+                url_trie[prefix] = weighted_urls
+                balancer_trie[prefix] = balancers[(strategy, weighted_urls)]
+        return url_trie, balancer_trie
+
     @functools.lru_cache(8192)
     def url(self, request_urn) -> str:
         """return url for upstream server based on request_urn and URLS trie in config file"""
@@ -102,18 +182,25 @@ class _Upstreams(object):
             if url:
                 return url
 
-        _, url = self.__URLS.longest_prefix(str(request_urn))
-        #if request_urn.method == 'broadcast_transaction_synchronous':
-        #    if not url:
-        #        logger.error('***** no url for %s', str(request_urn))
-        #    else:
-        #        logger.warning('>>>>> %s to %s', str(request_urn), url)
-        if not url:
+        _, weighted_urls = self.__URLS.longest_prefix(str(request_urn))
+        if not weighted_urls:
             raise InvalidUpstreamURL(
-                url=url, reason='No matching url found', urn=str(request_urn))
-        elif url.startswith('ws') or url.startswith('http'):
-            return url
-        raise InvalidUpstreamURL(url=url, reason='invalid format', urn=str(request_urn))
+                url=weighted_urls, reason='No matching url found', urn=str(request_urn))
+        for url, _ in weighted_urls:
+            if not (url.startswith('ws') or url.startswith('http')):
+                raise InvalidUpstreamURL(url=url, reason='invalid format', urn=str(request_urn))
+        # the first configured url is the primary url
+        return weighted_urls[0][0]
+
+    @functools.lru_cache(8192)
+    def balancer(self, request_urn) -> Balancer:
+        """return the balancer for the upstream urls matching request_urn"""
+        url = self.url(request_urn)
+        _, balancer = self.__BALANCERS.longest_prefix(str(request_urn))
+        if balancer is None or url not in balancer.urls:
+            # url was overridden, eg, JUSSI_ACCOUNT_TRANSFER_STEEMD_URL
+            return build_balancer(((url, 1),), self.__ENDPOINTS)
+        return balancer
 
     @functools.lru_cache(8192)
     def ttl(self, request_urn) -> int:
@@ -127,10 +214,57 @@ class _Upstreams(object):
             timeout = None
         return timeout
 
+    @functools.lru_cache(8192)
+    def retries(self, request_urn) -> int:
+        _, retries = self.__RETRIES.longest_prefix(str(request_urn))
+        return retries or 0
+
+    @functools.lru_cache(8192)
+    def hedge_after_ms(self, request_urn) -> int:
+        _, hedge_after_ms = self.__HEDGE_AFTER_MS.longest_prefix(str(request_urn))
+        return hedge_after_ms or 0
+
+    @functools.lru_cache(8192)
+    def stale_ttl(self, request_urn) -> int:
+        _, stale_ttl = self.__STALE_TTLS.longest_prefix(str(request_urn))
+        return stale_ttl or 0
+
+    @functools.lru_cache(8192)
+    def stale_if_error(self, request_urn) -> int:
+        _, stale_if_error = self.__STALE_IF_ERROR_TTLS.longest_prefix(str(request_urn))
+        return stale_if_error or 0
+
+    @functools.lru_cache(8192)
+    def priority(self, request_urn) -> str:
+        _, priority = self.__PRIORITIES.longest_prefix(str(request_urn))
+        return priority or DEFAULT_PRIORITY
+
+    @functools.lru_cache(8192)
+    def fan_out(self, request_urn) -> Optional['FanOut']:
+        _, fan_out = self.__FAN_OUTS.longest_prefix(str(request_urn))
+        if not fan_out:
+            return None
+        return FanOut(fan_out['param'], fan_out.get('key'), fan_out.get('result'))
+
     @property
     def urls(self) -> frozenset:
         """return a set of all defined upstream urls from config file"""
-        return frozenset(u for u in self.__URLS.values())
+        return frozenset(url for weighted_urls in self.__URLS.values()
+                         for url, _ in weighted_urls)
+
+    @property
+    def endpoints(self) -> dict:
+        """return a dict of url: UpstreamEndpoint for all upstream urls"""
+        return self.__ENDPOINTS
+
+    @property
+    def balancers(self) -> frozenset:
+        """return a set of all configured balancers"""
+        return frozenset(self.__BALANCERS.values())
+
+    def health_check(self, url: str) -> dict:
+        """return the health_check config of the upstream which defines url"""
+        return self.__HEALTH_CHECKS.get(url, dict())
 
     @property
     def namespaces(self)-> frozenset:
@@ -158,15 +292,35 @@ class _Upstreams(object):
         return self.__hash
 
 
+class FanOut(NamedTuple):
+    param: Union[int, str]
+    key: Optional[str]
+    result: Optional[str]
+
+
 class Upstream(NamedTuple):
     url: str
     ttl: int
     timeout: int
+    balancer: Balancer
+    retries: int
+    hedge_after_ms: int
+    priority: str
+    stale_ttl: int
+    stale_if_error: int
+    fan_out: Optional[FanOut]
 
     @classmethod
     @functools.lru_cache(4096)
     def from_urn(cls, urn, upstreams: _Upstreams=None):
-        """lookup upstream server url, time-to-live in cache, and timeout for a urn request based on config file"""
+        """lookup upstream server url, time-to-live in cache, timeout and retry settings for a urn request based on config file"""
         return Upstream(upstreams.url(urn),
                         upstreams.ttl(urn),
-                        upstreams.timeout(urn))
+                        upstreams.timeout(urn),
+                        upstreams.balancer(urn),
+                        upstreams.retries(urn),
+                        upstreams.hedge_after_ms(urn),
+                        upstreams.priority(urn),
+                        upstreams.stale_ttl(urn),
+                        upstreams.stale_if_error(urn),
+                        upstreams.fan_out(urn))
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Upstream JSON-RPC Batching
+--------------------------
+- Requests to the same upstream url, from one client batch or from concurrent
+  clients, are collected and sent upstream as a single jsonrpc batch
+- A batch is sent `linger` seconds after its first request, or as soon as it holds
+  `max_size` requests, whichever comes first
+- Each request in an upstream batch gets its position in the batch as its id, so
+  responses are matched to requests even if clients sent colliding
+  `x-jussi-request-id`s, and each response gets its client's id back
+- If the batch call fails, every request in it fails (and may be retried on its own)
+- Http batches carry the trace headers of their first request, plus every
+  request's `x-jussi-request-id` in `x-jussi-batch-request-ids`, so upstream logs
+  can be joined to each client request
+- Non-idempotent requests are never batched
+"""
+import asyncio
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import structlog
+import ujson
+
+from .errors import UpstreamResponseError
+from .typedefs import SingleJrpcRequest
+from .typedefs import SingleJrpcResponse
+from .ws.mux import MultiplexedPool
+
+logger = structlog.get_logger(__name__)
+
+UPSTREAM_BATCH_MAX_SIZE = 50
+
+BatchSender = Callable[..., Awaitable[List[dict]]]
+
+
+def batch_headers(requests: List[SingleJrpcRequest]) -> Dict[str, str]:
+    """upstream headers for a batch, the first request's plus all request ids"""
+    headers = dict(requests[0].upstream_headers)
+    request_ids = []  # type: List[str]
+    for request in requests:
+        # requests from one client batch share a request id
+        request_id = str(request.jussi_request_id)
+        if request_id not in request_ids:
+            request_ids.append(request_id)
+    headers['x-jussi-batch-request-ids'] = ','.join(request_ids)
+    return headers
+
+
+def http_batch_sender(session, url: str) -> BatchSender:
+    async def send(batch: List[dict], headers: Dict[str, str]=None) -> List[dict]:
+        async with session.post(url, json=batch, headers=headers) as resp:
+            return await resp.json(encoding='utf-8', content_type=None)
+    return send
+
+
+def ws_batch_sender(pool) -> BatchSender:
+    # websocket messages have no headers
+    if isinstance(pool, MultiplexedPool):
+        async def send_multiplexed(batch: List[dict],
+                                   headers: Dict[str, str]=None) -> List[dict]:
+            return await pool.request_batch(batch)
+        return send_multiplexed
+
+    async def send(batch: List[dict], headers: Dict[str, str]=None) -> List[dict]:
+        conn = await pool.acquire()
+        try:
+            await conn.send(ujson.dumps(batch, ensure_ascii=False))
+            response = await conn.recv()
+        except BaseException:
+            conn.terminate()
+            raise
+        await pool.release(conn)
+        return ujson.loads(response)
+    return send
+
+
+class UpstreamBatcher:
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, url: str, send: BatchSender, max_size: int=None,
+                 linger: float=0.002, loop=None) -> None:
+        self.url = url
+        self._send = send
+        self._max_size = max_size or UPSTREAM_BATCH_MAX_SIZE
+        self._linger = linger
+        self._loop = loop or asyncio.get_event_loop()
+        self._pending = []  # type: List[Tuple[SingleJrpcRequest, asyncio.Future]]
+        self._timer = None  # type: Optional[asyncio.Handle]
+        self.batches = 0
+        self.requests = 0
+
+    async def fetch(self, request: SingleJrpcRequest) -> SingleJrpcResponse:
+        future = self._loop.create_future()
+        self._pending.append((request, future))
+        self.requests += 1
+        if len(self._pending) >= self._max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = self._loop.call_later(self._linger, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch = [(request, future) for request, future in self._pending
+                 if not future.done()]
+        self._pending = []
+        if batch:
+            self._loop.create_task(self._send_batch(batch))
+
+    async def _send_batch(self, batch: List[Tuple[SingleJrpcRequest, asyncio.Future]]) -> None:
+        self.batches += 1
+        upstream_batch = []
+        for i, (request, _) in enumerate(batch):
+            upstream_request = request.to_upstream_request(as_json=False)
+            upstream_request['id'] = i
+            upstream_batch.append(upstream_request)
+        try:
+            responses = await self._send(upstream_batch,
+                                         batch_headers([request for request, _ in batch]))
+            if not isinstance(responses, list):
+                raise ValueError(f'expected a batch response, got {type(responses)}')
+        except Exception as e:
+            logger.info('upstream batch error', url=self.url, size=len(batch), e=e)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        responses_by_id = {response.get('id'): response for response in responses
+                           if isinstance(response, dict)}
+        for i, (request, future) in enumerate(batch):
+            if future.done():
+                continue
+            response = responses_by_id.get(i)
+            if response is None:
+                future.set_exception(UpstreamResponseError(jrpc_request=request,
+                                                           reason='missing from batch response',
+                                                           url=self.url))
+                continue
+            response['id'] = request.id
+            future.set_result(response)
+
+    def to_dict(self) -> dict:
+        return {
+            'url': self.url,
+            'batches': self.batches,
+            'requests': self.requests,
+            'pending': len(self._pending)
+        }
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Active Upstream Health Checks
+-----------------------------
+- Every `interval` seconds each upstream url is probed, failures eject the url's
+  `UpstreamEndpoint` and successes reinstate it, if it was ejected by a failed
+  probe (see jussi.balancer)
+- The default probe is a `condenser_api.get_dynamic_global_properties` jsonrpc call,
+  any well formed jsonrpc response (even an error) counts as healthy
+- An upstream may override the probe with a `health_check` config key:
+  - `{"method": "hive.db_head_state", "params": {}}` for a different jsonrpc call
+  - `{"path": "/health"}` for an http GET which must return status 200
+- Websocket urls are probed over a dedicated connection, not the request pool
+- After each round of probes, latency outliers are ejected from each balancer
+"""
+import asyncio
+from typing import Optional
+from urllib.parse import urljoin
+
+import structlog
+import ujson
+from async_timeout import timeout
+# pylint: disable=no-name-in-module
+from websockets import connect as websockets_connect
+
+from .balancer import UpstreamEndpoint
+
+# pylint: enable=no-name-in-module
+
+logger = structlog.get_logger(__name__)
+
+DEFAULT_HEALTH_CHECK_METHOD = 'condenser_api.get_dynamic_global_properties'
+HEALTH_CHECK_REQUEST_ID = 0
+
+
+def health_check_request(health_check: dict) -> str:
+    request = {
+        'id': HEALTH_CHECK_REQUEST_ID,
+        'jsonrpc': '2.0',
+        'method': health_check.get('method', DEFAULT_HEALTH_CHECK_METHOD)
+    }
+    if 'params' in health_check:
+        request['params'] = health_check['params']
+    return ujson.dumps(request, ensure_ascii=False)
+
+
+def is_healthy_response(response: bytes) -> bool:
+    try:
+        parsed = ujson.loads(response)
+        return isinstance(parsed, dict) and ('result' in parsed or 'error' in parsed)
+    except Exception:
+        return False
+
+
+class UpstreamHealthChecker:
+    """periodically probes every upstream url and updates its endpoint health"""
+
+    def __init__(self, upstreams, session, interval: float, timeout: float,
+                 loop=None) -> None:
+        self._upstreams = upstreams
+        self._session = session
+        self._interval = interval
+        self._timeout = timeout
+        self._loop = loop or asyncio.get_event_loop()
+        self._ws_conns = dict()
+        self._task = None  # type: Optional[asyncio.Task]
+
+    def start(self) -> None:
+        self._task = self._loop.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        for conn in self._ws_conns.values():
+            await conn.close()
+        self._ws_conns = dict()
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.check_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error('upstream health check error', e=e)
+            await asyncio.sleep(self._interval)
+
+    async def check_all(self) -> None:
+        endpoints = list(self._upstreams.endpoints.values())
+        results = await asyncio.gather(*[self.check(endpoint) for endpoint in endpoints])
+        for endpoint, healthy in zip(endpoints, results):
+            endpoint.on_health_check(healthy)
+        for balancer in self._upstreams.balancers:
+            balancer.eject_latency_outliers()
+
+    async def check(self, endpoint: UpstreamEndpoint) -> bool:
+        health_check = self._upstreams.health_check(endpoint.url)
+        try:
+            async with timeout(self._timeout):
+                if endpoint.url.startswith('ws'):
+                    return await self._check_ws(endpoint.url, health_check)
+                return await self._check_http(endpoint.url, health_check)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info('upstream health check failed', url=endpoint.url, e=e)
+            self._drop_ws_conn(endpoint.url)
+        return False
+
+    async def _check_http(self, url: str, health_check: dict) -> bool:
+        if 'path' in health_check:
+            async with self._session.get(urljoin(url, health_check['path'])) as resp:
+                return resp.status == 200
+        async with self._session.post(url, data=health_check_request(health_check)) as resp:
+            return is_healthy_response(await resp.read())
+
+    async def _check_ws(self, url: str, health_check: dict) -> bool:
+        conn = self._ws_conns.get(url)
+        if conn is None or not conn.open:
+            conn = await websockets_connect(url, loop=self._loop)
+            self._ws_conns[url] = conn
+        await conn.send(health_check_request(health_check))
+        return is_healthy_response(await conn.recv())
+
+    def _drop_ws_conn(self, url: str) -> None:
+        conn = self._ws_conns.pop(url, None)
+        if conn is not None:
+            conn.fail_connection()
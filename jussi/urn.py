@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 import functools
 import re
+from hashlib import blake2b
 import reprlib
 from typing import Dict
+from typing import Optional
+from typing import Tuple
 from typing import TypeVar
 from typing import Union
 
@@ -31,9 +34,16 @@ ParsedRequestDict = Dict[str, Union[str, float, int, list, dict, Empty]]
 
 FIELD_KEYS = ('namespace', 'api', 'method', 'params')
 
+# part of every cache key, bump it when the key format changes, cached values under
+# the old keys are no longer read and expire or are evicted
+CACHE_KEY_VERSION = 1
+# longer params are replaced in cache keys by their blake2b digest
+CACHE_KEY_MAX_PARAMS_LENGTH = 32
+CACHE_KEY_DIGEST_SIZE = 16
+
 
 class URN:
-    __slots__ = ('namespace', 'api', 'method', 'params', '__cached_str')
+    __slots__ = ('namespace', 'api', 'method', 'params', '__cached_str', '__cached_key')
 
     def __init__(self, namespace: str, api: APIType, method: str, params: ParamsType) -> None:
         self.namespace = namespace
@@ -41,6 +51,7 @@ class URN:
         self.method = method
         self.params = params
         self.__cached_str = None
+        self.__cached_key = None
 
     def __repr__(self) -> str:
         return f'URN(namespace={self.namespace}, api={self.api}, method={self.method}, params={reprlib.repr(self.params)})'
@@ -63,6 +74,38 @@ class URN:
                 params) if p is not _empty)
         return self.__cached_str
 
+    def cache_key(self) -> str:
+        """`namespace.api.method.v1`, followed by `=params` as canonical json, or by
+        `:digest` of the canonical json if it's longer than CACHE_KEY_MAX_PARAMS_LENGTH.
+        Long params starting with a block num are `=block_num:digest` of the others"""
+        if self.__cached_key:
+            return self.__cached_key
+        api = self.api
+        if api is not _empty:
+            api = str(self.api)
+        key = '.'.join(
+            p for p in (
+                self.namespace,
+                api,
+                self.method,
+                f'v{CACHE_KEY_VERSION}') if p is not _empty)
+        if self.params is not _empty:
+            params = ujson.dumps(self.params, ensure_ascii=False, sort_keys=True)
+            block_num, other_params = _split_block_num(self.params)
+            if len(params) <= CACHE_KEY_MAX_PARAMS_LENGTH:
+                key = f'{key}={params}'
+            elif block_num is None:
+                digest = blake2b(params.encode(), digest_size=CACHE_KEY_DIGEST_SIZE)
+                key = f'{key}:{digest.hexdigest()}'
+            else:
+                # the block num is kept, so the key can still be stored by block num,
+                # see jussi.cache.backends.block_store
+                other_params = ujson.dumps(other_params, ensure_ascii=False, sort_keys=True)
+                digest = blake2b(other_params.encode(), digest_size=CACHE_KEY_DIGEST_SIZE)
+                key = f'{key}={block_num}:{digest.hexdigest()}'
+        self.__cached_key = key
+        return key
+
     def to_dict(self) -> dict:
         return {
             'namespace': self.namespace,
@@ -75,7 +118,18 @@ class URN:
         return hash(str(self))
 
     def __eq__(self, urn) -> bool:
-        return hash(urn) == hash(self)
+        if isinstance(urn, (URN, str)):
+            return str(urn) == str(self)
+        return NotImplemented
+
+
+def _split_block_num(params: ParamsType) -> Tuple[Optional[int], ParamsType]:
+    """the block num params start with, if any, and the rest of params"""
+    if isinstance(params, list) and params and type(params[0]) is int:
+        return params[0], params[1:]
+    if isinstance(params, dict) and type(params.get('block_num')) is int:
+        return params['block_num'], {k: v for k, v in params.items() if k != 'block_num'}
+    return None, params
 
 
 @functools.lru_cache(8192)
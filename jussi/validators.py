@@ -42,6 +42,9 @@ BROADCAST_TRANSACTION_METHODS = {
     'broadcast_transaction_synchronous'
 }
 
+NON_IDEMPOTENT_METHODS = BROADCAST_TRANSACTION_METHODS | {'broadcast_block'}
+NON_IDEMPOTENT_APIS = {'network_broadcast_api'}
+
 
 #
 # validate_* methods raise on invalid input
@@ -120,6 +123,11 @@ def is_get_block_header_request(request: JSONRPCRequest) -> bool:
         'hived', 'appbase') and request.urn.method == 'get_block_header'
 
 
+def is_get_ops_in_block_request(request: JSONRPCRequest) -> bool:
+    return request.urn.namespace in (
+        'hived', 'appbase') and request.urn.method == 'get_ops_in_block'
+
+
 def is_get_dynamic_global_properties_request(request: JSONRPCRequest) -> bool:
     return request.urn.namespace in (
         'hived', 'appbase') and request.urn.method == 'get_dynamic_global_properties'
@@ -175,6 +183,12 @@ def is_broadcast_transaction_request(request: JSONRPCRequest) -> bool:
     return request.urn.method in BROADCAST_TRANSACTION_METHODS
 
 
+def is_idempotent_request(request: JSONRPCRequest) -> bool:
+    """True if sending the request more than once upstream is harmless"""
+    return request.urn.method not in NON_IDEMPOTENT_METHODS and \
+        request.urn.api not in NON_IDEMPOTENT_APIS
+
+
 def limit_broadcast_transaction_request(request: JSONRPCRequest, limits=None) -> NoReturn:
     if is_broadcast_transaction_request(request):
         if isinstance(request.urn.params, list):
@@ -221,4 +235,4 @@ def block_num_from_id(block_hash: str) -> int:
 
 
 def jsonrpc_cache_key(request: JSONRPCRequest) -> str:
-    return str(request.urn)
+    return request.urn.cache_key()
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Multiplexed Websocket Connections
+---------------------------------
+- Each connection carries many outstanding requests, a slow request doesn't hold a
+  connection for its whole round trip
+- Requests get an id unique to their connection, and a reader task routes each
+  response to its request's future by that id
+- Batch requests get one id per item, their response is routed by the first of its
+  ids which is pending, and the batch's own ids are restored. Entries without one of
+  the batch's ids, eg, an error with a null id, are left as they are
+- A request which times out is forgotten, its late response is dropped
+- When a connection closes, every request waiting on it fails and the next request
+  reconnects
+- Requests go to the connection with the fewest outstanding requests
+"""
+import asyncio
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import structlog
+import ujson
+# pylint: disable=no-name-in-module
+from websockets import WebSocketClientProtocol as WSConn
+from websockets import connect as websockets_connect
+from websockets.exceptions import ConnectionClosed
+
+from ..raw_response import find_upstream_id
+
+# pylint: enable=no-name-in-module
+logger = structlog.get_logger(__name__)
+
+# future, first id of its batch, the batch's own ids
+PendingRequest = Tuple[asyncio.Future, int, Optional[List[Any]]]
+
+
+# pylint: disable=protected-access
+class MultiplexedConnection:
+    __slots__ = ('_pool',
+                 '_con',
+                 '_connecting',
+                 '_reader',
+                 '_pending',
+                 '_next_id',
+                 '_outstanding',
+                 'requests')
+
+    def __init__(self, pool: 'MultiplexedPool') -> None:
+        self._pool = pool
+        self._con = None  # type: WSConn
+        self._connecting = None  # type: asyncio.Task
+        self._reader = None  # type: asyncio.Task
+        self._pending = dict()  # type: Dict[int, PendingRequest]
+        self._next_id = 1
+        self._outstanding = 0
+        self.requests = 0
+
+    def __len__(self) -> int:
+        # includes requests waiting for the connection to open
+        return self._outstanding
+
+    @property
+    def open(self) -> bool:
+        return self._con is not None and self._con.open
+
+    async def connect(self) -> None:
+        if self.open:
+            return
+        if self._connecting is None:
+            self._connecting = self._pool._loop.create_task(self._connect())
+        await asyncio.shield(self._connecting)
+
+    async def _connect(self) -> None:
+        try:
+            con = await self._pool._get_new_connection()
+            self._con = con
+            self._reader = self._pool._loop.create_task(self._read(con))
+        finally:
+            self._connecting = None
+
+    def _ids(self, count: int) -> int:
+        first_id = self._next_id
+        self._next_id += count
+        return first_id
+
+    async def request(self, upstream_request: dict, timeout: float=None) -> bytes:
+        """send a single request, returning the raw response with this connection's id"""
+        self._outstanding += 1
+        try:
+            await self.connect()
+            _id = self._ids(1)
+            future = self._pool._loop.create_future()
+            self._pending[_id] = (future, _id, None)
+            self.requests += 1
+            try:
+                await self._con.send(ujson.dumps(dict(upstream_request, id=_id),
+                                                 ensure_ascii=False))
+                return await asyncio.wait_for(future, timeout)
+            finally:
+                self._pending.pop(_id, None)
+        finally:
+            self._outstanding -= 1
+
+    async def request_batch(self, batch: List[dict], timeout: float=None) -> List[dict]:
+        """send a batch request, returning the parsed responses with the batch's own ids"""
+        self._outstanding += 1
+        try:
+            await self.connect()
+            first_id = self._ids(len(batch))
+            ids = list(range(first_id, first_id + len(batch)))
+            future = self._pool._loop.create_future()
+            batch_ids = [r.get('id') for r in batch]
+            for _id in ids:
+                self._pending[_id] = (future, first_id, batch_ids)
+            self.requests += 1
+            try:
+                await self._con.send(ujson.dumps([dict(r, id=_id) for r, _id in zip(batch, ids)],
+                                                 ensure_ascii=False))
+                return await asyncio.wait_for(future, timeout)
+            finally:
+                for _id in ids:
+                    self._pending.pop(_id, None)
+        finally:
+            self._outstanding -= 1
+
+    async def _read(self, con: WSConn) -> None:
+        try:
+            while True:
+                message = await con.recv()
+                try:
+                    self._dispatch(message)
+                except Exception as e:
+                    logger.error('unroutable websocket response', e=e,
+                                 url=self._pool._connect_url)
+        except ConnectionClosed as e:
+            self._closed(e)
+        except asyncio.CancelledError:
+            self._closed(ConnectionClosed(1001, 'connection terminated'))
+            raise
+        except Exception as e:
+            self._closed(e)
+
+    def _dispatch(self, message: Any) -> None:
+        if isinstance(message, str):
+            message = message.encode()
+        if message.lstrip().startswith(b'['):
+            responses = ujson.loads(message)
+            # entries may have no id of ours, eg, an error with a null id
+            pending = next((self._pending[r['id']] for r in responses
+                            if isinstance(r, dict) and type(r.get('id')) is int and
+                            r['id'] in self._pending), None)
+            if pending is None:
+                logger.info('dropping websocket batch response for forgotten request',
+                            url=self._pool._connect_url)
+                return
+            future, first_id, batch_ids = pending
+            for response in responses:
+                if isinstance(response, dict) and type(response.get('id')) is int and \
+                        0 <= response['id'] - first_id < len(batch_ids):
+                    response['id'] = batch_ids[response['id'] - first_id]
+            result = responses
+        else:
+            found = find_upstream_id(message)
+            _id = found[0] if found else ujson.loads(message).get('id')
+            if _id not in self._pending:
+                logger.info('dropping websocket response for forgotten request', id=_id,
+                            url=self._pool._connect_url)
+                return
+            future, _, _ = self._pending[_id]
+            result = message
+        if not future.done():
+            future.set_result(result)
+
+    def _closed(self, e: BaseException) -> None:
+        self._con = None
+        self._reader = None
+        for future, _, _ in list(self._pending.values()):
+            if not future.done():
+                future.set_exception(e)
+        self._pending.clear()
+
+    def terminate(self) -> None:
+        if self._con is not None:
+            self._con.fail_connection()
+        if self._reader is not None:
+            self._reader.cancel()
+
+    async def close(self) -> None:
+        if self._con is not None:
+            await self._con.close()
+
+    def to_dict(self) -> dict:
+        return {
+            'open': self.open,
+            'pending': self._outstanding,
+            'requests': self.requests
+        }
+
+
+class MultiplexedPool:
+    """A fixed number of websocket connections to an upstream, each shared by
+    any number of concurrent requests
+    """
+
+    __slots__ = ('_loop',
+                 '_size',
+                 '_connect_url',
+                 '_connect_kwargs',
+                 '_connections',
+                 '_closed')
+
+    def __init__(self,
+                 pool_size: int,
+                 pool_loop,
+                 connect_url: str,
+                 **connect_kwargs) -> None:
+        if pool_size <= 0:
+            raise ValueError('size is expected to be greater than zero')
+        self._loop = pool_loop or asyncio.get_event_loop()
+        self._size = pool_size
+        self._connect_url = connect_url
+        self._connect_kwargs = connect_kwargs
+        self._connections = [MultiplexedConnection(self) for _ in range(pool_size)]
+        self._closed = False
+
+    async def _get_new_connection(self) -> WSConn:
+        return await websockets_connect(self._connect_url, loop=self._loop,
+                                        **self._connect_kwargs)
+
+    def _select(self) -> MultiplexedConnection:
+        if self._closed:
+            raise ValueError('pool is closed')
+        return min(self._connections, key=len)
+
+    async def request(self, upstream_request: dict, timeout: float=None) -> bytes:
+        return await self._select().request(upstream_request, timeout=timeout)
+
+    async def request_batch(self, batch: List[dict], timeout: float=None) -> List[dict]:
+        return await self._select().request_batch(batch, timeout=timeout)
+
+    async def close(self) -> None:
+        self._closed = True
+        await asyncio.gather(*[conn.close() for conn in self._connections])
+
+    def terminate(self) -> None:
+        """Terminate all connections in the pool, failing outstanding requests"""
+        self._closed = True
+        for conn in self._connections:
+            conn.terminate()
+
+    def to_dict(self) -> dict:
+        return {
+            'url': self._connect_url,
+            'connections': [conn.to_dict() for conn in self._connections]
+        }
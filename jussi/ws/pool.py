@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
 import asyncio
+from bisect import bisect_left
+from collections import deque
+from typing import Deque
+from typing import List
 
 import structlog
 # pylint: disable=no-name-in-module
@@ -54,6 +58,9 @@ STEEMIT_MAX_BLOCK_SIZE = 65536  # get_dynamic_global_properties['maximum_block_s
 MAX_WEBSOCKET_RECV_SIZE = None  # no limit
 MAX_WEBSOCKET_READ_LIMIT = STEEMIT_MAX_BLOCK_SIZE + 1000
 
+# upper bounds, in seconds, of the acquire wait time histogram buckets
+WAIT_TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float('inf'))
+
 
 # pylint: disable=protected-access
 class PoolConnectionProxy:
@@ -88,7 +95,8 @@ class PoolConnectionHolder:
                  '_max_queries',
                  '_in_use',
                  '_queries',
-                 '_timeout'
+                 '_timeout',
+                 '_released_at'
                  )
 
     def __init__(self, pool, *, max_queries: int):
@@ -100,6 +108,7 @@ class PoolConnectionHolder:
         self._proxy = None
         self._timeout = None
         self._queries = 0
+        self._released_at = 0.0
 
     async def connect(self):
         if self._con is not None:
@@ -139,6 +148,20 @@ class PoolConnectionHolder:
         # connection proxy.
         self._release()
 
+    async def check(self, ping_timeout: float) -> None:
+        """ping an idle connection, reconnecting it if it's closed or doesn't answer"""
+        try:
+            if self._con is not None and self._con.open:
+                pong_waiter = await self._con.ping()
+                await asyncio.wait_for(pong_waiter, ping_timeout)
+                return
+        except Exception as e:
+            logger.info('websocket ping failed', e=e, url=self._pool._connect_url)
+        if self._con is not None:
+            self._con.fail_connection()
+            self._con = None
+        await self.connect()
+
     async def wait_until_released(self):
         if self._in_use is None:
             return
@@ -172,8 +195,9 @@ class PoolConnectionHolder:
             self._in_use.set_result(None)
         self._in_use = None
 
-        # Put ourselves back to the pool queue.
-        self._pool._queue.put_nowait(self)
+        # Put ourselves back to the pool.
+        self._released_at = self._pool._loop.time()
+        self._pool._release_holder(self)
 
 # pylint: disable=too-many-instance-attributes,too-many-arguments,protected-access
 
@@ -183,18 +207,37 @@ class Pool:
     Connection pool can be used to manage a set of connections to an upstream.
     Connections are first acquired from the pool, then used, and then released
     back to the pool.
+
+    The pool starts with ``pool_min_size`` connections and grows, one connection
+    at a time, up to ``pool_max_size`` when a request has waited
+    ``pool_scale_up_wait`` seconds for a connection. Connections idle for
+    ``pool_idle_timeout`` seconds are closed until the pool is back to its
+    minimum size. Idle connections are pinged every ``pool_ping_interval``
+    seconds, and reconnected in the background if they don't answer.
+    Requests waiting for a connection are served in the order they arrived,
+    and give up after ``pool_acquire_timeout`` seconds.
     """
 
-    __slots__ = ('_queue',
+    __slots__ = ('_idle',
+                 '_waiters',
                  '_loop',
                  '_minsize',
                  '_maxsize',
+                 '_max_queries',
+                 '_acquire_timeout',
+                 '_scale_up_wait',
+                 '_idle_timeout',
+                 '_ping_interval',
+                 '_ping_timeout',
+                 '_maintenance',
                  '_connect_url',
                  '_connect_kwargs',
                  '_holders',
                  '_initialized',
                  '_closing',
-                 '_closed')
+                 '_closed',
+                 '_wait_times',
+                 'stats')
 
     def __init__(self,
                  pool_min_size: int,
@@ -202,6 +245,12 @@ class Pool:
                  pool_max_queries: int,
                  pool_loop,
                  connect_url: str,
+                 *,
+                 pool_acquire_timeout: float=None,
+                 pool_scale_up_wait: float=0.0,
+                 pool_idle_timeout: float=None,
+                 pool_ping_interval: float=None,
+                 pool_ping_timeout: float=5.0,
                  **connect_kwargs):
 
         if pool_loop is None:
@@ -223,10 +272,20 @@ class Pool:
 
         self._minsize = pool_min_size
         self._maxsize = pool_max_size
-
-        self._holders = []
+        self._max_queries = pool_max_queries
+        self._acquire_timeout = pool_acquire_timeout or None
+        self._scale_up_wait = pool_scale_up_wait
+        self._idle_timeout = pool_idle_timeout or None
+        self._ping_interval = pool_ping_interval or None
+        self._ping_timeout = pool_ping_timeout
+        self._maintenance = None  # type: asyncio.Task
+
+        self._holders = []  # type: List[PoolConnectionHolder]
+        # idle holders, most recently released last
+        self._idle = deque()  # type: Deque[PoolConnectionHolder]
+        # requests waiting for a holder, oldest first
+        self._waiters = deque()  # type: Deque[asyncio.Future]
         self._initialized = False
-        self._queue = asyncio.LifoQueue(loop=self._loop)
 
         self._closing = False
         self._closed = False
@@ -234,10 +293,12 @@ class Pool:
         self._connect_url = connect_url
         self._connect_kwargs = connect_kwargs
 
-        for _ in range(pool_max_size):
-            ch = PoolConnectionHolder(self, max_queries=pool_max_queries)
-            self._holders.append(ch)
-            self._queue.put_nowait(ch)
+        self._wait_times = [0] * len(WAIT_TIME_BUCKETS)
+        self.stats = dict(acquired=0, acquire_timeouts=0, grown=0, shrunk=0,
+                          reconnects=0)
+
+        for _ in range(pool_min_size):
+            self._idle.append(self._add_holder())
 
     async def _async__init__(self):
         if self._initialized:
@@ -246,18 +307,9 @@ class Pool:
             raise ValueError('pool is closed')
 
         if self._minsize:
-            # Since we use a LIFO queue, the first items in the queue will be
-            # the last ones in `self._holders`.  We want to pre-connect the
-            # first few connections in the queue, therefore we want to walk
-            # `self._holders` in reverse.
-
-            if self._minsize > 1:
-                connect_tasks = []
-                for i, ch in enumerate(reversed(self._holders)):
-                    if i >= self._minsize:
-                        break
-                    connect_tasks.append(ch.connect())
-                await asyncio.gather(*connect_tasks, loop=self._loop)
+            await asyncio.gather(*[ch.connect() for ch in self._holders])
+        if self._ping_interval or self._idle_timeout:
+            self._maintenance = self._loop.create_task(self._maintain())
         self._initialized = True
         return self
 
@@ -267,21 +319,55 @@ class Pool:
         return await websockets_connect(self._connect_url, loop=self._loop,
                                         **self._connect_kwargs)
 
-    async def acquire(self, timeout: int=None) -> PoolConnectionProxy:
-        async def _acquire_impl(timeout=None) -> PoolConnectionProxy:
-            ch = await self._queue.get()  # type: PoolConnectionHolder
-            self._queue.task_done()
-            try:
-                proxy = await ch.acquire()  # type: # type: PoolConnectionProxy
-            except Exception:
-                self._queue.put_nowait(ch)
-                raise
+    def _add_holder(self) -> PoolConnectionHolder:
+        ch = PoolConnectionHolder(self, max_queries=self._max_queries)
+        self._holders.append(ch)
+        return ch
+
+    def _release_holder(self, ch: PoolConnectionHolder) -> None:
+        """hand a free holder to the longest waiting request, or make it idle"""
+        if ch not in self._holders:
+            return
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(ch)
+                return
+        self._idle.append(ch)
+
+    def _grow(self) -> None:
+        """add a holder for the longest waiting request"""
+        if self._closing or self._closed or len(self._holders) >= self._maxsize:
+            return
+        if any(not waiter.done() for waiter in self._waiters):
+            self.stats['grown'] += 1
+            self._release_holder(self._add_holder())
+
+    def _record_wait(self, wait_time: float) -> None:
+        self._wait_times[bisect_left(WAIT_TIME_BUCKETS, wait_time)] += 1
+
+    async def _wait_for_holder(self, timeout: float=None) -> PoolConnectionHolder:
+        if self._idle:
+            return self._idle.pop()
+        waiter = self._loop.create_future()
+        self._waiters.append(waiter)
+        if len(self._holders) < self._maxsize:
+            if self._scale_up_wait:
+                self._loop.call_later(self._scale_up_wait, self._grow)
             else:
-                # Record the timeout, as we will apply it by default
-                # in release().
-                ch._timeout = timeout
-                return proxy
+                self._grow()
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            self.stats['acquire_timeouts'] += 1
+            raise
+        except asyncio.CancelledError:
+            # the waiter may have been handed a holder just as it was cancelled
+            if waiter.done() and not waiter.cancelled():
+                self._release_holder(waiter.result())
+            raise
 
+    async def acquire(self, timeout: int=None) -> PoolConnectionProxy:
         if self._closing:
             raise ValueError('pool is closing')
         if not self._initialized:
@@ -290,10 +376,82 @@ class Pool:
             raise ValueError('pool is closed')
 
         if timeout is None:
-            return await _acquire_impl()
+            timeout = self._acquire_timeout
+        start = self._loop.time()
+        ch = await self._wait_for_holder(timeout)
+        self._record_wait(self._loop.time() - start)
+        self.stats['acquired'] += 1
+        try:
+            proxy = await ch.acquire()  # type: PoolConnectionProxy
+        except BaseException:
+            self._release_holder(ch)
+            raise
         else:
-            return await asyncio.wait_for(
-                _acquire_impl(), timeout=timeout, loop=self._loop)
+            # Record the timeout, as we will apply it by default
+            # in release().
+            ch._timeout = timeout
+            return proxy
+
+    async def _maintain(self) -> None:
+        interval = min(i for i in (self._ping_interval, self._idle_timeout) if i)
+        while not self._closed:
+            await asyncio.sleep(interval)
+            try:
+                self._shrink()
+                if self._ping_interval:
+                    await self._check_idle()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error('websocket pool maintenance error', e=e, url=self._connect_url)
+
+    def _shrink(self) -> None:
+        """close connections idle for longer than the idle timeout, down to min size"""
+        if not self._idle_timeout:
+            return
+        now = self._loop.time()
+        while self._idle and len(self._holders) > self._minsize:
+            ch = self._idle[0]
+            if now - ch._released_at < self._idle_timeout:
+                break
+            self._idle.popleft()
+            self._holders.remove(ch)
+            self.stats['shrunk'] += 1
+            if ch._con is not None:
+                ch._con.fail_connection()
+                ch._con = None
+
+    async def _check_idle(self) -> None:
+        """ping idle connections, reconnecting those which don't answer"""
+        checking = list(self._idle)
+        self._idle.clear()
+
+        async def check(ch):
+            con = ch._con
+            try:
+                await ch.check(self._ping_timeout)
+            except Exception as e:
+                logger.info('websocket reconnect failed', e=e, url=self._connect_url)
+            finally:
+                if ch._con is not con:
+                    self.stats['reconnects'] += 1
+                self._release_holder(ch)
+        await asyncio.gather(*[check(ch) for ch in checking])
+
+    def to_dict(self) -> dict:
+        wait_times = dict()
+        for bucket, count in zip(WAIT_TIME_BUCKETS, self._wait_times):
+            wait_times['le_%s' % bucket] = count
+        return {
+            'url': self._connect_url,
+            'size': len(self._holders),
+            'min_size': self._minsize,
+            'max_size': self._maxsize,
+            'idle': len(self._idle),
+            'waiting': len([w for w in self._waiters if not w.done()]),
+            'wait_times': wait_times,
+            **self.stats
+        }
 
     async def release(self, connection: PoolConnectionProxy, *, timeout: int=None):
         """Release a connection back to the pool.
@@ -313,7 +471,7 @@ class Pool:
         # Use asyncio.shield() to guarantee that task cancellation
         # does not prevent the connection from being returned to the
         # pool properly.
-        return await asyncio.shield(ch.release(timeout), loop=self._loop)
+        return await asyncio.shield(ch.release(timeout))
 
     async def close(self):
         """Attempt to gracefully close all connections in the pool.
@@ -336,15 +494,17 @@ class Pool:
             raise ValueError('pool is closed')
 
         self._closing = True
+        if self._maintenance is not None:
+            self._maintenance.cancel()
 
         try:
             release_coros = [
                 ch.wait_until_released() for ch in self._holders]
-            await asyncio.gather(*release_coros, loop=self._loop)
+            await asyncio.gather(*release_coros)
 
             close_coros = [
                 ch.close() for ch in self._holders]
-            await asyncio.gather(*close_coros, loop=self._loop)
+            await asyncio.gather(*close_coros)
 
         except Exception:
             self.terminate()
@@ -362,6 +522,8 @@ class Pool:
             raise ValueError('pool is not initialized')
         if self._closed:
             raise ValueError('pool is closed')
+        if self._maintenance is not None:
+            self._maintenance.cancel()
         for ch in self._holders:
             ch.terminate()
         self._closed = True
@@ -1730,6 +1730,9 @@ def app(loop):
     app.config.args.server_port = 42101
     app.config.args.websocket_pool_minsize = 0
     app.config.args.websocket_pool_maxsize = 1
+    app.config.args.websocket_multiplex = False
+    app.config.args.upstream_health_check_interval = 0
+    app.config.args.block_clock_interval = 0
     app = jussi.logging_config.setup_logging(app)
     app = jussi.serve.setup_routes(app)
     app = jussi.middlewares.setup_middlewares(app)
@@ -1,39 +1,140 @@
 # -*- coding: utf-8 -*-
+# pylint: skip-file
+"""
+benchmark the websocket connection pools against a simulated upstream
+
+    python -m tests.profiling_tests.profile_pool --concurrency 200 --requests 20000
+    python -m tests.profiling_tests.profile_pool --pool mux --latency 0.005
+    python -m tests.profiling_tests.profile_pool --profile
+
+each request acquires a connection, waits --latency seconds (the simulated
+upstream round trip) and releases it, or for --pool mux, sends a request over a
+shared connection. reports throughput, time spent waiting (beyond --latency) percentiles and the
+pool's own stats
+"""
+import argparse
 import asyncio
 import cProfile
+import time
+
+import ujson
 import uvloop
-from tests.conftest import AttrDict
+
+from jussi.ws.mux import MultiplexedPool
 from jussi.ws.pool import Pool
-# asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
-pr = cProfile.Profile()
 
+class MockedWSConn:
+    def __init__(self, latency):
+        self.latency = latency
+        self.open = True
+        self.responses = asyncio.Queue()
+
+    @property
+    def closed(self):
+        return not self.open
+
+    async def send(self, message):
+        asyncio.ensure_future(self._respond(message))
+
+    async def _respond(self, message):
+        await asyncio.sleep(self.latency)
+        request = ujson.loads(message)
+        await self.responses.put(ujson.dumps({'id': request['id'], 'result': None}))
+
+    async def recv(self):
+        return await self.responses.get()
+
+    async def ping(self):
+        pong_waiter = asyncio.get_event_loop().create_future()
+        pong_waiter.set_result(None)
+        return pong_waiter
+
+    def fail_connection(self):
+        self.open = False
+
+    async def close(self, timeout=None):
+        self.open = False
 
-def patch_pool(Pool):
-    MockedWSConn = AttrDict()
-    MockedWSConn.send = lambda x: None
-    MockedWSConn.recv = lambda x: None
-    Pool._get_new_connection = lambda s: MockedWSConn
-    return Pool
 
+def mocked(pool_class, latency):
+    class MockedPool(pool_class):
+        async def _get_new_connection(self):
+            return MockedWSConn(latency)
+    return MockedPool
 
-async def run(pool, count):
-    pr.enable()
-    for i in range(count):
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+async def run_pool(pool, latency, count, waits):
+    for _ in range(count):
+        start = time.perf_counter()
         conn = await pool.acquire()
+        waits.append(time.perf_counter() - start)
+        await conn.send(ujson.dumps({'id': 1}))
+        await conn.recv()
         await pool.release(conn)
-    pr.disable()
 
 
-if __name__ == "__main__":
+async def run_mux(pool, latency, count, waits):
+    for _ in range(count):
+        start = time.perf_counter()
+        await pool.request({'id': 1})
+        waits.append(time.perf_counter() - start - latency)
+
+
+async def bench(args):
     loop = asyncio.get_event_loop()
-    pool = loop.run_until_complete(Pool(
-        1,  # minsize of pool
-        2,  # maxsize of pool
-        0,  # max queries per conn (0 means unlimited)
-        loop,  # event_loop
-        'ws://127.0.0.1',  # connection url
-        # all kwargs are passed to websocket connection
-    ))
-    loop.run_until_complete(run(pool, 10000))
-    pr.print_stats(sort='time')
+    if args.pool == 'mux':
+        pool = mocked(MultiplexedPool, args.latency)(args.max_size, loop, 'ws://127.0.0.1')
+        run = run_mux
+    else:
+        pool = await mocked(Pool, args.latency)(
+            args.min_size, args.max_size, 0, loop, 'ws://127.0.0.1',
+            pool_scale_up_wait=args.scale_up_wait)
+        run = run_pool
+    waits = []
+    per_worker = args.requests // args.concurrency
+    start = time.perf_counter()
+    await asyncio.gather(*[run(pool, args.latency, per_worker, waits)
+                           for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+    print(f'{args.pool} pool: {len(waits)} requests in {elapsed:.2f}s, '
+          f'{len(waits) / elapsed:.0f} requests/s')
+    for p in (0.5, 0.9, 0.99):
+        print(f'wait p{int(p * 100)}: {percentile(waits, p) * 1000:.2f}ms')
+    print(ujson.dumps(pool.to_dict(), indent=2))
+    pool.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark websocket connection pools')
+    parser.add_argument('--pool', choices=['pool', 'mux'], default='pool')
+    parser.add_argument('--min_size', type=int, default=1)
+    parser.add_argument('--max_size', type=int, default=8)
+    parser.add_argument('--scale_up_wait', type=float, default=0.01)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--latency', type=float, default=0.002)
+    parser.add_argument('--uvloop', action='store_true')
+    parser.add_argument('--profile', action='store_true')
+    args = parser.parse_args()
+
+    if args.uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    pr = cProfile.Profile()
+    if args.profile:
+        pr.enable()
+    loop.run_until_complete(bench(args))
+    if args.profile:
+        pr.disable()
+        pr.print_stats(sort='time')
+
+
+if __name__ == '__main__':
+    main()
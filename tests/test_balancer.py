@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+import collections
+import time
+
+import pytest
+
+from jussi.balancer import Balancer
+from jussi.balancer import HealthPolicy
+from jussi.balancer import STRATEGIES
+from jussi.balancer import UpstreamEndpoint
+from jussi.balancer import build_balancer
+from jussi.balancer import normalize_weighted_urls
+
+
+@pytest.mark.parametrize('value,expected', [
+    ('wss://a.com', (('wss://a.com', 1),)),
+    (['wss://a.com', 'wss://b.com'], (('wss://a.com', 1), ('wss://b.com', 1))),
+    ([['wss://a.com', 3], ['wss://b.com', 1]], (('wss://a.com', 3), ('wss://b.com', 1))),
+    ([{'url': 'wss://a.com', 'weight': 2}, {'url': 'wss://b.com'}],
+     (('wss://a.com', 2), ('wss://b.com', 1)))
+])
+def test_normalize_weighted_urls(value, expected):
+    assert normalize_weighted_urls(value) == expected
+
+
+@pytest.mark.parametrize('value', [
+    [], [['wss://a.com', 0]], [['wss://a.com', 1.5]]
+])
+def test_normalize_weighted_urls_invalid(value):
+    with pytest.raises(ValueError):
+        normalize_weighted_urls(value)
+
+
+def test_build_balancer_shares_endpoints():
+    endpoints = dict()
+    balancer1 = build_balancer((('wss://a.com', 1), ('wss://b.com', 1)), endpoints)
+    balancer2 = build_balancer((('wss://b.com', 1),), endpoints)
+    assert balancer1.endpoints[1] is balancer2.endpoints[0]
+    assert set(endpoints.keys()) == {'wss://a.com', 'wss://b.com'}
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        build_balancer((('wss://a.com', 1),), dict(), strategy='random')
+
+
+def test_round_robin_weights():
+    balancer = build_balancer((('wss://a.com', 3), ('wss://b.com', 1)), dict(),
+                              strategy='round_robin')
+    counts = collections.Counter(balancer.select().url for _ in range(400))
+    assert counts['wss://a.com'] == 300
+    assert counts['wss://b.com'] == 100
+
+
+def test_round_robin_is_smooth():
+    balancer = build_balancer((('wss://a.com', 1), ('wss://b.com', 1)), dict(),
+                              strategy='round_robin')
+    urls = [balancer.select().url for _ in range(4)]
+    assert urls[0] != urls[1]
+    assert urls[2] != urls[3]
+
+
+def test_least_outstanding_requests():
+    balancer = build_balancer((('wss://a.com', 1), ('wss://b.com', 1)), dict(),
+                              strategy='least_outstanding_requests')
+    a, b = balancer.endpoints
+    a.on_request_start()
+    a.on_request_start()
+    assert balancer.select() is b
+    b.on_request_start()
+    b.on_request_start()
+    b.on_request_start()
+    assert balancer.select() is a
+
+
+def test_power_of_two_choices_prefers_faster():
+    balancer = build_balancer((('wss://a.com', 1), ('wss://b.com', 1)), dict(),
+                              strategy='power_of_two_choices')
+    a, b = balancer.endpoints
+    a.latency_ewma = 1.0
+    b.latency_ewma = 0.01
+    assert all(balancer.select() is b for _ in range(50))
+
+
+@pytest.mark.parametrize('strategy', list(STRATEGIES.keys()))
+def test_select_exclude(strategy):
+    balancer = build_balancer((('wss://a.com', 1), ('wss://b.com', 1)), dict(),
+                              strategy=strategy)
+    a, b = balancer.endpoints
+    assert all(balancer.select(exclude=(a,)) is b for _ in range(10))
+    # excluding every member falls back to all members
+    assert balancer.select(exclude=(a, b)) in (a, b)
+
+
+def test_endpoint_tracking():
+    endpoint = UpstreamEndpoint('wss://a.com')
+    start = endpoint.on_request_start()
+    assert endpoint.outstanding == 1
+    endpoint.on_request_end(start)
+    assert endpoint.outstanding == 0
+    assert endpoint.latency_ewma is not None
+    start = endpoint.on_request_start()
+    endpoint.on_request_end(start, error=True)
+    assert endpoint.errors == 1
+    assert endpoint.requests == 2
+
+
+def test_endpoint_latency_p95():
+    endpoint = UpstreamEndpoint('wss://a.com')
+    for i in range(1, 101):
+        endpoint.on_request_start()
+        endpoint.on_request_end(time.perf_counter() - i / 1000)
+    assert endpoint.latency_p95 == pytest.approx(0.096, abs=0.001)
+
+
+def test_endpoint_request_cancel():
+    endpoint = UpstreamEndpoint('wss://a.com')
+    endpoint.on_request_start()
+    endpoint.on_request_cancel()
+    assert endpoint.outstanding == 0
+    assert endpoint.errors == 0
+    assert endpoint.latency_ewma is None
+
+
+def test_single_member_balancer():
+    endpoint = UpstreamEndpoint('wss://a.com')
+    balancer = Balancer([(endpoint, 1)])
+    assert balancer.select() is endpoint
+    assert balancer.urls == ('wss://a.com',)
+
+
+def test_consecutive_errors_eject():
+    endpoint = UpstreamEndpoint('wss://a.com', policy=HealthPolicy(max_consecutive_errors=2))
+    endpoint.on_request_end(endpoint.on_request_start(), error=True)
+    assert not endpoint.is_ejected()
+    endpoint.on_request_end(endpoint.on_request_start(), error=True)
+    assert endpoint.is_ejected()
+    assert endpoint.last_ejection_reason == 'consecutive_errors'
+
+
+def test_success_resets_consecutive_errors():
+    endpoint = UpstreamEndpoint('wss://a.com', policy=HealthPolicy(max_consecutive_errors=2))
+    endpoint.on_request_end(endpoint.on_request_start(), error=True)
+    endpoint.on_request_end(endpoint.on_request_start())
+    endpoint.on_request_end(endpoint.on_request_start(), error=True)
+    assert not endpoint.is_ejected()
+
+
+def test_ejection_backoff():
+    endpoint = UpstreamEndpoint('wss://a.com', policy=HealthPolicy(ejection_time=10,
+                                                                   max_ejection_time=25))
+    endpoint.eject('test')
+    first = endpoint.ejected_until
+    endpoint.reinstate()
+    endpoint.eject('test')
+    second = endpoint.ejected_until
+    endpoint.reinstate()
+    endpoint.eject('test')
+    assert endpoint.ejections == 3
+    assert second - first > 9
+    assert endpoint.ejected_until - time.perf_counter() <= 25
+
+
+def test_health_check_ejects_and_reinstates():
+    endpoint = UpstreamEndpoint('wss://a.com')
+    endpoint.on_health_check(False)
+    assert endpoint.is_ejected()
+    endpoint.on_health_check(True)
+    assert not endpoint.is_ejected()
+
+
+def test_health_check_keeps_error_ejection():
+    endpoint = UpstreamEndpoint('wss://a.com', policy=HealthPolicy(max_consecutive_errors=1))
+    endpoint.on_request_end(endpoint.on_request_start(), error=True)
+    assert endpoint.is_ejected()
+    endpoint.on_health_check(True)
+    assert endpoint.is_ejected()
+    assert endpoint.last_ejection_reason == 'consecutive_errors'
+
+
+def test_slow_start_weight_factor():
+    endpoint = UpstreamEndpoint('wss://a.com', policy=HealthPolicy(slow_start=10))
+    now = time.perf_counter()
+    assert endpoint.weight_factor(now) == 1.0
+    endpoint.eject('test')
+    endpoint.reinstate()
+    assert endpoint.weight_factor(time.perf_counter()) < 0.2
+    assert endpoint.weight_factor(time.perf_counter() + 5) == pytest.approx(0.5, abs=0.01)
+    assert endpoint.weight_factor(time.perf_counter() + 11) == 1.0
+
+
+@pytest.mark.parametrize('strategy', list(STRATEGIES.keys()))
+def test_select_skips_ejected(strategy):
+    balancer = build_balancer((('wss://a.com', 1), ('wss://b.com', 1)), dict(),
+                              strategy=strategy)
+    a, b = balancer.endpoints
+    a.eject('test')
+    assert all(balancer.select() is b for _ in range(10))
+
+
+def test_select_all_ejected():
+    balancer = build_balancer((('wss://a.com', 1), ('wss://b.com', 1)), dict())
+    a, b = balancer.endpoints
+    a.eject('test')
+    b.eject('test')
+    assert {balancer.select(), balancer.select()} == {a, b}
+
+
+def test_eject_latency_outliers():
+    balancer = build_balancer((('wss://a.com', 1), ('wss://b.com', 1), ('wss://c.com', 1)),
+                              dict())
+    a, b, c = balancer.endpoints
+    a.latency_ewma = 0.01
+    b.latency_ewma = 0.02
+    c.latency_ewma = 2.0
+    balancer.eject_latency_outliers()
+    assert not a.is_ejected()
+    assert not b.is_ejected()
+    assert c.is_ejected()
+    assert c.last_ejection_reason == 'latency_outlier'
+
+
+def test_eject_latency_outliers_min_latency():
+    balancer = build_balancer((('wss://a.com', 1), ('wss://b.com', 1)), dict())
+    a, b = balancer.endpoints
+    a.latency_ewma = 0.001
+    b.latency_ewma = 0.1
+    balancer.eject_latency_outliers()
+    assert not b.is_ejected()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+import ujson
+
+from jussi.balancer import build_balancer
+from jussi.block_clock import BlockClock
+from jussi.block_clock import BlockState
+from jussi.block_clock import block_state_from_response
+
+
+def dgp_response(head_block_num, last_irreversible_block_num):
+    return ujson.dumps({
+        'id': 0,
+        'jsonrpc': '2.0',
+        'result': {
+            'head_block_number': head_block_num,
+            'last_irreversible_block_num': last_irreversible_block_num,
+            'time': '2018-04-04T19:24:36'
+        }
+    }).encode()
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def read(self):
+        return self.body
+
+
+class FakeSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.urls = []
+
+    def post(self, url, data=None):
+        self.urls.append(url)
+        return FakeResponse(self.responses.pop(0))
+
+
+def make_upstreams(*urls):
+    balancer = build_balancer(tuple((url, 1) for url in urls), dict())
+    return SimpleNamespace(balancer=lambda urn: balancer)
+
+
+UPSTREAMS = make_upstreams('http://test.com')
+
+
+@pytest.fixture
+def clock_path(tmpdir):
+    return os.path.join(str(tmpdir), 'jussi-block-clock')
+
+
+def make_clock(path, *responses, on_update=None, upstreams=UPSTREAMS):
+    return BlockClock(upstreams, FakeSession(*responses), path=path,
+                      on_update=on_update, loop=asyncio.new_event_loop())
+
+
+def test_block_state_from_response():
+    state = block_state_from_response(dgp_response(21_000_020, 21_000_000))
+    assert state.head_block_num == 21_000_020
+    assert state.last_irreversible_block_num == 21_000_000
+    assert state.head_block_time == 1522869876.0
+
+
+def test_block_clock_shared_between_instances(clock_path):
+    leader = make_clock(clock_path)
+    follower = make_clock(clock_path)
+    assert follower.read() == BlockState(0, 0, 0.0, 0.0)
+    leader.publish(BlockState(20, 10, 1.0, 2.0))
+    assert follower.read() == BlockState(20, 10, 1.0, 2.0)
+    assert make_clock(clock_path).last_irreversible_block_num == 10
+
+
+def test_block_clock_one_leader(clock_path):
+    first = make_clock(clock_path)
+    second = make_clock(clock_path)
+    assert first.try_lead()
+    assert not second.try_lead()
+    asyncio.new_event_loop().run_until_complete(first.stop())
+    assert second.try_lead()
+
+
+async def test_block_clock_tick(clock_path):
+    updates = []
+
+    async def on_update(state):
+        updates.append(state.last_irreversible_block_num)
+    leader = make_clock(clock_path,
+                        dgp_response(30, 10), dgp_response(25, 5), dgp_response(31, 11),
+                        on_update=on_update)
+    follower = make_clock(clock_path, on_update=on_update)
+    await leader.tick()
+    await follower.tick()
+    assert updates == [10, 10]
+    assert not follower.is_leader
+    # a lagging upstream doesn't move the clock back
+    await leader.tick()
+    assert leader.last_irreversible_block_num == 10
+    await leader.tick()
+    await follower.tick()
+    assert follower.head_block_num == 31
+    assert follower.last_irreversible_block_num == 11
+    assert leader.to_dict()['polls'] == 3
+
+
+async def test_block_clock_poll_error(clock_path):
+    clock = make_clock(clock_path, b'not json')
+    await clock.tick()
+    assert clock.last_irreversible_block_num == 0
+    assert clock.to_dict()['poll_errors'] == 1
+
+
+async def test_block_clock_skips_ejected_upstreams(clock_path):
+    upstreams = make_upstreams('http://primary.com', 'http://secondary.com')
+    primary, secondary = upstreams.balancer(None).endpoints
+    primary.eject('test')
+    clock = make_clock(clock_path, dgp_response(30, 10), dgp_response(31, 11),
+                       upstreams=upstreams)
+    await clock.tick()
+    await clock.tick()
+    assert clock._session.urls == ['http://secondary.com', 'http://secondary.com']
+    assert clock.last_irreversible_block_num == 11
+    assert secondary.requests == 2
+    assert secondary.outstanding == 0
+
+
+async def test_block_clock_poll_error_counts_against_upstream(clock_path):
+    clock = make_clock(clock_path, b'not json')
+    endpoint = UPSTREAMS.balancer(None).endpoints[0]
+    errors = endpoint.consecutive_errors
+    await clock.tick()
+    assert endpoint.consecutive_errors == errors + 1
+    assert endpoint.outstanding == 0
+
+
+async def test_block_clock_per_process():
+    first = make_clock(None, dgp_response(30, 10))
+    second = make_clock(None, dgp_response(31, 11))
+    assert first.try_lead()
+    assert second.try_lead()
+    await first.tick()
+    assert first.last_irreversible_block_num == 10
+    assert second.read() == BlockState(0, 0, 0.0, 0.0)
+    await first.stop()
+    first.close()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from jussi.block_prefetcher import BlockPrefetcher
+from jussi.block_prefetcher import block_num_param
+from jussi.block_prefetcher import with_block_num
+from jussi.request.jsonrpc import from_http_request
+from jussi.upstream import _Upstreams
+
+with open('DEV_config.json') as f:
+    UPSTREAMS = _Upstreams(json.load(f), validate=False)
+
+
+class FakeCacheGroup:
+    def __init__(self, cached=()):
+        self.cached = set(cached)
+        self.responses = []
+
+    async def mget(self, keys):
+        return [1 if key in self.cached else None for key in keys]
+
+    async def cache_batch_jsonrpc_response(self, requests=None, responses=None,
+                                           last_irreversible_block_num=None):
+        self.responses.extend(responses)
+
+
+def make_http_request(cache_group=None, head_block_num=None, client_ip='1.1.1.1'):
+    block_clock = None
+    if head_block_num is not None:
+        block_clock = SimpleNamespace(head_block_num=head_block_num)
+    config = SimpleNamespace(upstreams=UPSTREAMS,
+                             cache_group=cache_group or FakeCacheGroup(),
+                             block_clock=block_clock,
+                             upstream_concurrency_limits=None,
+                             upstream_fair_queues=None,
+                             last_irreversible_block_num=1000)
+    return SimpleNamespace(app=SimpleNamespace(config=config),
+                           amzn_trace_id=None,
+                           jussi_request_id='123',
+                           client_ip=client_ip,
+                           is_single_jrpc=True,
+                           jsonrpc=None)
+
+
+def get_block(http_request, block_num):
+    http_request.jsonrpc = from_http_request(http_request, 0, {
+        'id': 1, 'jsonrpc': '2.0', 'method': 'condenser_api.get_block', 'params': [block_num]})
+    return http_request
+
+
+def block_response(request):
+    block_num = request['params'][0]
+    return {'id': request['id'], 'jsonrpc': '2.0',
+            'result': {'block_id': f'{block_num:08x}' + '0' * 32, 'transactions': []}}
+
+
+def make_prefetcher(batches, **kwargs):
+    async def send(batch):
+        batches.append([r['params'][0] for r in batch])
+        return [block_response(r) for r in batch]
+    prefetcher = BlockPrefetcher(loop=asyncio.get_event_loop(), **kwargs)
+    prefetcher._senders['https://api.hive.blog'] = send
+    return prefetcher
+
+
+@pytest.mark.parametrize('request_dict,expected', [
+    ({'id': 1, 'jsonrpc': '2.0', 'method': 'get_block', 'params': [1000]},
+     {'id': 1, 'jsonrpc': '2.0', 'method': 'get_block', 'params': [1001]}),
+    ({'id': 1, 'jsonrpc': '2.0', 'method': 'block_api.get_block', 'params': {'block_num': 1000}},
+     {'id': 1, 'jsonrpc': '2.0', 'method': 'block_api.get_block', 'params': {'block_num': 1001}}),
+    ({'id': 1, 'jsonrpc': '2.0', 'method': 'call',
+      'params': ['condenser_api', 'get_ops_in_block', [1000, True]]},
+     {'id': 1, 'jsonrpc': '2.0', 'method': 'call',
+      'params': ['condenser_api', 'get_ops_in_block', [1001, True]]})
+])
+def test_with_block_num(request_dict, expected):
+    jrpc_request = from_http_request(make_http_request(), 0, request_dict)
+    assert block_num_param(jrpc_request) == 1000
+    assert with_block_num(jrpc_request, 1001) == expected
+
+
+def test_block_num_param_other_methods():
+    jrpc_request = from_http_request(make_http_request(), 0, {
+        'id': 1, 'jsonrpc': '2.0', 'method': 'condenser_api.get_accounts', 'params': [['a']]})
+    assert block_num_param(jrpc_request) is None
+
+
+async def test_prefetch_sequential_blocks():
+    batches = []
+    prefetcher = make_prefetcher(batches, depth=10, min_run=3)
+    cache_group = FakeCacheGroup()
+    http_request = make_http_request(cache_group)
+    for block_num in range(100, 103):
+        prefetcher.observe(get_block(http_request, block_num))
+    await asyncio.sleep(0)
+    assert batches == [list(range(103, 113))]
+    assert len(cache_group.responses) == 10
+    # the window is refilled once half of it has been used
+    for block_num in range(103, 108):
+        prefetcher.observe(get_block(http_request, block_num))
+    await asyncio.sleep(0)
+    assert batches[1:] == [list(range(113, 118))]
+    assert prefetcher.in_flight == 0
+
+
+async def test_prefetch_not_sequential():
+    batches = []
+    prefetcher = make_prefetcher(batches, depth=10, min_run=3)
+    http_request = make_http_request()
+    for block_num in (100, 101, 200, 201, 100):
+        prefetcher.observe(get_block(http_request, block_num))
+    other_client = make_http_request(client_ip='2.2.2.2')
+    prefetcher.observe(get_block(other_client, 202))
+    await asyncio.sleep(0)
+    assert batches == []
+
+
+async def test_prefetch_bounds():
+    batches = []
+    prefetcher = make_prefetcher(batches, depth=10, min_run=2, client_budget=4)
+    cache_group = FakeCacheGroup(cached={'appbase.condenser_api.get_block.v1=[103]'})
+    http_request = make_http_request(cache_group, head_block_num=106)
+    for block_num in (100, 101):
+        prefetcher.observe(get_block(http_request, block_num))
+    await asyncio.sleep(0)
+    # at most client_budget blocks, skipping cached blocks
+    assert batches == [[102, 104, 105]]
+    assert prefetcher.to_dict()['already_cached'] == 1
+    for block_num in (102, 103, 104, 105, 106):
+        prefetcher.observe(get_block(http_request, block_num))
+    await asyncio.sleep(0)
+    # never past the head block
+    assert batches[1:] == [[106]]
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+
+from jussi.cache.backends.block_store import BlockStore
+from jussi.cache.backends.block_store import block_key
+from jussi.urn import URN
+
+BLOCK = {'block_id': '000003e8b922f4906a45af8e99d86b3511acd7a5',
+         'previous': '000003e7c4b5ec7d1d81b7d8d2fa3e8d0bcbd64c',
+         'transactions': []}
+
+
+def get_block_key(block_num):
+    return URN('appbase', 'condenser_api', 'get_block', [block_num]).cache_key()
+
+
+def response(block_num):
+    return {'id': 1, 'jsonrpc': '2.0', 'result': dict(BLOCK, block_num=block_num)}
+
+
+@pytest.fixture
+def block_store(tmpdir):
+    store = BlockStore(str(tmpdir), segment_blocks=10, max_open_segments=2)
+    yield store
+    store.close()
+
+
+@pytest.mark.parametrize('key,expected', [
+    (get_block_key(1000), ('appbase.condenser_api.get_block.v1=[#]', 1000)),
+    (URN('appbase', 'block_api', 'get_block', {'block_num': 7}).cache_key(),
+     ('appbase.block_api.get_block.v1={"block_num":#}', 7)),
+    (URN('appbase', 'condenser_api', 'get_ops_in_block', [12, True]).cache_key(),
+     ('appbase.condenser_api.get_ops_in_block.v1=[#,true]', 12)),
+    (URN('hived', 'database_api', 'get_block_header', [3]).cache_key(),
+     ('hived.database_api.get_block_header.v1=[#]', 3)),
+    (URN('appbase', 'account_history_api', 'get_ops_in_block',
+         {'block_num': 12345678, 'only_virtual': True}).cache_key(),
+     ('appbase.account_history_api.get_ops_in_block.v1=#:fc2d2634d70b5537471ae2c6be3c8ad1',
+      12345678)),
+    (URN('appbase', 'condenser_api', 'get_accounts', [['a']]).cache_key(), None),
+    (URN('appbase', 'condenser_api', 'get_block', ['x']).cache_key(), None),
+    ('last_irreversible_block_num', None),
+])
+def test_block_key(key, expected):
+    assert block_key(key) == expected
+
+
+def test_block_store_sets_gets(block_store):
+    for block_num in range(1, 35):
+        block_store.sets(get_block_key(block_num), response(block_num))
+    for block_num in range(1, 35):
+        assert block_store.gets(get_block_key(block_num)) == response(block_num)
+    assert block_store.gets(get_block_key(35)) is None
+    assert block_store.gets(get_block_key(1000)) is None
+    assert block_store.to_dict()['open_segments'] == 2
+    assert block_store.stored == 34
+
+
+def test_block_store_only_stores_irreversible_blocks(block_store):
+    block_store.sets(get_block_key(1), response(1), expire_time=3)
+    block_store.sets('last_irreversible_block_num', 1)
+    assert block_store.gets(get_block_key(1)) is None
+    assert block_store.gets('last_irreversible_block_num') is None
+    assert block_store.stored == 0
+    assert os.listdir(block_store.path) == []
+
+
+def test_block_store_never_replaces_blocks(block_store):
+    block_store.sets(get_block_key(1), response(1))
+    block_store.sets(get_block_key(1), response(2))
+    assert block_store.gets(get_block_key(1)) == response(1)
+    assert block_store.stored == 1
+
+
+def test_block_store_is_shared(block_store):
+    block_store.sets(get_block_key(1), response(1))
+    other = BlockStore(block_store.path, segment_blocks=10)
+    assert other.gets(get_block_key(2)) is None
+    block_store.sets(get_block_key(2), response(2))
+    # values appended after the other store mapped the data file are read
+    assert other.gets(get_block_key(1)) == response(1)
+    assert other.gets(get_block_key(2)) == response(2)
+    other.sets(get_block_key(2), response(3))
+    assert other.stored == 0
+    other.close()
+
+
+def test_block_store_corrupt_value(block_store):
+    block_store.sets(get_block_key(1), response(1))
+    block_store.close()
+    with open(os.path.join(block_store.path, '000000.dat'), 'r+b') as f:
+        f.write(b'\x00\x00\x00\x00')
+    assert block_store.gets(get_block_key(1)) is None
+    assert block_store.corrupt == 1
+
+
+def test_block_store_load(block_store):
+    items = [(get_block_key(block_num), response(block_num)) for block_num in range(5)]
+    assert block_store.load(items) == 5
+    assert block_store.load(items) == 0
+
+
+async def test_block_store_async(block_store):
+    await block_store.set_many({get_block_key(1): response(1), get_block_key(2): response(2)})
+    await block_store.set(get_block_key(3), response(3), expire_time=None)
+    assert await block_store.mget([get_block_key(1), get_block_key(4), get_block_key(3)]) == \
+        [response(1), None, response(3)]
+    await block_store.clear()
+    assert await block_store.get(get_block_key(1)) is None
+    assert os.listdir(block_store.path) == []
+
+
+async def test_block_store_hashed_keys(block_store):
+    def ops_key(block_num, only_virtual):
+        return URN('appbase', 'account_history_api', 'get_ops_in_block',
+                   {'block_num': block_num, 'only_virtual': only_virtual}).cache_key()
+    await block_store.set(ops_key(12345678, True), response(1), expire_time=None)
+    await block_store.set(ops_key(12345678, False), response(2), expire_time=None)
+    assert await block_store.mget([ops_key(12345678, True), ops_key(12345678, False),
+                                   ops_key(12345679, True)]) == [response(1), response(2), None]
+    assert await block_store.ttls([ops_key(12345678, True), ops_key(12345679, True)]) == \
+        [None, 0.0]
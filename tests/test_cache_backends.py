@@ -2,7 +2,9 @@
 
 import time
 import pytest
+from jussi.cache.backends.lru import BoundedMemoryCache
 from jussi.cache.backends.max_ttl import SimplerMaxTTLMemoryCache
+from jussi.cache.cache_group import CacheGroup
 
 from .conftest import make_request
 from .conftest import build_mocked_cache
@@ -19,6 +21,18 @@ async def test_cache_clear(cache):
     assert await cache.get('key') is None
 
 
+@pytest.mark.parametrize('cache', [SimplerMaxTTLMemoryCache(), build_mocked_cache()])
+async def test_cache_ttls(cache):
+    await cache.clear()
+    await cache.set('a', 'value', 100)
+    await cache.set('b', 'value', 10)
+    a, b, missing = await cache.ttls(['a', 'b', 'missing'])
+    assert 99 < a <= 100
+    assert 9 < b <= 10
+    assert missing == 0.0
+    assert await cache.ttls([]) == []
+
+
 @pytest.mark.parametrize('cache', [SimplerMaxTTLMemoryCache()])
 def test_cache_gets(cache):
     cache.sets('key', 'value', None)
@@ -104,3 +118,117 @@ def test_cache_max_size(cache):
     for i in range(max_size + 10):
         cache.sets(f'{i}', 'value', cache._max_ttl + 100)
     assert len(cache._cache) == max_size
+
+
+@pytest.mark.parametrize('policy', ['lru', 'lfu'])
+def test_bounded_cache_gets_and_sets(policy):
+    cache = BoundedMemoryCache(policy=policy)
+    cache.sets('key', 'value', None)
+    cache.set_manys({'key1': 'value1', 'key2': 'value2'}, 10)
+    assert cache.mgets(['key', 'key1', 'key2', 'missing']) == \
+        ['value', 'value1', 'value2', None]
+    assert cache.hits == 3
+    assert cache.misses == 1
+    cache.deletes('key')
+    assert cache.gets('key') is None
+    assert len(cache) == 2
+
+
+def test_bounded_cache_ttl_expire():
+    cache = BoundedMemoryCache()
+    cache.sets('key', 'value', 0)
+    assert cache.gets('key') is None
+    cache.sets('key', 'value', 0.01)
+    time.sleep(0.02)
+    assert cache.gets('key') is None
+    assert cache.expirations == 1
+    assert len(cache) == 0
+
+
+def test_bounded_cache_prunes_expired_on_set():
+    cache = BoundedMemoryCache()
+    cache.sets('key', 'value', 0.01)
+    time.sleep(0.02)
+    cache.sets('key2', 'value', None)
+    assert len(cache) == 1
+    assert cache.expirations == 1
+
+
+def test_bounded_cache_overwrite():
+    cache = BoundedMemoryCache()
+    cache.sets('key', 'value', 0.01)
+    cache.sets('key', 'value2', None)
+    time.sleep(0.02)
+    cache.prune()
+    assert cache.gets('key') == 'value2'
+
+
+def test_bounded_cache_lru_eviction():
+    cache = BoundedMemoryCache(max_size=3, policy='lru')
+    for key in ('a', 'b', 'c'):
+        cache.sets(key, key, None)
+    cache.gets('a')
+    cache.sets('d', 'd', None)
+    assert cache.gets('b') is None
+    assert cache.mgets(['a', 'c', 'd']) == ['a', 'c', 'd']
+    assert cache.evictions == 1
+
+
+def test_bounded_cache_lfu_eviction():
+    cache = BoundedMemoryCache(max_size=3, policy='lfu')
+    for key in ('a', 'b', 'c'):
+        cache.sets(key, key, None)
+    cache.gets('a')
+    cache.gets('a')
+    cache.gets('b')
+    cache.sets('d', 'd', None)
+    assert cache.gets('c') is None
+    cache.sets('e', 'e', None)
+    # d was used least
+    assert cache.gets('d') is None
+    assert cache.mgets(['a', 'b', 'e']) == ['a', 'b', 'e']
+
+
+def test_bounded_cache_lfu_admits_new_keys():
+    cache = BoundedMemoryCache(max_size=3, policy='lfu')
+    for key in ('a', 'b', 'c'):
+        cache.sets(key, 1, None)
+    for _ in range(2):
+        for key in ('a', 'b', 'c'):
+            cache.gets(key)
+    cache.sets('x', 1, None)
+    assert cache.gets('x') == 1
+    assert len(cache) == 3
+    assert cache.evictions == 1
+
+
+def test_bounded_cache_max_bytes():
+    cache = BoundedMemoryCache(max_bytes=2000)
+    for i in range(10):
+        cache.sets(f'{i}', {'result': 'x' * 500}, None)
+    assert cache.bytes <= 2000
+    assert len(cache) < 10
+    assert cache.gets('9') == {'result': 'x' * 500}
+    # values larger than the whole cache are not stored
+    cache.sets('big', 'x' * 5000, None)
+    assert cache.gets('big') is None
+
+
+def test_bounded_cache_max_size():
+    cache = BoundedMemoryCache(max_size=100)
+    for i in range(110):
+        cache.sets(f'{i}', 'value', None)
+    assert len(cache) == 100
+    assert cache.to_dict()['evictions'] == 10
+
+
+def test_bounded_cache_invalid_policy():
+    with pytest.raises(ValueError):
+        BoundedMemoryCache(policy='fifo')
+
+
+def test_cache_group_keeps_empty_memory_cache():
+    memory_cache = BoundedMemoryCache(max_size=10, policy='lfu')
+    assert len(memory_cache) == 0
+    cache_group = CacheGroup([], memory_cache=memory_cache)
+    assert cache_group._memory_cache is memory_cache
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from jussi.cache.backends.batcher import BatchedReadCache
+from jussi.cache.backends.lru import BoundedMemoryCache
+from jussi.cache.backends.redis import Cache
+from jussi.cache.backends.redis import MockClient
+
+
+class CountingMockClient(MockClient):
+    def __init__(self, cache):
+        super().__init__(cache)
+        self.mgets = []
+
+    async def mget(self, keys):
+        self.mgets.append(keys)
+        return await super().mget(keys)
+
+
+class FailingMockClient(MockClient):
+    async def mget(self, keys):
+        raise ConnectionRefusedError()
+
+
+def build_cache(client_class=CountingMockClient):
+    return Cache(client_class(cache=BoundedMemoryCache()))
+
+
+async def test_batched_reads():
+    cache = build_cache()
+    batched = BatchedReadCache(cache, window=0.01)
+    await batched.set('a', 1, 180)
+    await batched.set('b', 2, 180)
+    results = await asyncio.gather(batched.get('a'),
+                                   batched.mget(['a', 'b', 'c']),
+                                   batched.get('b'))
+    assert results == [1, [1, 2, None], 2]
+    assert cache.client.mgets == [['a', 'b', 'c']]
+    assert batched.to_dict() == {'batches': 1, 'reads': 3, 'keys': 3}
+
+
+async def test_batched_reads_max_keys():
+    cache = build_cache()
+    batched = BatchedReadCache(cache, window=10, max_keys=2)
+    results = await asyncio.gather(batched.get('a'), batched.get('b'))
+    assert results == [None, None]
+    assert len(cache.client.mgets) == 1
+
+
+async def test_batched_reads_empty():
+    batched = BatchedReadCache(build_cache(), window=10)
+    assert await batched.mget([]) == []
+
+
+async def test_batched_reads_error():
+    batched = BatchedReadCache(build_cache(FailingMockClient), window=0.001)
+    with pytest.raises(ConnectionRefusedError):
+        await batched.get('a')
+
+
+async def test_batched_reads_cancelled_waiter():
+    cache = build_cache()
+    batched = BatchedReadCache(cache, window=0.01)
+    await batched.set('a', 1, 180)
+    cancelled = asyncio.ensure_future(batched.get('a'))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    assert await batched.get('a') == 1
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import zlib
+
+import pytest
+import ujson
+
+from jussi.cache.codecs import CODECS
+from jussi.cache.codecs import CacheCodecs
+from jussi.cache.codecs import get_codec
+from jussi.cache.codecs import pack
+from jussi.cache.codecs import unpack
+
+VALUE = {'id': 1, 'jsonrpc': '2.0', 'result': {
+    'previous': '000003e7c4fd3221cf407efcf7c1730e2ca54b05',
+    'witness': 'initminer',
+    'transactions': [],
+    'body': '「又遲到了！」年輕人醒來的時候，已時八時三十分。'}}
+
+
+@pytest.mark.parametrize('name', list(CODECS.keys()))
+def test_codec_roundtrip(name):
+    assert unpack(pack(VALUE, get_codec(name))) == VALUE
+
+
+def test_legacy_zlib_values():
+    legacy = zlib.compress(ujson.dumps(VALUE, ensure_ascii=False).encode('utf8'))
+    assert unpack(legacy) == VALUE
+    assert pack(VALUE, get_codec('zlib_legacy')) == legacy
+
+
+def test_default_codec_is_legacy_zlib():
+    # older versions only read header-less zlib, see the rolling deploy notes
+    packed = CacheCodecs().pack(VALUE, key='key', expire_time=None)
+    assert packed[0] == 0x78
+    assert ujson.loads(zlib.decompress(packed).decode('utf8')) == VALUE
+
+
+def test_codec_headers_are_unique():
+    headers = [c.header for c in CODECS.values() if c.header]
+    assert len(headers) == len(set(headers))
+    assert b'\x78' not in headers
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        get_codec('snappy')
+    with pytest.raises(ValueError):
+        CacheCodecs(default='snappy')
+
+
+def test_cache_codecs_selection():
+    codecs = CacheCodecs.from_args(default='zlib', no_expire='none',
+                                   prefixes=['appbase.condenser_api.get_block=zlib_legacy'])
+    assert codecs.codec_for('appbase.condenser_api.get_block.params=[1]', 3).name == \
+        'zlib_legacy'
+    assert codecs.codec_for('appbase.condenser_api.get_accounts', 3).name == 'zlib'
+    assert codecs.codec_for('appbase.condenser_api.get_accounts', None).name == 'none'
+    assert codecs.codec_for('last_irreversible_block_num', 180).name == 'zlib'
+
+
+def test_cache_codecs_mixed_values():
+    zlib_codecs = CacheCodecs(default='zlib')
+    none_codecs = CacheCodecs(default='none')
+    assert none_codecs.unpack(zlib_codecs.pack(VALUE)) == VALUE
+    assert zlib_codecs.unpack(none_codecs.pack(VALUE)) == VALUE
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import pytest
+import ujson
 from time import perf_counter
 
 from jussi.cache.backends.max_ttl import SimplerMaxTTLMemoryCache
@@ -132,6 +133,16 @@ async def test_cache_group_clear():
     assert await cache_group.get('key') is None
 
 
+async def test_cache_group_reads_write_cache_without_read_cache_of_its_tier():
+    fast = CacheGroupItem(build_mocked_cache(), True, True, SpeedTier.FAST)
+    slow = CacheGroupItem(build_mocked_cache(), False, True, SpeedTier.SLOW)
+    cache_group = CacheGroup([slow, fast])
+    assert cache_group._read_caches == [fast.cache, slow.cache]
+
+    await slow.cache.set('key', 'value', 180)
+    assert await cache_group.get('key') == 'value'
+
+
 async def test_cache_group_get():
     caches = [
         CacheGroupItem(build_mocked_cache(), True, True, SpeedTier.FAST),
@@ -281,7 +292,7 @@ async def test_cache_group_get_batch_jsonrpc_responses():
             "extensions": [],
             "witness_signature": "207f15578cac20ac0e8af1ebb8f463106b8849577e21cca9fc60da146d1d95df88072dedc6ffb7f7f44a9185bbf9bf8139a5b4285c9f423843720296a44d428856",
             "transactions": [],
-            "block_id": "000003e8b922f4906a45af8e99d86b3511acd7a5",
+            "block_id": f"{_id:08x}b922f4906a45af8e99d86b3511acd7a5",
             "signing_key": "STM8GC13uCZbP44HzMLV6zPZGwVQ8Nt4Kji8PapsPiNq1BK153XTX",
             "transaction_ids": []
         }
@@ -317,7 +328,7 @@ async def test_cache_group_cache_batch_jsonrpc_responses():
         "extensions": [],
         "witness_signature": "207f15578cac20ac0e8af1ebb8f463106b8849577e21cca9fc60da146d1d95df88072dedc6ffb7f7f44a9185bbf9bf8139a5b4285c9f423843720296a44d428856",
         "transactions": [],
-        "block_id": "000003e8b922f4906a45af8e99d86b3511acd7a5",
+        "block_id": f"{_id:08x}b922f4906a45af8e99d86b3511acd7a5",
         "signing_key": "STM8GC13uCZbP44HzMLV6zPZGwVQ8Nt4Kji8PapsPiNq1BK153XTX",
         "transaction_ids": []}} for _id in range(1, 10)]
 
@@ -385,3 +396,66 @@ def test_cache_group_x_jussi_cache_key(steemd_request_and_response):
     batch_req = [req, req, req]
     assert jsonrpc_cache_key(req) == CacheGroup.x_jussi_cache_key(req)
     assert CacheGroup.x_jussi_cache_key(batch_req) == 'batch'
+
+
+async def test_cache_group_encoded_memory_cache(steemd_request_and_response):
+    caches = [
+        CacheGroupItem(build_mocked_cache(), True, True, SpeedTier.FAST)
+    ]
+    cache_group = CacheGroup(caches, encoded_memory_cache=True)
+    req, resp = steemd_request_and_response
+    req = jsonrpc_from_request(dummy_request, 0, req)
+    resp['jsonrpc'] = '2.0'
+    key = jsonrpc_cache_key(req)
+    await cache_group.set('last_irreversible_block_num', 15_000_000, 180)
+    await cache_group.cache_single_jsonrpc_response(req, resp)
+    assert isinstance(cache_group._memory_cache.gets(key), bytes)
+    cached_response = await cache_group.get_single_jsonrpc_response(req)
+    assert ujson.loads(cached_response) == resp
+    # slower caches still store parsed responses
+    assert await caches[0].cache.get(key) == resp
+
+
+async def test_cache_group_encoded_batch_jsonrpc_responses():
+    batch_req = [jsonrpc_from_request(dummy_request, _id, {
+        "id": _id, "jsonrpc": "2.0", "method": "get_block",
+        "params": [_id]
+    }) for _id in range(1, 4)]
+    batch_resp = [{'id': _id, "jsonrpc": "2.0",
+                   'result': dict(jrpc_resp_1['result'],
+                                  block_id=f'{_id:08x}' + jrpc_resp_1['result']['block_id'][8:])}
+                  for _id in range(1, 4)]
+    caches = [
+        CacheGroupItem(build_mocked_cache(), True, True, SpeedTier.FAST)
+    ]
+    cache_group = CacheGroup(caches, encoded_memory_cache=True)
+    await cache_group.set('last_irreversible_block_num', 15_000_000, 180)
+    await cache_group.cache_batch_jsonrpc_response(batch_req, batch_resp)
+
+    test_responses = await cache_group.get_batch_jsonrpc_responses(batch_req)
+    assert ujson.loads(test_responses) == batch_resp
+
+    # mixed encoded memory cache and parsed slow cache results
+    cache_group._memory_cache.deletes(jsonrpc_cache_key(batch_req[0]))
+    test_responses = await cache_group.get_batch_jsonrpc_responses(batch_req)
+    assert ujson.loads(test_responses) == batch_resp
+
+
+async def test_cache_group_encoded_memory_cache_validates_get_block():
+    # a get_block result for another block is neither cached nor encoded
+    batch_req = [jsonrpc_from_request(dummy_request, _id, {
+        "id": _id, "jsonrpc": "2.0", "method": "get_block",
+        "params": [_id]
+    }) for _id in (1000, 1001)]
+    batch_resp = [{'id': _id, "jsonrpc": "2.0", 'result': jrpc_resp_1['result']}
+                  for _id in (1000, 1001)]
+    caches = [
+        CacheGroupItem(build_mocked_cache(), True, True, SpeedTier.FAST)
+    ]
+    cache_group = CacheGroup(caches, encoded_memory_cache=True)
+    await cache_group.set('last_irreversible_block_num', 15_000_000, 180)
+    await cache_group.cache_batch_jsonrpc_response(batch_req, batch_resp)
+    assert isinstance(cache_group._memory_cache.gets(jsonrpc_cache_key(batch_req[0])), bytes)
+    assert cache_group._memory_cache.gets(jsonrpc_cache_key(batch_req[1])) is None
+    assert await caches[0].cache.get(jsonrpc_cache_key(batch_req[1])) is None
+    assert cache_group.memory_cache_value(batch_resp[1], batch_req[1]) == batch_resp[1]
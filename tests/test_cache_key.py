@@ -1,8 +1,46 @@
 # -*- coding: utf-8 -*-
+import pytest
+
 from jussi.cache.utils import jsonrpc_cache_key
+from jussi.empty import _empty
+from jussi.urn import URN
+from jussi.urn import from_request
 
 
 def test_cache_key(urn_test_requests):
     jsonrpc_request, urn, url, ttl, timeout, jussi_request = urn_test_requests
     result = jsonrpc_cache_key(jussi_request)
-    assert result == urn
+    assert result == jussi_request.urn.cache_key()
+    assert result.startswith(urn.split('.params=')[0] + '.v1')
+
+
+@pytest.mark.parametrize('jsonrpc_request,expected', [
+    ({'id': 1, 'jsonrpc': '2.0', 'method': 'get_dynamic_global_properties'},
+     'hived.database_api.get_dynamic_global_properties.v1'),
+    ({'id': 1, 'jsonrpc': '2.0', 'method': 'get_block', 'params': [1000]},
+     'hived.database_api.get_block.v1=[1000]'),
+    ({'id': 1, 'jsonrpc': '2.0', 'method': 'block_api.get_block', 'params': {'block_num': 1}},
+     'appbase.block_api.get_block.v1={"block_num":1}'),
+    ({'id': 1, 'jsonrpc': '2.0', 'method': 'condenser_api.get_accounts',
+      'params': [['a' * 16, 'b' * 16]]},
+     'appbase.condenser_api.get_accounts.v1:e9f21c0d169e37fbaecc349866476dda'),
+])
+def test_cache_key_format(jsonrpc_request, expected):
+    assert from_request(jsonrpc_request).cache_key() == expected
+
+
+def test_cache_key_canonical_params():
+    urn1 = URN('appbase', 'test_api', 'method', {'a': {'c': 1, 'b': [1] * 20}})
+    urn2 = URN('appbase', 'test_api', 'method', {'a': {'b': [1] * 20, 'c': 1}})
+    assert urn1.cache_key() == urn2.cache_key()
+    assert urn1.cache_key() != URN('appbase', 'test_api', 'method', [1] * 20).cache_key()
+    assert URN('appbase', 'test_api', 'method', []).cache_key() != \
+        URN('appbase', 'test_api', 'method', _empty).cache_key()
+
+
+def test_urn_eq_is_exact():
+    urn = URN('appbase', 'test_api', 'method', [1])
+    assert urn == URN('appbase', 'test_api', 'method', [1])
+    assert urn == 'appbase.test_api.method.params=[1]'
+    assert urn != URN('appbase', 'test_api', 'method', [2])
+    assert urn != 1
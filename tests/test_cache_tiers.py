@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+from jussi.cache import CacheGroupItem
+from jussi.cache import SpeedTier
+from jussi.cache.backends.block_store import BlockStore
+from jussi.cache.backends.max_ttl import SimplerMaxTTLMemoryCache
+from jussi.cache.cache_group import CacheGroup
+from jussi.cache.tiers import Admission
+from jussi.cache.tiers import WriteBehind
+from jussi.cache.utils import FRESH_UNTIL
+from jussi.urn import URN
+
+RESPONSE = {'id': 1, 'jsonrpc': '2.0', 'result': {'block_id': '000003e8'}}
+
+
+def make_cache_group(**kwargs):
+    fast = CacheGroupItem(SimplerMaxTTLMemoryCache(), True, True, SpeedTier.FAST)
+    slow = CacheGroupItem(SimplerMaxTTLMemoryCache(), True, True, SpeedTier.SLOW)
+    return CacheGroup([slow, fast], **kwargs), fast.cache, slow.cache
+
+
+def test_admission():
+    admission = Admission(min_hits=2, max_keys=2)
+    assert admission.admit('a') is False
+    assert admission.admit('a') is True
+    assert admission.admit('a') is False
+    admission.admit('b')
+    admission.admit('c')
+    # counts are reset when full
+    assert admission.admit('b') is False
+    assert Admission(min_hits=1).admit('a') is True
+
+
+async def test_promotion():
+    cache_group, fast, slow = make_cache_group(promote_min_hits=2, promote_ttl=5,
+                                               encoded_memory_cache=True)
+    await slow.set('key', RESPONSE, 180)
+    assert await cache_group.get('key') == RESPONSE
+    assert await fast.get('key') is None
+    assert await cache_group.get('key') == RESPONSE
+    await cache_group._promotions.flush()
+    assert await fast.get('key') == RESPONSE
+    # values are promoted as they are, for at most promote_ttl seconds
+    assert cache_group._memory_cache.gets('key') == RESPONSE
+    assert 4 < (await fast.ttls(['key']))[0] <= 5
+    stats = cache_group.tier_stats()['read_tiers']
+    assert [(s['speed_tier'], s['hits'], s['misses'], s['promotions']) for s in stats] == \
+        [('FAST', 0, 2, 0), ('SLOW', 2, 0, 1)]
+
+
+async def test_promotion_mget():
+    cache_group, fast, slow = make_cache_group(promote_min_hits=1)
+    await fast.set('a', 1, 180)
+    await slow.set('b', 2, 180)
+    assert await cache_group.mget(['a', 'b', 'c']) == [1, 2, None]
+    await cache_group._promotions.flush()
+    assert await fast.get('b') == 2
+    assert cache_group._memory_cache.gets('b') == 2
+    # values are only promoted into faster tiers
+    assert await slow.get('a') is None
+
+
+async def test_no_promotion_by_default():
+    cache_group, fast, slow = make_cache_group()
+    await slow.set('key', 1, 180)
+    for _ in range(3):
+        assert await cache_group.get('key') == 1
+    assert await fast.get('key') is None
+
+
+async def test_write_behind():
+    cache_group, fast, slow = make_cache_group(write_behind=True)
+    assert cache_group._write_behind_caches == [slow]
+    await cache_group.set('a', 1, 180)
+    await cache_group.set_many({'b': 2}, 180)
+    assert await fast.mget(['a', 'b']) == [1, 2]
+    await cache_group._write_behind.flush()
+    assert await slow.mget(['a', 'b']) == [1, 2]
+    assert cache_group.tier_stats()['write_behind']['written'] == 2
+
+
+async def test_write_behind_max_pending():
+    write_behind = WriteBehind(max_pending=1)
+    done = []
+
+    async def write(value):
+        done.append(value)
+    write_behind.submit(write(1))
+    write_behind.submit(write(2))
+    await write_behind.flush()
+    assert done == [1]
+    assert write_behind.to_dict()['dropped'] == 1
+
+
+async def test_promotion_keeps_remaining_ttl_and_stale_marker():
+    cache_group, fast, slow = make_cache_group(promote_min_hits=1, promote_ttl=60)
+    stale = dict(RESPONSE, **{FRESH_UNTIL: 1.0})
+    await slow.set('stale', stale, 2)
+    assert await cache_group.get('stale') == stale
+    await cache_group._promotions.flush()
+    assert await fast.get('stale') == stale
+    assert cache_group._memory_cache.gets('stale') == stale
+    assert (await fast.ttls(['stale']))[0] <= 2
+
+
+async def test_no_promotion_into_block_store(tmpdir):
+    block_store = BlockStore(str(tmpdir))
+    slow = SimplerMaxTTLMemoryCache()
+    cache_group = CacheGroup([CacheGroupItem(slow, True, True, SpeedTier.SLOW),
+                              CacheGroupItem(block_store, True, True, SpeedTier.FAST)],
+                             promote_min_hits=1)
+    key = URN('appbase', 'condenser_api', 'get_block', [1]).cache_key()
+    await slow.set(key, RESPONSE, 180)
+    assert await cache_group.get(key) == RESPONSE
+    await cache_group._promotions.flush()
+    assert block_store.stored == 0
+    assert cache_group._memory_cache.gets(key) == RESPONSE
+    block_store.close()
+
+
+async def test_reads_dont_wait_for_promotion():
+    cache_group, fast, slow = make_cache_group(promote_min_hits=1)
+    await slow.set('key', RESPONSE, 180)
+    assert await cache_group.get('key') == RESPONSE
+    # promoted in the background
+    assert await fast.get('key') is None
+    await cache_group._promotions.flush()
+    assert await fast.get('key') == RESPONSE
+    assert cache_group.tier_stats()['promotions']['written'] == 1
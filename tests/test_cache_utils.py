@@ -2,7 +2,12 @@
 import pytest
 
 
+import ujson
+
 from jussi.cache.utils import block_num_from_jsonrpc_response
+from jussi.cache.utils import encode_cached_result
+from jussi.cache.utils import merge_encoded_cached_response
+from jussi.empty import _empty
 
 # FIXME add all formats of get_block and get_block_header responses
 ttl_rpc_req = {"id": "1", "jsonrpc": "2.0",
@@ -31,3 +36,21 @@ non_ttl_rpc_req = {"id": "1", "jsonrpc": "2.0",
 def test_block_num_from_jsonrpc_response(response, expected):
     num = block_num_from_jsonrpc_response(response)
     assert num == expected
+
+
+class FakeRequest:
+    def __init__(self, _id):
+        self.id = _id
+
+
+@pytest.mark.parametrize('_id', [1, '1', None, 'a"b'])
+def test_merge_encoded_cached_response(_id):
+    encoded = encode_cached_result(rpc_resp)
+    merged = ujson.loads(merge_encoded_cached_response(FakeRequest(_id), encoded))
+    assert merged == {'id': _id, 'jsonrpc': '2.0', 'result': rpc_resp['result']}
+
+
+def test_merge_encoded_cached_response_no_id():
+    encoded = encode_cached_result(rpc_resp)
+    merged = ujson.loads(merge_encoded_cached_response(FakeRequest(_empty), encoded))
+    assert merged == {'jsonrpc': '2.0', 'result': rpc_resp['result']}
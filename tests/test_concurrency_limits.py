@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import jussi.handlers
+from jussi.concurrency_limits import AdaptiveConcurrencyLimiter
+from jussi.concurrency_limits import UpstreamConcurrencyLimits
+from jussi.errors import UpstreamOverloadedError
+from jussi.handlers import fetch_with_limit
+
+
+def test_limiter_rejects_over_limit():
+    limiter = AdaptiveConcurrencyLimiter(limit=2, min_limit=1)
+    assert limiter.try_acquire()
+    assert limiter.try_acquire()
+    assert not limiter.try_acquire()
+    assert limiter.to_dict()['rejected'] == 1
+    limiter.on_ignore()
+    assert limiter.try_acquire()
+
+
+def test_limiter_additive_increase():
+    limiter = AdaptiveConcurrencyLimiter(limit=10, max_limit=11)
+    for _ in range(200):
+        for _ in range(10):
+            limiter.try_acquire()
+        for _ in range(10):
+            limiter.observe(0.01)
+            limiter.on_success()
+    assert limiter.limit == 11
+
+
+def test_limiter_no_increase_when_idle():
+    limiter = AdaptiveConcurrencyLimiter(limit=10)
+    for _ in range(100):
+        limiter.try_acquire()
+        limiter.observe(0.01)
+        limiter.on_success()
+    assert limiter.limit == 10
+
+
+def test_limiter_multiplicative_decrease():
+    limiter = AdaptiveConcurrencyLimiter(limit=100, min_limit=50, backoff=0.5)
+    limiter.observe(0.01)
+    limiter.observe(0.05)
+    assert limiter.limit == 50
+    limiter.try_acquire()
+    limiter.on_drop()
+    assert limiter.limit == 50
+
+
+def test_limiter_decreases_once_per_rtt():
+    limiter = AdaptiveConcurrencyLimiter(limit=100, min_limit=1, backoff=0.5)
+    limiter.observe(10)
+    for _ in range(3):
+        limiter.try_acquire()
+        limiter.on_drop()
+    assert limiter.limit == 50
+
+
+def test_limiter_baseline_per_method():
+    limiter = AdaptiveConcurrencyLimiter(limit=100)
+    for i in range(1000):
+        limiter.try_acquire()
+        if i % 10:
+            limiter.observe(0.002, 'condenser_api.get_dynamic_global_properties')
+        else:
+            limiter.observe(0.05, 'condenser_api.get_account_history')
+        limiter.on_success()
+    assert limiter.limit == 100
+    assert limiter.to_dict()['min_rtts'] == {
+        'condenser_api.get_dynamic_global_properties': 0.002,
+        'condenser_api.get_account_history': 0.05}
+    limiter.observe(0.2, 'condenser_api.get_account_history')
+    assert limiter.limit == 90
+
+
+def make_http_request(limits):
+    config = SimpleNamespace(upstream_concurrency_limits=limits,
+                             args=SimpleNamespace(upstream_overload_retry_after=2,
+                                                  log_traceback=False))
+    return SimpleNamespace(app=SimpleNamespace(config=config))
+
+
+class FakeJrpcRequest:
+    upstream = SimpleNamespace(url='http://test.com')
+    id = 1
+
+
+async def test_fetch_with_limit(monkeypatch):
+    async def fetch_with_retries(http_request, jrpc_request):
+        await asyncio.sleep(0.01)
+        return {'id': 1, 'result': 'ok'}
+    monkeypatch.setattr(jussi.handlers, 'fetch_with_retries', fetch_with_retries)
+    limits = UpstreamConcurrencyLimits(limit=1, min_limit=1)
+    http_request = make_http_request(limits)
+    first = asyncio.ensure_future(fetch_with_limit(http_request, FakeJrpcRequest()))
+    await asyncio.sleep(0)
+    with pytest.raises(UpstreamOverloadedError) as e:
+        await fetch_with_limit(http_request, FakeJrpcRequest())
+    assert e.value.format_message() == \
+        'Upstream http://test.com is overloaded, retry after 2 seconds'
+    assert (await first)['result'] == 'ok'
+    assert limits.to_dict()['http://test.com']['in_flight'] == 0
+
+
+def test_overloaded_error_response():
+    error = UpstreamOverloadedError(url='http://test.com', retry_after=3)
+    sanic_response = error.to_sanic_response()
+    assert sanic_response.status == 503
+    assert sanic_response.headers['Retry-After'] == '3'
+
+
+async def test_fetch_with_limit_cancelled(monkeypatch):
+    async def fetch_with_retries(http_request, jrpc_request):
+        await asyncio.sleep(10)
+    monkeypatch.setattr(jussi.handlers, 'fetch_with_retries', fetch_with_retries)
+    limits = UpstreamConcurrencyLimits(limit=10, min_limit=1)
+    fetch = asyncio.ensure_future(fetch_with_limit(make_http_request(limits),
+                                                   FakeJrpcRequest()))
+    await asyncio.sleep(0)
+    fetch.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await fetch
+    assert limits.to_dict()['http://test.com'] == {
+        'limit': 10, 'in_flight': 0, 'rejected': 0, 'min_rtts': {}}
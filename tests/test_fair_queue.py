@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+from jussi.fair_queue import UpstreamFairQueues
+from jussi.fair_queue import WeightedFairQueue
+
+
+async def serve_in_order(queue, requests):
+    """queue requests behind a busy upstream, and return the order they're served in"""
+    await queue.acquire('normal', 'busy')
+    order = []
+
+    async def request(name, priority, client):
+        await queue.acquire(priority, client)
+        order.append(name)
+        queue.release()
+    tasks = [asyncio.ensure_future(request(*r)) for r in requests]
+    await asyncio.sleep(0)
+    queue.release()
+    await asyncio.gather(*tasks)
+    return order
+
+
+async def test_fair_queue_no_wait_when_idle():
+    queue = WeightedFairQueue(2)
+    await queue.acquire('bulk', '1.1.1.1')
+    await queue.acquire('bulk', '1.1.1.1')
+    assert queue.to_dict() == {'concurrency': 2, 'in_flight': 2, 'waiting': 0, 'queued': 0}
+
+
+async def test_fair_queue_priorities():
+    queue = WeightedFairQueue(1)
+    requests = [(f'bulk{i}', 'bulk', '1.1.1.1') for i in range(4)]
+    requests.append(('critical', 'critical', '1.1.1.1'))
+    order = await serve_in_order(queue, requests)
+    assert order.index('critical') <= 1
+
+
+async def test_fair_queue_clients_share_a_class():
+    queue = WeightedFairQueue(1)
+    requests = [(f'greedy{i}', 'normal', '1.1.1.1') for i in range(6)]
+    requests += [(f'other{i}', 'normal', '2.2.2.2') for i in range(2)]
+    order = await serve_in_order(queue, requests)
+    assert order[:4] == ['greedy0', 'other0', 'greedy1', 'other1']
+
+
+async def test_fair_queue_cancelled_waiter():
+    queue = WeightedFairQueue(1)
+    await queue.acquire('normal', 'a')
+    cancelled = asyncio.ensure_future(queue.acquire('normal', 'b'))
+    waiting = asyncio.ensure_future(queue.acquire('normal', 'c'))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    await asyncio.sleep(0)
+    queue.release()
+    await waiting
+    assert queue.in_flight == 1
+    assert len(queue) == 0
+
+
+def test_upstream_fair_queues():
+    queues = UpstreamFairQueues(4, loop=asyncio.new_event_loop())
+    assert queues['http://test.com'] is queues['http://test.com']
+    assert queues.to_dict()['http://test.com']['concurrency'] == 4
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import jussi.handlers
+from jussi.cache.cache_group import CacheGroup
+from jussi.cache.utils import FRESH_UNTIL
+from jussi.fan_out import cached_result
+from jussi.fan_out import fan_out_items
+from jussi.fan_out import join_results
+from jussi.fan_out import split_result
+from jussi.fan_out import with_items
+from jussi.handlers import dispatch_fan_out
+from jussi.request.jsonrpc import from_http_request
+from jussi.upstream import FanOut
+from jussi.upstream import _Upstreams
+
+CONFIG = {
+    "limits": {},
+    "upstreams": [
+        {
+            "name": "appbase",
+            "urls": [["appbase", "http://test.com"]],
+            "ttls": [["appbase", 3]],
+            "timeouts": [["appbase", 1]],
+            "fan_outs": [
+                ["appbase.condenser_api.get_accounts", {"param": 0, "key": "name"}],
+                ["appbase.condenser_api.lookup_account_names", {"param": 0}],
+                ["appbase.database_api.find_accounts",
+                 {"param": "accounts", "key": "name", "result": "accounts"}]
+            ]
+        }
+    ]
+}
+UPSTREAMS = _Upstreams(CONFIG, validate=False)
+STALE_CONFIG = {
+    "limits": {},
+    "upstreams": [dict(CONFIG['upstreams'][0],
+                       stale_ttls=[["appbase.condenser_api.get_accounts", 60]])]
+}
+ACCOUNTS = {name: {'name': name, 'balance': f'{i}.000 HIVE'}
+            for i, name in enumerate(('alice', 'bob', 'carol', 'dave'))}
+
+
+def make_http_request(cache_group=None):
+    config = SimpleNamespace(upstreams=UPSTREAMS,
+                             cache_group=cache_group or CacheGroup([]),
+                             last_irreversible_block_num=1)
+    return SimpleNamespace(app=SimpleNamespace(config=config),
+                           amzn_trace_id=None,
+                           jussi_request_id='123')
+
+
+def make_request(http_request, request_dict):
+    return from_http_request(http_request, 0, dict({'id': 1, 'jsonrpc': '2.0'}, **request_dict))
+
+
+def get_accounts(http_request, names):
+    return make_request(http_request, {'method': 'condenser_api.get_accounts',
+                                       'params': [names]})
+
+
+@pytest.mark.parametrize('request_dict,expected', [
+    ({'method': 'condenser_api.get_accounts', 'params': [['alice', 'bob']]}, ['alice', 'bob']),
+    ({'method': 'call', 'params': ['condenser_api', 'get_accounts', [['alice', 'bob']]]},
+     ['alice', 'bob']),
+    ({'method': 'database_api.find_accounts', 'params': {'accounts': ['alice', 'bob']}},
+     ['alice', 'bob']),
+    ({'method': 'condenser_api.get_accounts', 'params': [['alice']]}, None),
+    ({'method': 'condenser_api.get_accounts', 'params': [['alice', 'alice']]}, None),
+    ({'method': 'condenser_api.get_accounts', 'params': ['alice']}, None),
+    ({'method': 'condenser_api.get_account_count', 'params': [['alice', 'bob']]}, None),
+])
+def test_fan_out_items(request_dict, expected):
+    request = make_request(make_http_request(), request_dict)
+    assert fan_out_items(request) == expected
+
+
+def test_with_items():
+    http_request = make_http_request()
+    request = make_request(http_request, {
+        'method': 'call', 'params': ['condenser_api', 'get_accounts', [['alice', 'bob']]]})
+    assert with_items(request, ['bob']) == {
+        'id': 1, 'jsonrpc': '2.0', 'method': 'call',
+        'params': ['condenser_api', 'get_accounts', [['bob']]]}
+    request = make_request(http_request, {
+        'method': 'database_api.find_accounts', 'params': {'accounts': ['alice', 'bob']}})
+    assert with_items(request, ['bob'])['params'] == {'accounts': ['bob']}
+
+
+@pytest.mark.parametrize('fan_out,items,result,expected', [
+    (FanOut(0, None, None), ['a', 'b'], [1, None], [[1], [None]]),
+    (FanOut(0, None, None), ['a', 'b'], [1], None),
+    (FanOut(0, 'name', None), ['a', 'b', 'c'], [{'name': 'c'}, {'name': 'a'}],
+     [[{'name': 'a'}], [], [{'name': 'c'}]]),
+    (FanOut(0, 'name', None), ['a', 'b'], [{'name': 'x'}], None),
+    (FanOut('accounts', 'name', 'accounts'), ['a', 'b'], {'accounts': [{'name': 'b'}]},
+     [{'accounts': []}, {'accounts': [{'name': 'b'}]}]),
+])
+def test_split_result(fan_out, items, result, expected):
+    results = split_result(fan_out, items, result)
+    assert results == expected
+    if expected is not None and fan_out.key is None:
+        assert join_results(fan_out, results) == result
+
+
+async def test_dispatch_fan_out(monkeypatch):
+    upstream_requests = []
+
+    async def dispatch_single(http_request, jrpc_request):
+        names = jrpc_request.urn.params[0]
+        upstream_requests.append(names)
+        return {'id': jrpc_request.id, 'jsonrpc': '2.0',
+                'result': [ACCOUNTS[name] for name in names if name in ACCOUNTS]}
+    monkeypatch.setattr(jussi.handlers, 'dispatch_single', dispatch_single)
+    http_request = make_http_request()
+
+    response = await dispatch_fan_out(http_request, get_accounts(http_request, ['alice', 'bob']))
+    assert response['result'] == [ACCOUNTS['alice'], ACCOUNTS['bob']]
+    await asyncio.sleep(0.01)
+    # only missing items are sent upstream, and results keep the requested order
+    response = await dispatch_fan_out(http_request,
+                                      get_accounts(http_request, ['carol', 'bob', 'nobody']))
+    assert response == {'id': 1, 'jsonrpc': '2.0', 'result': [ACCOUNTS['carol'], ACCOUNTS['bob']]}
+    await asyncio.sleep(0.01)
+    response = await dispatch_fan_out(http_request,
+                                      get_accounts(http_request, ['nobody', 'carol', 'alice']))
+    assert response['result'] == [ACCOUNTS['carol'], ACCOUNTS['alice']]
+    assert upstream_requests == [['alice', 'bob'], ['carol', 'nobody']]
+
+
+async def test_dispatch_fan_out_upstream_error(monkeypatch):
+    error = {'id': 1, 'jsonrpc': '2.0', 'error': {'code': -32000}}
+
+    async def dispatch_single(http_request, jrpc_request):
+        return error
+    monkeypatch.setattr(jussi.handlers, 'dispatch_single', dispatch_single)
+    http_request = make_http_request()
+    assert await dispatch_fan_out(http_request,
+                                  get_accounts(http_request, ['alice', 'bob'])) == error
+
+
+def test_cached_result_with_stale_marker():
+    fan_out = FanOut(param=0, key='name', result=None)
+    response = {'id': 1, 'jsonrpc': '2.0', 'result': [ACCOUNTS['alice']]}
+    assert cached_result(fan_out, dict(response, **{FRESH_UNTIL: time.time() + 10})) == \
+        [ACCOUNTS['alice']]
+    assert cached_result(fan_out, dict(response, **{FRESH_UNTIL: time.time() - 10})) is None
+    assert cached_result(fan_out, response) == [ACCOUNTS['alice']]
+
+
+async def test_dispatch_fan_out_stale_ttls(monkeypatch):
+    upstream_requests = []
+
+    async def dispatch_single(http_request, jrpc_request):
+        upstream_requests.append(jrpc_request.urn.params[0])
+    monkeypatch.setattr(jussi.handlers, 'dispatch_single', dispatch_single)
+    http_request = make_http_request()
+    http_request.app.config.upstreams = _Upstreams(STALE_CONFIG, validate=False)
+    cache_group = http_request.app.config.cache_group
+    # requests for one item are cached as usual, with a stale marker
+    for name in ('alice', 'bob'):
+        request = get_accounts(http_request, [name])
+        assert request.upstream.stale_ttl == 60
+        await cache_group.cache_single_jsonrpc_response(
+            request=request, response={'id': 1, 'jsonrpc': '2.0', 'result': [ACCOUNTS[name]]})
+    response = await dispatch_fan_out(http_request, get_accounts(http_request, ['bob', 'alice']))
+    assert response['result'] == [ACCOUNTS['bob'], ACCOUNTS['alice']]
+    assert upstream_requests == []
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from jussi.http_pools import UpstreamHTTPPools
+from jussi.upstream import _Upstreams
+from jussi.urn import URN
+
+
+class FakeUpstreams:
+    @staticmethod
+    def health_check(url):
+        return {}
+
+
+async def start_server(delay=0.0):
+    async def handle(request):
+        await asyncio.sleep(delay)
+        return web.json_response({'id': 0, 'jsonrpc': '2.0', 'result': {}})
+    app = web.Application()
+    app.router.add_post('/', handle)
+    server = TestServer(app)
+    await server.start_server()
+    return server
+
+
+async def test_http_pools_per_url():
+    slow = await start_server(delay=0.05)
+    fast = await start_server()
+    slow_url, fast_url = str(slow.make_url('/')), str(fast.make_url('/'))
+    pools = UpstreamHTTPPools([slow_url, fast_url, 'ws://test.com'], limit=1)
+    assert slow_url in pools and 'ws://test.com' not in pools
+
+    async def post(url):
+        async with pools.session(url).post(url, json={}) as resp:
+            return await resp.json()
+    slow_requests = asyncio.ensure_future(asyncio.gather(*[post(slow_url) for _ in range(3)]))
+    await asyncio.sleep(0.01)
+    # a saturated upstream doesn't hold up the others
+    await asyncio.wait_for(post(fast_url), 0.04)
+    await slow_requests
+
+    data = pools.to_dict()
+    assert data[slow_url]['limit'] == 1
+    assert data[slow_url]['queued'] == 2
+    assert data[slow_url]['queued_time_max'] > 0.03
+    assert data[fast_url]['queued'] == 0
+    assert data[slow_url]['in_use'] == 0
+    await pools.close()
+    await slow.close()
+    await fast.close()
+
+
+async def test_http_pools_prewarm():
+    server = await start_server(delay=0.01)
+    url = str(server.make_url('/'))
+    pools = UpstreamHTTPPools([url])
+    await pools.prewarm(FakeUpstreams, min_connections=3)
+    data = pools.to_dict()[url]
+    assert data['created'] == 3
+    assert data['idle'] == 3
+    await pools.close()
+    await server.close()
+
+
+async def test_http_pools_account_transfer_url(monkeypatch):
+    server = await start_server()
+    transfer_url = str(server.make_url('/'))
+    monkeypatch.setenv('JUSSI_ACCOUNT_TRANSFER_STEEMD_URL', transfer_url)
+    upstreams = _Upstreams({'limits': {}, 'upstreams': [{
+        'name': 'appbase',
+        'urls': [['appbase', 'http://appbase.test.com']],
+        'ttls': [['appbase', 3]],
+        'timeouts': [['appbase', 3]]}]}, validate=False)
+    pools = UpstreamHTTPPools(upstreams.urls)
+    url = upstreams.url(URN('appbase', 'condenser_api', 'get_state', ['@a/transfers']))
+    assert url == transfer_url
+    assert url not in pools
+    async with pools.session(url).post(url, json={}) as resp:
+        assert (await resp.json())['result'] == {}
+    assert pools.to_dict()[url]['created'] == 1
+    await pools.close()
+    await server.close()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+from types import SimpleNamespace
+
+import pytest
+import ujson
+
+from jussi.cache.cache_group import CacheGroup
+from jussi.cache.cache_group import UncacheableResponse
+from jussi.cache.utils import NegativeResponse
+from jussi.middlewares.caching import get_response
+from jussi.request.jsonrpc import from_http_request
+from jussi.upstream import _Upstreams
+
+CONFIG = {
+    "limits": {},
+    "upstreams": [
+        {
+            "name": "appbase",
+            "urls": [["appbase", "http://test.com"]],
+            "ttls": [["appbase", 3],
+                     ["appbase.condenser_api.get_block", -2],
+                     ["appbase.condenser_api.no_cache", -1]],
+            "timeouts": [["appbase", 1]]
+        }
+    ]
+}
+UPSTREAMS = _Upstreams(CONFIG, validate=False)
+UNKNOWN_ACCOUNT = {'code': -32003, 'message': 'Assert Exception:account != nullptr'}
+
+
+def make_http_request(method, params=None, cache_group=None):
+    config = SimpleNamespace(upstreams=UPSTREAMS,
+                             cache_group=cache_group,
+                             cache_read_timeout=1)
+    http_request = SimpleNamespace(app=SimpleNamespace(config=config),
+                                   amzn_trace_id=None,
+                                   jussi_request_id='123',
+                                   is_single_jrpc=True,
+                                   is_batch_jrpc=False,
+                                   timings=[])
+    http_request.jsonrpc = from_http_request(http_request, 0, {
+        'id': 1, 'jsonrpc': '2.0', 'method': f'condenser_api.{method}', 'params': params or [1]})
+    return http_request
+
+
+def make_cache_group():
+    return CacheGroup([], negative_ttl=0.5, error_ttl=0.5, error_codes=[-32602, -32003])
+
+
+@pytest.mark.parametrize('method,response,expected', [
+    ('get_block', {'id': 1, 'jsonrpc': '2.0', 'result': None},
+     {'id': 1, 'jsonrpc': '2.0', 'result': None}),
+    ('get_block', {'id': 1, 'jsonrpc': '2.0', 'result': {}},
+     {'id': 1, 'jsonrpc': '2.0', 'result': {}}),
+    ('get_accounts', {'id': 1, 'jsonrpc': '2.0', 'error': UNKNOWN_ACCOUNT},
+     {'id': 1, 'jsonrpc': '2.0', 'error': UNKNOWN_ACCOUNT}),
+])
+async def test_negative_response_cached(method, response, expected):
+    cache_group = make_cache_group()
+    request = make_http_request(method).jsonrpc
+    await cache_group.cache_single_jsonrpc_response(request=request, response=response)
+    cached = await cache_group.get_single_jsonrpc_response(request)
+    assert cached == NegativeResponse(expected)
+    # never mistaken for a cached result
+    assert await cache_group.get_batch_jsonrpc_responses([request]) == [None]
+
+
+@pytest.mark.parametrize('method,response', [
+    ('get_accounts', {'id': 1, 'jsonrpc': '2.0', 'error': {'code': -32000}}),
+    ('no_cache', {'id': 1, 'jsonrpc': '2.0', 'result': None}),
+    ('no_cache', {'id': 1, 'jsonrpc': '2.0', 'error': UNKNOWN_ACCOUNT}),
+])
+async def test_negative_response_not_cached(method, response):
+    cache_group = make_cache_group()
+    request = make_http_request(method).jsonrpc
+    try:
+        await cache_group.cache_single_jsonrpc_response(request=request, response=response)
+    except UncacheableResponse:
+        pass
+    assert await cache_group.get_single_jsonrpc_response(request) is None
+
+
+async def test_null_result_cached_with_method_ttl():
+    cache_group = make_cache_group()
+    request = make_http_request('get_accounts').jsonrpc
+    response = {'id': 1, 'jsonrpc': '2.0', 'result': None}
+    await cache_group.cache_single_jsonrpc_response(request=request, response=response)
+    assert await cache_group.get_single_jsonrpc_response(request) == response
+
+
+async def test_negative_caching_disabled():
+    cache_group = CacheGroup([])
+    request = make_http_request('get_block').jsonrpc
+    with pytest.raises(UncacheableResponse):
+        await cache_group.cache_single_jsonrpc_response(
+            request=request, response={'id': 1, 'jsonrpc': '2.0', 'result': None},
+            last_irreversible_block_num=1)
+    assert await cache_group.get_single_jsonrpc_response(request) is None
+
+
+async def test_get_response_negative_hit():
+    cache_group = make_cache_group()
+    http_request = make_http_request('get_accounts', cache_group=cache_group)
+    await cache_group.cache_single_jsonrpc_response(
+        request=http_request.jsonrpc,
+        response={'id': 7, 'jsonrpc': '2.0', 'error': UNKNOWN_ACCOUNT})
+    response = await get_response(http_request)
+    assert ujson.loads(response.body) == {'id': 1, 'jsonrpc': '2.0', 'error': UNKNOWN_ACCOUNT}
+    assert response.headers['x-jussi-cache-hit'] == 'appbase.condenser_api.get_accounts.v1=[1]'
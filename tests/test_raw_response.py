@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import pytest
+import ujson
+
+from jussi.empty import _empty
+from jussi.raw_response import RawJsonRpcResponse
+from jussi.raw_response import encode_batch_response
+from jussi.raw_response import find_upstream_id
+from jussi.raw_response import with_id
+
+RESULT = {'id': 1, 'block': {'transactions': [{'id': 2}]}, 'text': ',"id":3}'}
+
+
+@pytest.mark.parametrize('body,expected', [
+    (b'{"id":123,"jsonrpc":"2.0","result":1}', 123),
+    (b'{"jsonrpc":"2.0","result":1,"id":123}', 123),
+    (b'{"jsonrpc": "2.0", "result": 1, "id": 123}\n', 123),
+    (b'{"jsonrpc":"2.0","result":{"id":123}}', None),
+    (b'{"jsonrpc":"2.0","id":123,"result":1}', None),
+    (b'{"jsonrpc":"2.0","result":"\\",\\"id\\":123}"}', None),
+    (b'<html>bad gateway</html>', None)
+])
+def test_find_upstream_id(body, expected):
+    found = find_upstream_id(body)
+    if expected is None:
+        assert found is None
+    else:
+        assert found[0] == expected
+
+
+@pytest.mark.parametrize('upstream_response', [
+    {'id': 123, 'jsonrpc': '2.0', 'result': RESULT},
+    {'jsonrpc': '2.0', 'result': RESULT, 'id': 123},
+    {'jsonrpc': '2.0', 'id': 123, 'result': RESULT},
+    {'jsonrpc': '2.0', 'error': {'code': -32603, 'message': 'Internal Error'}, 'id': 123}
+])
+@pytest.mark.parametrize('_id', [1, 'abc', None, 12345678901])
+def test_from_upstream(upstream_response, _id):
+    body = ujson.dumps(upstream_response)
+    response = RawJsonRpcResponse.from_upstream(body, _id)
+    assert response.upstream_id == 123
+    assert ujson.loads(response.body) == dict(upstream_response, id=_id)
+    assert response == dict(upstream_response, id=_id)
+
+
+def test_from_upstream_no_id():
+    body = ujson.dumps({'jsonrpc': '2.0', 'result': RESULT, 'id': 123})
+    response = RawJsonRpcResponse.from_upstream(body, _empty)
+    assert 'id' not in ujson.loads(response.body)
+
+
+def test_from_upstream_invalid():
+    with pytest.raises(ValueError):
+        RawJsonRpcResponse.from_upstream(b'<html>bad gateway</html>', 1)
+
+
+def test_with_id():
+    body = ujson.dumps({'jsonrpc': '2.0', 'result': RESULT, 'id': 123})
+    response = RawJsonRpcResponse.from_upstream(body, 1)
+    response2 = with_id(response, 'a longer id')
+    assert response2['id'] == 'a longer id'
+    assert with_id(response2, 2)['id'] == 2
+    assert response['id'] == 1
+    assert with_id({'id': 1, 'result': 1}, 2) == {'id': 2, 'result': 1}
+
+
+def test_encode_batch_response():
+    responses = [
+        RawJsonRpcResponse.from_upstream(
+            ujson.dumps({'jsonrpc': '2.0', 'result': RESULT, 'id': 123}), 1),
+        {'id': 2, 'jsonrpc': '2.0', 'result': RESULT}
+    ]
+    assert ujson.loads(encode_batch_response(responses)) == [
+        {'id': 1, 'jsonrpc': '2.0', 'result': RESULT},
+        {'id': 2, 'jsonrpc': '2.0', 'result': RESULT}
+    ]
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from jussi.cache.backends.replicas import HEDGE_MIN_SAMPLES
+from jussi.cache.backends.replicas import ReplicaSet
+
+
+class FakeReplica:
+    def __init__(self, values=None, delay=0.0, error=None):
+        self.values = values or {}
+        self.delay = delay
+        self.error = error
+        self.reads = 0
+
+    async def get(self, key):
+        results = await self.mget([key])
+        return results[0]
+
+    async def mget(self, keys):
+        self.reads += 1
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return [self.values.get(key) for key in keys]
+
+
+def warm(replica_set, latency):
+    for replica in replica_set.replicas:
+        for _ in range(HEDGE_MIN_SAMPLES):
+            replica.observe(latency)
+
+
+async def test_reads_fastest_replica():
+    slow = FakeReplica({'key': 'slow'}, delay=0.02)
+    fast = FakeReplica({'key': 'fast'})
+    replica_set = ReplicaSet([slow, fast], hedge_percentile=0)
+    results = [await replica_set.get('key') for _ in range(10)]
+    # each replica is read once to measure it, then the fastest
+    assert results[2:] == ['fast'] * 8
+    assert slow.reads == 1
+    assert await replica_set.mget(['key', 'other']) == ['fast', None]
+
+
+async def test_hedged_read():
+    slow = FakeReplica({'key': 'slow'}, delay=0.2)
+    fast = FakeReplica({'key': 'fast'})
+    replica_set = ReplicaSet([slow, fast], hedge_percentile=95)
+    warm(replica_set, 0.001)
+    replica_set.replicas[1].observe(0.002)
+    assert await replica_set.get('key') == 'fast'
+    assert replica_set.hedges == 1
+    assert replica_set.hedge_wins == 1
+
+
+async def test_hedged_read_waits_for_a_hit():
+    missing = FakeReplica({}, delay=0.01)
+    slow = FakeReplica({'key': 'slow'}, delay=0.03)
+    replica_set = ReplicaSet([slow, missing], hedge_percentile=95)
+    warm(replica_set, 0.001)
+    replica_set.replicas[1].observe(0.01)
+    assert await replica_set.get('key') == 'slow'
+    assert replica_set.hedge_wins == 0
+
+
+@pytest.mark.parametrize('error', [None, ConnectionError('down')])
+async def test_ejects_failing_replica(error):
+    bad = FakeReplica({'key': 'bad'}, delay=0 if error else 0.05, error=error)
+    good = FakeReplica({'key': 'good'}, delay=0.001)
+    replica_set = ReplicaSet([bad, good], timeout=0.01, hedge_percentile=0,
+                             eject_after=2, eject_seconds=60)
+    replica_set.replicas[1].observe(1.0)
+    for _ in range(2):
+        if error is None:
+            assert await replica_set.get('key') is None
+        else:
+            with pytest.raises(ConnectionError):
+                await replica_set.get('key')
+    assert replica_set.to_dict()['replicas'][0]['ejected'] is True
+    assert await replica_set.get('key') == 'good'
+    # reinstated with a fresh ewma once the ejection is over
+    replica_set.replicas[0].ejected_until = 1.0
+    replica_set.ranked()
+    assert replica_set.replicas[0].ewma is None
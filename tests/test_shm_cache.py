@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from jussi.cache.backends.shm import SharedMemoryCache
+
+SIZE = 4096 + 4 * 64 * 1024
+LARGE_SIZE = 4096 + 4 * 1024 * 1024
+
+
+@pytest.fixture
+def shm_path(tmpdir):
+    return os.path.join(str(tmpdir), 'jussi-cache')
+
+
+def test_shm_cache_get_set(shm_path):
+    cache = SharedMemoryCache(SIZE, path=shm_path)
+    cache.sets('key', {'result': 1}, 180)
+    assert cache.gets('key') == {'result': 1}
+    assert cache.gets('missing') is None
+    cache.sets('key', 'x' * 5000, None)
+    assert cache.gets('key') == 'x' * 5000
+    cache.sets('key', 'small', None)
+    assert cache.gets('key') == 'small'
+    assert cache.to_dict()['hits'] == 3
+    assert cache.to_dict()['stored'] == 3
+
+
+def test_shm_cache_expiry(shm_path):
+    cache = SharedMemoryCache(SIZE, path=shm_path)
+    cache.sets('key', 1, 0.05)
+    cache.sets('uncached', 1, -1)
+    assert cache.gets('key') == 1
+    assert cache.gets('uncached') is None
+    time.sleep(0.06)
+    assert cache.gets('key') is None
+
+
+async def test_shm_cache_ttls(shm_path):
+    cache = SharedMemoryCache(SIZE, path=shm_path)
+    cache.sets('key', 1, 10)
+    cache.sets('forever', 1, None)
+    ttls = await cache.ttls(['key', 'forever', 'missing'])
+    assert 9 < ttls[0] <= 10
+    assert ttls[1:] == [None, 0.0]
+
+
+def test_shm_cache_too_large(shm_path):
+    cache = SharedMemoryCache(SIZE, path=shm_path, slot_sizes=(1024, 4096))
+    cache.sets('key', os.urandom(8192).hex(), 180)
+    assert cache.gets('key') is None
+    assert cache.to_dict()['too_large'] == 1
+
+
+def test_shm_cache_shared_between_instances(shm_path):
+    writer = SharedMemoryCache(SIZE, path=shm_path)
+    reader = SharedMemoryCache(SIZE, path=shm_path)
+    writer.sets('key', [1, 2, 3], 180)
+    assert reader.gets('key') == [1, 2, 3]
+
+
+def test_shm_cache_keeps_existing_layout(shm_path):
+    cache = SharedMemoryCache(SIZE, path=shm_path)
+    cache.sets('key', 1, 180)
+    other = SharedMemoryCache(LARGE_SIZE, path=shm_path, slot_sizes=(2048, 8192))
+    assert other.size == SIZE
+    assert other.to_dict()['slots'] == cache.to_dict()['slots']
+    assert os.path.getsize(shm_path) == SIZE
+    assert other.gets('key') == 1
+    other.sets('other', 2, 180)
+    assert cache.gets('other') == 2
+
+
+def test_shm_cache_recreated_when_invalid(shm_path):
+    with open(shm_path, 'wb') as f:
+        f.write(b'not a cache')
+    cache = SharedMemoryCache(SIZE, path=shm_path)
+    assert os.path.getsize(shm_path) == SIZE
+    cache.sets('key', 1, 180)
+    assert cache.gets('key') == 1
+
+
+def write_values(path, start):
+    cache = SharedMemoryCache(LARGE_SIZE, path=path)
+    for i in range(start, start + 100):
+        cache.sets(f'key{i}', {'value': i}, 180)
+
+
+def test_shm_cache_shared_between_processes(shm_path):
+    cache = SharedMemoryCache(LARGE_SIZE, path=shm_path)
+    workers = [multiprocessing.Process(target=write_values, args=(shm_path, i * 100))
+               for i in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    found = [cache.gets(f'key{i}') for i in range(200)]
+    # colliding keys overwrite each other, but no value is torn or mixed up
+    assert all(value is None or value == {'value': i} for i, value in enumerate(found))
+    assert sum(value is not None for value in found) > 100
+
+
+async def test_shm_cache_async_api(shm_path):
+    cache = SharedMemoryCache(SIZE, path=shm_path)
+    await cache.set_many({'a': 1, 'b': 2}, expire_time=180)
+    assert await cache.mget(['a', 'b', 'c']) == [1, 2, None]
+    await cache.clear()
+    assert await cache.get('a') is None
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from jussi.single_flight import SingleFlight
+from jussi.single_flight import is_coalescable_request
+from jussi.upstream import _Upstreams
+from jussi.upstream import Upstream
+from jussi.urn import URN
+
+SINGLE_FLIGHT_CONFIG = {
+    "limits": {},
+    "upstreams": [
+        {
+            "name": "test",
+            "urls": [
+                ["test", "http://test1.com"]
+            ],
+            "ttls": [
+                ["test", 3],
+                ["test.api.uncached", -1]
+            ],
+            "timeouts": [
+                ["test", 1]
+            ]
+        }
+    ]
+}
+
+upstreams = _Upstreams(SINGLE_FLIGHT_CONFIG, validate=False)
+
+
+class FakeJrpcRequest:
+    def __init__(self, _id, method='get_block', api='api', params=1):
+        self.id = _id
+        self.urn = URN('test', api, method, params)
+        self.upstream = Upstream.from_urn(self.urn, upstreams=upstreams)
+
+
+def make_fetch(request, calls, delay=0.01, exc=None):
+    async def fetch():
+        calls.append(request.id)
+        await asyncio.sleep(delay)
+        if exc:
+            raise exc
+        return {'id': request.id, 'jsonrpc': '2.0', 'result': {'block': 1}}
+    return fetch
+
+
+@pytest.mark.parametrize('request_args,expected', [
+    (dict(), True),
+    (dict(api='api', method='uncached'), False),
+    (dict(api='condenser_api', method='broadcast_transaction'), False)
+])
+def test_is_coalescable_request(request_args, expected):
+    assert is_coalescable_request(FakeJrpcRequest(1, **request_args)) is expected
+
+
+async def test_single_flight_coalesces():
+    single_flight = SingleFlight()
+    calls = []
+    requests = [FakeJrpcRequest(i) for i in range(10)]
+    responses = await asyncio.gather(*[single_flight.fetch(r, make_fetch(r, calls))
+                                       for r in requests])
+    assert calls == [0]
+    assert [r['id'] for r in responses] == list(range(10))
+    assert all(r['result'] == {'block': 1} for r in responses)
+    assert single_flight.leaders == 1
+    assert single_flight.coalesced == 9
+    assert len(single_flight) == 0
+
+
+async def test_single_flight_different_keys():
+    single_flight = SingleFlight()
+    calls = []
+    requests = [FakeJrpcRequest(i, params=i) for i in range(3)]
+    await asyncio.gather(*[single_flight.fetch(r, make_fetch(r, calls)) for r in requests])
+    assert sorted(calls) == [0, 1, 2]
+    assert single_flight.coalesced == 0
+
+
+async def test_single_flight_uncacheable():
+    single_flight = SingleFlight()
+    calls = []
+    requests = [FakeJrpcRequest(i, method='uncached') for i in range(3)]
+    await asyncio.gather(*[single_flight.fetch(r, make_fetch(r, calls)) for r in requests])
+    assert len(calls) == 3
+
+
+async def test_single_flight_shares_errors():
+    single_flight = SingleFlight()
+    calls = []
+    requests = [FakeJrpcRequest(i) for i in range(3)]
+    results = await asyncio.gather(
+        *[single_flight.fetch(r, make_fetch(r, calls, exc=ConnectionError()))
+          for r in requests], return_exceptions=True)
+    assert calls == [0]
+    assert all(isinstance(r, ConnectionError) for r in results)
+    # nothing left in flight, the next request goes upstream again
+    await single_flight.fetch(requests[0], make_fetch(requests[0], calls))
+    assert calls == [0, 0]
+
+
+async def test_single_flight_leader_cancelled():
+    single_flight = SingleFlight()
+    calls = []
+    leader, waiter = FakeJrpcRequest(1), FakeJrpcRequest(2)
+    leader_task = asyncio.ensure_future(single_flight.fetch(leader, make_fetch(leader, calls)))
+    await asyncio.sleep(0)
+    waiter_task = asyncio.ensure_future(single_flight.fetch(waiter, make_fetch(waiter, calls)))
+    await asyncio.sleep(0)
+    leader_task.cancel()
+    response = await waiter_task
+    assert response['id'] == 2
+    assert calls == [1]
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+import ujson
+
+import jussi.cache.cache_group
+import jussi.cache.utils
+import jussi.handlers
+import jussi.middlewares.caching
+from jussi.cache.cache_group import CacheGroup
+from jussi.cache.utils import StaleResponse
+from jussi.handlers import dispatch_single_or_stale
+from jussi.middlewares.caching import stale_or_none
+from jussi.raw_response import RawJsonRpcResponse
+from jussi.request.jsonrpc import from_http_request
+from jussi.upstream import _Upstreams
+
+CONFIG = {
+    "limits": {},
+    "upstreams": [
+        {
+            "name": "test",
+            "urls": [["test", "http://test.com"]],
+            "ttls": [["test", 3]],
+            "timeouts": [["test", 1]],
+            "stale_ttls": [["test.api.stale", 5]],
+            "stale_if_error_ttls": [["test.api", 60]]
+        }
+    ]
+}
+UPSTREAMS = _Upstreams(CONFIG, validate=False)
+RESPONSE = {'id': 1, 'jsonrpc': '2.0', 'result': {'head_block_number': 1}}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(jussi.cache.cache_group, 'time', clock)
+    monkeypatch.setattr(jussi.cache.utils, 'time', clock)
+    return clock
+
+
+def make_http_request(method, cache_group=None):
+    config = SimpleNamespace(upstreams=UPSTREAMS,
+                             cache_group=cache_group or CacheGroup([]),
+                             last_irreversible_block_num=1)
+    http_request = SimpleNamespace(app=SimpleNamespace(config=config),
+                                   amzn_trace_id=None,
+                                   jussi_request_id='123',
+                                   request_timeout=1,
+                                   stale_response=None,
+                                   upstream_responses=None,
+                                   timings=[])
+    http_request.jsonrpc = from_http_request(http_request, 0, {
+        'id': 1, 'jsonrpc': '2.0', 'method': f'test.api.{method}'})
+    return http_request
+
+
+async def test_stale_response_kept_past_ttl(clock):
+    cache_group = CacheGroup([])
+    request = make_http_request('stale', cache_group).jsonrpc
+    other = make_http_request('other', cache_group).jsonrpc
+    await cache_group.cache_single_jsonrpc_response(request=request, response=RESPONSE)
+    await cache_group.cache_single_jsonrpc_response(request=other, response=RESPONSE)
+    assert await cache_group.get_single_jsonrpc_response(request) == RESPONSE
+
+    clock.now += 4
+    stale = await cache_group.get_single_jsonrpc_response(request)
+    assert stale == StaleResponse(RESPONSE, 1.0)
+    assert await cache_group.get_batch_jsonrpc_responses([request]) == [None]
+
+
+async def test_revalidate_once(clock):
+    cache_group = CacheGroup([])
+    refreshes = []
+
+    async def refresh():
+        refreshes.append(1)
+        await asyncio.sleep(0)
+    await asyncio.gather(cache_group.revalidate('key', refresh),
+                         cache_group.revalidate('key', refresh))
+    assert len(refreshes) == 1
+    await cache_group.revalidate('key', refresh)
+    assert len(refreshes) == 2
+
+
+async def test_stale_or_none(monkeypatch):
+    refreshed = []
+
+    async def dispatch_single(http_request, jrpc_request):
+        refreshed.append(jrpc_request.urn.method)
+        return RawJsonRpcResponse(ujson.dumps(RESPONSE).encode())
+    monkeypatch.setattr(jussi.middlewares.caching, 'dispatch_single', dispatch_single)
+
+    http_request = make_http_request('stale')
+    assert stale_or_none(http_request, StaleResponse(RESPONSE, 4)) == RESPONSE
+    await asyncio.sleep(0)
+    assert refreshed == ['stale']
+
+    http_request = make_http_request('stale')
+    assert stale_or_none(http_request, StaleResponse(RESPONSE, 10)) is None
+    assert http_request.stale_response == RESPONSE
+
+    http_request = make_http_request('stale')
+    assert stale_or_none(http_request, StaleResponse(RESPONSE, 100)) is None
+    assert http_request.stale_response is None
+
+
+@pytest.mark.parametrize('upstream_response,expected', [
+    (asyncio.TimeoutError(), RESPONSE),
+    ({'id': 1, 'jsonrpc': '2.0', 'error': {'code': -32000}}, RESPONSE),
+    ({'id': 1, 'jsonrpc': '2.0', 'result': 'fresh'}, {'id': 1, 'jsonrpc': '2.0', 'result': 'fresh'})
+])
+async def test_dispatch_single_or_stale(monkeypatch, upstream_response, expected):
+    async def dispatch_single(http_request, jrpc_request):
+        if isinstance(upstream_response, Exception):
+            raise upstream_response
+        return upstream_response
+    monkeypatch.setattr(jussi.handlers, 'dispatch_single', dispatch_single)
+    http_request = make_http_request('stale')
+    http_request.stale_response = RESPONSE
+    response = await dispatch_single_or_stale(http_request)
+    assert ujson.loads(response.body) == expected
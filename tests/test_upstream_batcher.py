@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from jussi.errors import UpstreamResponseError
+from jussi.upstream_batcher import UpstreamBatcher
+from jussi.upstream_batcher import http_batch_sender
+
+
+class FakeJrpcRequest:
+    # jussi request ids from different clients may collide
+    upstream_id = 123
+
+    def __init__(self, _id, params, jussi_request_id=123):
+        self.id = _id
+        self.params = params
+        self.jussi_request_id = jussi_request_id
+
+    @property
+    def upstream_headers(self):
+        return {'x-jussi-request-id': self.jussi_request_id,
+                'x-amzn-trace-id': f'Root={self.jussi_request_id}'}
+
+    def to_upstream_request(self, as_json=True):
+        return {'id': self.upstream_id, 'jsonrpc': '2.0',
+                'method': 'get_block', 'params': self.params}
+
+
+def make_send(batches, drop=(), exc=None, headers=None):
+    async def send(batch, batch_headers=None):
+        batches.append(batch)
+        if headers is not None:
+            headers.append(batch_headers)
+        await asyncio.sleep(0)
+        if exc:
+            raise exc
+        # hived may reorder responses
+        return [{'id': r['id'], 'jsonrpc': '2.0', 'result': r['params']}
+                for r in reversed(batch) if r['params'] not in drop]
+    return send
+
+
+async def test_upstream_batch():
+    batches = []
+    batcher = UpstreamBatcher('http://test.com', make_send(batches), linger=0.01)
+    responses = await asyncio.gather(*[batcher.fetch(FakeJrpcRequest(i, [i * 10]))
+                                       for i in range(5)])
+    assert responses == [{'id': i, 'jsonrpc': '2.0', 'result': [i * 10]}
+                         for i in range(5)]
+    assert len(batches) == 1
+    assert [r['id'] for r in batches[0]] == list(range(5))
+    assert batcher.to_dict() == {'url': 'http://test.com', 'batches': 1,
+                                 'requests': 5, 'pending': 0}
+
+
+async def test_upstream_batch_max_size():
+    batches = []
+    batcher = UpstreamBatcher('http://test.com', make_send(batches),
+                              max_size=2, linger=10)
+    await asyncio.gather(*[batcher.fetch(FakeJrpcRequest(i, [i])) for i in range(4)])
+    assert [len(b) for b in batches] == [2, 2]
+
+
+async def test_upstream_batch_error():
+    batcher = UpstreamBatcher('http://test.com', make_send([], exc=ConnectionError()),
+                              linger=0.001)
+    results = await asyncio.gather(batcher.fetch(FakeJrpcRequest(1, [1])),
+                                   batcher.fetch(FakeJrpcRequest(2, [2])),
+                                   return_exceptions=True)
+    assert all(isinstance(r, ConnectionError) for r in results)
+
+
+async def test_upstream_batch_missing_response():
+    batcher = UpstreamBatcher('http://test.com', make_send([], drop=([2],)),
+                              linger=0.001)
+    ok = asyncio.ensure_future(batcher.fetch(FakeJrpcRequest(1, [1])))
+    missing = asyncio.ensure_future(batcher.fetch(FakeJrpcRequest(2, [2])))
+    assert (await ok)['result'] == [1]
+    with pytest.raises(UpstreamResponseError):
+        await missing
+
+
+async def test_upstream_batch_skips_cancelled():
+    batches = []
+    batcher = UpstreamBatcher('http://test.com', make_send(batches), linger=0.01)
+    cancelled = asyncio.ensure_future(batcher.fetch(FakeJrpcRequest(1, [1])))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    assert (await batcher.fetch(FakeJrpcRequest(2, [2])))['id'] == 2
+    assert [r['params'] for r in batches[0]] == [[2]]
+
+
+async def test_upstream_batch_headers():
+    headers = []
+    batcher = UpstreamBatcher('http://test.com', make_send([], headers=headers), linger=0.01)
+    await asyncio.gather(batcher.fetch(FakeJrpcRequest(1, [1], jussi_request_id=7)),
+                         batcher.fetch(FakeJrpcRequest(2, [2], jussi_request_id=7)),
+                         batcher.fetch(FakeJrpcRequest(3, [3], jussi_request_id=9)))
+    assert headers == [{'x-jussi-request-id': 7,
+                        'x-amzn-trace-id': 'Root=7',
+                        'x-jussi-batch-request-ids': '7,9'}]
+
+
+class FakeResponse:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def json(self, encoding=None, content_type=None):
+        return []
+
+
+class FakeSession:
+    def __init__(self):
+        self.posts = []
+
+    def post(self, url, json=None, headers=None):
+        self.posts.append((url, json, headers))
+        return FakeResponse()
+
+
+async def test_http_batch_sender_headers():
+    session = FakeSession()
+    send = http_batch_sender(session, 'http://test.com')
+    await send([{'id': 0}], {'x-jussi-request-id': '7'})
+    # the block prefetcher sends batches with no client request behind them
+    await send([{'id': 0}])
+    assert session.posts == [('http://test.com', [{'id': 0}], {'x-jussi-request-id': '7'}),
+                             ('http://test.com', [{'id': 0}], None)]
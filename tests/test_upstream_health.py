@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import ujson
+import pytest
+
+from jussi.upstream import _Upstreams
+from jussi.upstream_health import UpstreamHealthChecker
+from jussi.upstream_health import health_check_request
+from jussi.upstream_health import is_healthy_response
+
+HEALTH_CHECK_CONFIG = {
+    "limits": {},
+    "upstreams": [
+        {
+            "name": "test",
+            "urls": [
+                ["test", ["http://test1.com", "http://test2.com"]]
+            ],
+            "ttls": [
+                ["test", 1]
+            ],
+            "timeouts": [
+                ["test", 1]
+            ]
+        },
+        {
+            "name": "test2",
+            "health_check": {"path": "/health"},
+            "urls": [
+                ["test2", "http://test3.com"]
+            ],
+            "ttls": [
+                ["test2", 1]
+            ],
+            "timeouts": [
+                ["test2", 1]
+            ]
+        }
+    ]
+}
+
+
+def test_default_health_check_request():
+    request = ujson.loads(health_check_request(dict()))
+    assert request == {'id': 0, 'jsonrpc': '2.0',
+                       'method': 'condenser_api.get_dynamic_global_properties'}
+
+
+def test_health_check_request_method_and_params():
+    request = ujson.loads(health_check_request({'method': 'hive.db_head_state',
+                                                'params': {}}))
+    assert request['method'] == 'hive.db_head_state'
+    assert request['params'] == {}
+
+
+@pytest.mark.parametrize('response,expected', [
+    (b'{"id":0,"jsonrpc":"2.0","result":{}}', True),
+    (b'{"id":0,"jsonrpc":"2.0","error":{"code":-32601}}', True),
+    (b'<html>bad gateway</html>', False),
+    (b'[]', False),
+    (b'', False)
+])
+def test_is_healthy_response(response, expected):
+    assert is_healthy_response(response) is expected
+
+
+def test_health_check_config():
+    upstreams = _Upstreams(HEALTH_CHECK_CONFIG, validate=False)
+    assert upstreams.health_check('http://test1.com') == dict()
+    assert upstreams.health_check('http://test3.com') == {'path': '/health'}
+
+
+async def test_check_all(loop):
+    upstreams = _Upstreams(HEALTH_CHECK_CONFIG, validate=False)
+    checker = UpstreamHealthChecker(upstreams, None, interval=1, timeout=1, loop=loop)
+    unhealthy = {'http://test2.com'}
+
+    async def check(endpoint):
+        return endpoint.url not in unhealthy
+    checker.check = check
+
+    await checker.check_all()
+    endpoints = upstreams.endpoints
+    assert endpoints['http://test2.com'].is_ejected()
+    assert not endpoints['http://test1.com'].is_ejected()
+
+    unhealthy.clear()
+    await checker.check_all()
+    assert not endpoints['http://test2.com'].is_ejected()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import jussi.handlers
+from jussi.concurrency_limits import UpstreamConcurrencyLimits
+from jussi.handlers import fetch_with_retries
+from jussi.upstream import _Upstreams
+from jussi.upstream import Upstream
+from jussi.urn import URN
+
+RETRY_CONFIG = {
+    "limits": {},
+    "upstreams": [
+        {
+            "name": "test",
+            "urls": [
+                ["test", ["http://test1.com", "http://test2.com"]]
+            ],
+            "ttls": [
+                ["test", 1]
+            ],
+            "timeouts": [
+                ["test", 1]
+            ],
+            "retries": [
+                ["test", 1]
+            ],
+            "hedge_after_ms": [
+                ["test.api.hedged", 10]
+            ]
+        }
+    ]
+}
+
+
+HTTP_REQUEST = SimpleNamespace(app=SimpleNamespace(config=SimpleNamespace(
+    upstream_batchers={}, upstream_fair_queues=None, upstream_concurrency_limits=None)))
+
+
+class FakeJrpcRequest:
+    def __init__(self, urn, upstreams):
+        self.urn = urn
+        self.upstream = Upstream.from_urn(urn, upstreams=upstreams)
+        self.timings = []
+
+
+@pytest.fixture
+def upstreams():
+    return _Upstreams(RETRY_CONFIG, validate=False)
+
+
+def patch_fetch(monkeypatch, delays, failing=()):
+    calls = []
+
+    async def fetch_http(http_request, jrpc_request, url=None):
+        calls.append(url)
+        await asyncio.sleep(delays.get(url, 0))
+        if url in failing:
+            raise ConnectionError(url)
+        return {'id': 1, 'jsonrpc': '2.0', 'result': url}
+    monkeypatch.setattr(jussi.handlers, 'fetch_http', fetch_http)
+    return calls
+
+
+async def test_retry_on_other_url(monkeypatch, upstreams):
+    calls = patch_fetch(monkeypatch, {}, failing={'http://test1.com'})
+    request = FakeJrpcRequest(URN('test', 'api', 'method', False), upstreams)
+    for _ in range(2):
+        response = await fetch_with_retries(HTTP_REQUEST, request)
+        assert response['result'] == 'http://test2.com'
+    assert calls.count('http://test2.com') == 2
+
+
+async def test_limit_observes_endpoint_fetches(monkeypatch, upstreams):
+    patch_fetch(monkeypatch, {'http://test2.com': 0.01}, failing={'http://test1.com'})
+    limits = UpstreamConcurrencyLimits()
+    http_request = SimpleNamespace(app=SimpleNamespace(config=SimpleNamespace(
+        upstream_batchers={}, upstream_fair_queues=None, upstream_concurrency_limits=limits)))
+    request = FakeJrpcRequest(URN('test', 'api', 'method', False), upstreams)
+    await fetch_with_retries(http_request, request)
+    # only the successful fetch is a round trip, the failed one isn't counted in it
+    min_rtts = limits[request.upstream.url].to_dict()['min_rtts']
+    assert list(min_rtts) == ['api.method']
+    # timers can wake a little early, so allow some slack below the 0.01s sleep,
+    # while staying well above the instant failed fetch
+    assert 0.005 < min_rtts['api.method'] < 0.1
+
+
+async def test_no_retry_for_broadcast(monkeypatch, upstreams):
+    patch_fetch(monkeypatch, {}, failing={'http://test1.com', 'http://test2.com'})
+    request = FakeJrpcRequest(URN('test', 'condenser_api', 'broadcast_transaction', False),
+                              upstreams)
+    with pytest.raises(ConnectionError):
+        await fetch_with_retries(HTTP_REQUEST, request)
+    assert sum(e.errors for e in upstreams.endpoints.values()) == 1
+
+
+async def test_hedged_request(monkeypatch, upstreams):
+    calls = patch_fetch(monkeypatch, {'http://test1.com': 1, 'http://test2.com': 0})
+    request = FakeJrpcRequest(URN('test', 'api', 'hedged', False), upstreams)
+    response = await fetch_with_retries(HTTP_REQUEST, request)
+    assert response['result'] == 'http://test2.com'
+    assert calls == ['http://test1.com', 'http://test2.com']
+    # the abandoned request is not an error
+    await asyncio.sleep(0)
+    slow = upstreams.endpoints['http://test1.com']
+    assert slow.errors == 0
+    assert slow.outstanding == 0
+
+
+async def test_no_hedge_when_fast(monkeypatch, upstreams):
+    calls = patch_fetch(monkeypatch, {})
+    request = FakeJrpcRequest(URN('test', 'api', 'hedged', False), upstreams)
+    await fetch_with_retries(HTTP_REQUEST, request)
+    assert len(calls) == 1
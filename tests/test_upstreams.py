@@ -49,6 +49,47 @@ SIMPLE_CONFIG = {
     ]
 }
 
+BALANCED_CONFIG = {
+    "limits": {},
+    "upstreams": [
+        {
+            "name": "test",
+            "balancer": "least_outstanding_requests",
+            "urls": [
+                ["test", [["http://test1.com", 2], ["http://test2.com", 1]]],
+                ["test.api.method", ["ws://test3.com", "ws://test4.com"]],
+                ["test.api.method2", [["http://test1.com", 2], ["http://test2.com", 1]]]
+            ],
+            "ttls": [
+                ["test", 1]
+            ],
+            "timeouts": [
+                ["test", 1]
+            ],
+            "retries": [
+                ["test", 1],
+                ["test.api.method", 0]
+            ],
+            "hedge_after_ms": [
+                ["test.api.method2", 50]
+            ],
+            "priorities": [
+                ["test.api", "bulk"],
+                ["test.api.method", "critical"]
+            ],
+            "stale_ttls": [
+                ["test.api.method", 3]
+            ],
+            "stale_if_error_ttls": [
+                ["test.api", 60]
+            ],
+            "fan_outs": [
+                ["test.api.method", {"param": 0, "key": "name"}]
+            ]
+        }
+    ]
+}
+
 VALID_HOSTNAME_CONFIG = {
     "limits": {},
     "upstreams": [
@@ -203,3 +244,76 @@ def test_hash_ineq():
     upstreams1 = _Upstreams(SIMPLE_CONFIG, validate=False)
     upstreams2 = _Upstreams(VALID_HOSTNAME_CONFIG, validate=False)
     assert hash(upstreams1) != hash(upstreams2)
+
+
+def test_balanced_urls_config():
+    upstreams = _Upstreams(BALANCED_CONFIG, validate=False)
+    assert upstreams.urls == frozenset(['http://test1.com', 'http://test2.com',
+                                        'ws://test3.com', 'ws://test4.com'])
+    assert set(upstreams.endpoints.keys()) == upstreams.urls
+
+
+def test_balanced_url_is_primary_url():
+    from jussi.urn import URN
+    upstreams = _Upstreams(BALANCED_CONFIG, validate=False)
+    assert upstreams.url(URN('test', 'api', 'other', False)) == 'http://test1.com'
+    assert upstreams.url(URN('test', 'api', 'method', False)) == 'ws://test3.com'
+
+
+def test_balancer():
+    from jussi.urn import URN
+    upstreams = _Upstreams(BALANCED_CONFIG, validate=False)
+    balancer = upstreams.balancer(URN('test', 'api', 'other', False))
+    assert balancer.urls == ('http://test1.com', 'http://test2.com')
+    assert balancer.strategy_name == 'least_outstanding_requests'
+    # identical url groups share a balancer
+    assert balancer is upstreams.balancer(URN('test', 'api', 'method2', False))
+
+
+def test_balancer_default_strategy():
+    from jussi.urn import URN
+    upstreams = _Upstreams(SIMPLE_CONFIG, validate=False)
+    balancer = upstreams.balancer(URN('test', 'api', 'method', False))
+    assert balancer.strategy_name == 'round_robin'
+    assert balancer.urls == ('http://test.com',)
+
+
+def test_retries_and_hedge_after_ms():
+    from jussi.urn import URN
+    upstreams = _Upstreams(BALANCED_CONFIG, validate=False)
+    assert upstreams.retries(URN('test', 'api', 'other', False)) == 1
+    assert upstreams.retries(URN('test', 'api', 'method', False)) == 0
+    assert upstreams.hedge_after_ms(URN('test', 'api', 'other', False)) == 0
+    assert upstreams.hedge_after_ms(URN('test', 'api', 'method2', False)) == 50
+
+
+def test_retries_default():
+    from jussi.urn import URN
+    upstreams = _Upstreams(SIMPLE_CONFIG, validate=False)
+    assert upstreams.retries(URN('test', 'api', 'method', False)) == 0
+    assert upstreams.hedge_after_ms(URN('test', 'api', 'method', False)) == 0
+
+
+def test_priorities():
+    from jussi.urn import URN
+    upstreams = _Upstreams(BALANCED_CONFIG, validate=False)
+    assert upstreams.priority(URN('test', 'api', 'method', False)) == 'critical'
+    assert upstreams.priority(URN('test', 'api', 'other', False)) == 'bulk'
+    assert upstreams.priority(URN('test', 'other_api', 'method', False)) == 'normal'
+
+
+def test_stale_ttls():
+    from jussi.urn import URN
+    upstreams = _Upstreams(BALANCED_CONFIG, validate=False)
+    assert upstreams.stale_ttl(URN('test', 'api', 'method', False)) == 3
+    assert upstreams.stale_ttl(URN('test', 'api', 'other', False)) == 0
+    assert upstreams.stale_if_error(URN('test', 'api', 'method', False)) == 60
+    assert upstreams.stale_if_error(URN('test', 'other_api', 'method', False)) == 0
+
+
+def test_fan_outs():
+    from jussi.urn import URN
+    from jussi.upstream import FanOut
+    upstreams = _Upstreams(BALANCED_CONFIG, validate=False)
+    assert upstreams.fan_out(URN('test', 'api', 'method', False)) == FanOut(0, 'name', None)
+    assert upstreams.fan_out(URN('test', 'api', 'other', False)) is None
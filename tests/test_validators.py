@@ -18,6 +18,7 @@ from jussi.validators import limit_broadcast_transaction_request
 from jussi.validators import limit_custom_json_op_length
 from jussi.validators import limit_custom_json_account
 from jussi.validators import is_broadcast_transaction_request
+from jussi.validators import is_idempotent_request
 from jussi.validators import validate_jsonrpc_request
 
 from .conftest import make_request
@@ -380,3 +381,22 @@ def test_invalid_limit_broadcast_transaction_request(invalid_broadcast_transacti
     with pytest.raises(JsonRpcError):
         limit_broadcast_transaction_request(
             req, limits=TEST_UPSTREAM_CONFIG['limits'])
+
+
+@pytest.mark.parametrize('req,expected', [
+    ({'id': 1, 'jsonrpc': '2.0', 'method': 'get_block', 'params': [1000]}, True),
+    ({'id': 1, 'jsonrpc': '2.0', 'method': 'condenser_api.get_block', 'params': [1000]}, True),
+    ({'id': 1, 'jsonrpc': '2.0', 'method': 'broadcast_block', 'params': [{}]}, False),
+    ({'id': 1, 'jsonrpc': '2.0', 'method': 'condenser_api.broadcast_transaction_synchronous',
+      'params': [{}]}, False),
+    ({'id': 1, 'jsonrpc': '2.0', 'method': 'network_broadcast_api.broadcast_block',
+      'params': {'block': {}}}, False)
+])
+def test_is_idempotent_request(req, expected):
+    req = jsonrpc_from_request(dummy_request, 0, req)
+    assert is_idempotent_request(req) is expected
+
+
+def test_broadcast_transaction_is_not_idempotent(valid_broadcast_transaction):
+    req = jsonrpc_from_request(dummy_request, 0, valid_broadcast_transaction)
+    assert is_idempotent_request(req) is False
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+import ujson
+from websockets.exceptions import ConnectionClosed
+
+from jussi.ws.mux import MultiplexedPool
+
+
+class FakeWSConn:
+    """echoes each request's params after its delay, in whatever order they finish"""
+
+    def __init__(self, delays=None, batch_error=False):
+        self.delays = delays or {}
+        self.batch_error = batch_error
+        self.sent = []
+        self.responses = asyncio.Queue()
+        self.open = True
+
+    async def send(self, message):
+        request = ujson.loads(message)
+        self.sent.append(request)
+        asyncio.ensure_future(self._respond(request))
+
+    async def _respond(self, request):
+        if isinstance(request, list):
+            await asyncio.sleep(0)
+            response = [{'id': r['id'], 'jsonrpc': '2.0', 'result': r['params']}
+                        for r in reversed(request)]
+            if self.batch_error:
+                response.insert(0, {'id': None, 'jsonrpc': '2.0',
+                                    'error': {'code': -32700, 'message': 'Parse error'}})
+        else:
+            await asyncio.sleep(self.delays.get(request['params'][0], 0))
+            response = {'id': request['id'], 'jsonrpc': '2.0', 'result': request['params']}
+        await self.responses.put(ujson.dumps(response))
+
+    async def recv(self):
+        message = await self.responses.get()
+        if message is None:
+            self.open = False
+            raise ConnectionClosed(1006, 'closed')
+        return message
+
+    def disconnect(self):
+        self.responses.put_nowait(None)
+
+    def fail_connection(self):
+        self.disconnect()
+
+    async def close(self):
+        self.disconnect()
+
+
+class FakeMultiplexedPool(MultiplexedPool):
+    def __init__(self, size, **kwargs):
+        super().__init__(size, None, 'ws://test.com')
+        self.conns = []
+        self.conn_kwargs = kwargs
+
+    async def _get_new_connection(self):
+        conn = FakeWSConn(**self.conn_kwargs)
+        self.conns.append(conn)
+        return conn
+
+
+def make_pool(size=1, **kwargs):
+    pool = FakeMultiplexedPool(size, **kwargs)
+    return pool, pool.conns
+
+
+def request(params, _id=1):
+    return {'id': _id, 'jsonrpc': '2.0', 'method': 'get_block', 'params': params}
+
+
+async def test_mux_concurrent_requests():
+    pool, conns = make_pool(delays={'slow': 0.05})
+    slow = asyncio.ensure_future(pool.request(request(['slow'])))
+    fast = await asyncio.gather(*[pool.request(request([i])) for i in range(10)])
+    assert not slow.done()
+    # colliding request ids are rewritten per connection
+    assert [ujson.loads(r)['result'] for r in fast] == [[i] for i in range(10)]
+    assert ujson.loads(await slow)['result'] == ['slow']
+    assert len(conns) == 1
+    assert len({r['id'] for r in conns[0].sent}) == 11
+
+
+async def test_mux_batch_request():
+    pool, _ = make_pool()
+    batch = [request([i], _id=i) for i in range(3)]
+    responses = await pool.request_batch(batch)
+    assert sorted((r['id'], r['result']) for r in responses) == [(0, [0]), (1, [1]), (2, [2])]
+
+
+async def test_mux_batch_response_with_null_id():
+    pool, _ = make_pool(batch_error=True)
+    batch = [request([i], _id=i) for i in range(3)]
+    responses = await pool.request_batch(batch, timeout=1)
+    assert responses[0]['id'] is None
+    assert sorted((r['id'], r['result']) for r in responses[1:]) == \
+        [(0, [0]), (1, [1]), (2, [2])]
+
+
+async def test_mux_batch_response_for_forgotten_request():
+    pool, _ = make_pool()
+    assert ujson.loads(await pool.request(request([1])))['result'] == [1]
+    # dropped without an error
+    pool._connections[0]._dispatch(ujson.dumps([{'id': 99, 'jsonrpc': '2.0', 'result': 1}]))
+    pool._connections[0]._dispatch(ujson.dumps([{'id': None, 'jsonrpc': '2.0', 'error': {}}]))
+
+
+async def test_mux_request_timeout():
+    pool, conns = make_pool(delays={'slow': 0.05})
+    with pytest.raises(asyncio.TimeoutError):
+        await pool.request(request(['slow']), timeout=0.01)
+    # the late response is dropped and the connection is still usable
+    await asyncio.sleep(0.06)
+    assert ujson.loads(await pool.request(request([1])))['result'] == [1]
+    assert len(conns) == 1
+
+
+async def test_mux_disconnect_fails_waiters_and_reconnects():
+    pool, conns = make_pool(delays={'slow': 1})
+    waiters = [asyncio.ensure_future(pool.request(request(['slow']))) for _ in range(3)]
+    await asyncio.sleep(0.01)
+    conns[0].disconnect()
+    results = await asyncio.gather(*waiters, return_exceptions=True)
+    assert all(isinstance(r, ConnectionClosed) for r in results)
+    assert ujson.loads(await pool.request(request([1])))['result'] == [1]
+    assert len(conns) == 2
+
+
+async def test_mux_least_loaded_connection():
+    pool, conns = make_pool(size=2, delays={'slow': 0.05})
+    await asyncio.gather(*[pool.request(request(['slow'])) for _ in range(4)])
+    assert [len(c.sent) for c in conns] == [2, 2]
+    assert [c['pending'] for c in pool.to_dict()['connections']] == [0, 0]
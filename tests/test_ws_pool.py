@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import pytest
+
+from jussi.ws.pool import Pool
+
+
+class FakeWSConn:
+    def __init__(self, answers_pings=True):
+        self.open = True
+        self.answers_pings = answers_pings
+
+    @property
+    def closed(self):
+        return not self.open
+
+    async def ping(self):
+        pong_waiter = asyncio.get_event_loop().create_future()
+        if self.answers_pings:
+            pong_waiter.set_result(None)
+        return pong_waiter
+
+    def fail_connection(self):
+        self.open = False
+
+    async def close(self, timeout=None):
+        self.open = False
+
+
+class FakePool(Pool):
+    def __init__(self, *args, answers_pings=True, **kwargs):
+        super().__init__(*args, None, 'ws://test.com', **kwargs)
+        self.conns = []
+        self.answers_pings = answers_pings
+
+    async def _get_new_connection(self):
+        conn = FakeWSConn(self.answers_pings)
+        self.conns.append(conn)
+        return conn
+
+
+async def test_pool_connects_min_size():
+    pool = await FakePool(2, 4, 0)
+    assert len(pool.conns) == 2
+    assert pool.to_dict()['size'] == 2
+
+
+async def test_pool_waiters_served_fifo():
+    pool = await FakePool(1, 1, 0)
+    conn = await pool.acquire()
+    order = []
+
+    async def acquire(i):
+        c = await pool.acquire()
+        order.append(i)
+        await pool.release(c)
+    waiters = [asyncio.ensure_future(acquire(i)) for i in range(5)]
+    await asyncio.sleep(0)
+    await pool.release(conn)
+    await asyncio.gather(*waiters)
+    assert order == list(range(5))
+
+
+async def test_pool_acquire_timeout():
+    pool = await FakePool(1, 1, 0, pool_acquire_timeout=0.01)
+    conn = await pool.acquire()
+    with pytest.raises(asyncio.TimeoutError):
+        await pool.acquire()
+    assert pool.stats['acquire_timeouts'] == 1
+    await pool.release(conn)
+    # the timed out waiter doesn't take the released connection
+    await pool.release(await pool.acquire())
+
+
+async def test_pool_grows_when_waiting():
+    pool = await FakePool(1, 3, 0, pool_scale_up_wait=0.01)
+    conns = [await pool.acquire() for _ in range(3)]
+    assert len(pool.conns) == 3
+    assert pool.stats['grown'] == 2
+    with pytest.raises(asyncio.TimeoutError):
+        await pool.acquire(timeout=0.02)
+    for conn in conns:
+        await pool.release(conn)
+    wait_times = pool.to_dict()['wait_times']
+    assert wait_times['le_0.001'] == 1
+    assert sum(wait_times.values()) == 3
+
+
+async def test_pool_shrinks_idle_connections():
+    pool = await FakePool(1, 3, 0, pool_idle_timeout=0.01)
+    conns = [await pool.acquire() for _ in range(3)]
+    for conn in conns:
+        await pool.release(conn)
+    await asyncio.sleep(0.05)
+    assert pool.to_dict()['size'] == 1
+    assert pool.stats['shrunk'] == 2
+    assert sum(c.open for c in pool.conns) == 1
+    pool.terminate()
+
+
+async def test_pool_reconnects_unanswered_pings():
+    pool = await FakePool(1, 1, 0, answers_pings=False,
+                          pool_ping_interval=0.01, pool_ping_timeout=0.01)
+    await asyncio.sleep(0.03)
+    assert pool.stats['reconnects'] >= 1
+    assert not pool.conns[0].open
+    assert pool.conns[-1].open
+    conn = await pool.acquire()
+    assert conn._con is pool.conns[-1]
+    pool.terminate()